@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compares the in-memory padding buffer (IndexedCircularIO) with the memory-mapped
+buffer (MmapCircularIO). Each buffer is filled with synthetic h264-sized
+frames in its own process, then the process's resident memory is recorded
+and the pre-roll is read the way VideoStreamSaver reads it when a recording
+is persisted. The peak resident memory (VmHWM) and the anonymous memory are
+recorded again after the persist, so they include the copies made while
+persisting. The mapped file's pages are counted in RssFile, which the kernel
+can reclaim.
+
+Run on a Pi from the repository root:
+    python3 ancillary/benchmarks/padding_buffer.py --seconds 120 --dir /mnt/ssd
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+MockFrame = namedtuple('MockFrame', 'index frame_type frame_size video_size split_size timestamp complete')
+
+
+class BenchmarkEncoder:
+
+    def __init__(self):
+        self.frame = None
+
+
+class BenchmarkCamera:
+    """
+    Supplies the encoder frame metadata both buffers read while recording.
+    """
+
+    def __init__(self, splitter_port):
+        self._encoders = {splitter_port: BenchmarkEncoder()}
+
+
+def resident_kb():
+    """
+    :return: A dict of the process's resident memory from /proc in kilobytes.
+    """
+    memory = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM', 'RssAnon', 'RssFile', 'RssShmem'):
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+def run_buffer(kind, seconds, bitrate, framerate, directory):
+    from watchtower.streamer.video_stream_saver import VideoStreamSaver
+    camera = BenchmarkCamera(splitter_port=1)
+    if kind == 'memory':
+        from watchtower.recorder.circular_io import IndexedCircularIO
+        stream = IndexedCircularIO(camera, seconds=seconds, bitrate=bitrate, splitter_port=1)
+    else:
+        from watchtower.recorder.mmap_circular_io import MmapCircularIO
+        stream = MmapCircularIO(camera, seconds=seconds, bitrate=bitrate, splitter_port=1, directory=directory)
+
+    # Fill the buffer twice so it has wrapped around.
+    frame_size = bitrate // 8 // framerate
+    frame_count = seconds * framerate * 2
+    frame_data = os.urandom(frame_size)
+    encoder = camera._encoders[1]
+    fill_start = time.time()
+    for i in range(frame_count):
+        encoder.frame = MockFrame(index=i, frame_type=0, frame_size=frame_size,
+                                  video_size=(i + 1) * frame_size, split_size=(i + 1) * frame_size,
+                                  timestamp=i * 1000000 // framerate, complete=True)
+        # A new object per frame, like the camera's buffers. Writing the same
+        # object again would let the in-memory buffer hold one reference to
+        # it for every frame.
+        stream.write(bytearray(frame_data))
+    fill_time = time.time() - fill_start
+    memory = resident_kb()
+
+    # Persist the whole pre-roll like a motion event would, in the saver's
+    # bounded reads.
+    saver = VideoStreamSaver(stream, [], 'benchmark', start_time=0)
+    persist_start = time.time()
+    position = saver.start_pos()
+    persisted = 0
+    with open(os.devnull, 'wb') as f:
+        while True:
+            buffers, position = saver.read_buffers(position)
+            read_length = 0
+            for buffer in buffers:
+                read_length += f.write(buffer)
+            persisted += read_length
+            if read_length < saver.max_read_bytes:
+                break
+    persist_time = time.time() - persist_start
+    persisted_memory = resident_kb()
+
+    return dict(buffer=kind,
+                fill_sec=round(fill_time, 3),
+                persist_sec=round(persist_time, 3),
+                persisted_mb=round(persisted / 1024 / 1024, 1),
+                peak_after_persist_kb=persisted_memory['VmHWM'],
+                anon_after_persist_kb=persisted_memory['RssAnon'],
+                **memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the padding buffers.')
+    parser.add_argument('--seconds', type=int, default=60, help='Seconds of padding.')
+    parser.add_argument('--bitrate', type=int, default=17000000, help='Video bitrate in bits per second.')
+    parser.add_argument('--framerate', type=int, default=30, help='Video framerate.')
+    parser.add_argument('--dir', default=None, help='Directory of the memory-mapped file.')
+    parser.add_argument('--buffer', choices=('memory', 'mmap'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.buffer is not None:
+        print(json.dumps(run_buffer(args.buffer, args.seconds, args.bitrate, args.framerate, args.dir)))
+        return
+
+    # Each buffer runs in a fresh process so their memory use doesn't overlap.
+    for kind in ('memory', 'mmap'):
+        command = [sys.executable, os.path.abspath(__file__), '--buffer', kind,
+                   '--seconds', str(args.seconds), '--bitrate', str(args.bitrate),
+                   '--framerate', str(args.framerate)]
+        if args.dir is not None:
+            command += ['--dir', args.dir]
+        result = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            print('%s buffer failed.' % kind)
+            continue
+        print(result.stdout.strip())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,125 @@
 import argparse
 import base64
+import io
+import struct
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 
 """
 John Newman
 April 8, 2019
 
-This program is used for decrypting files encrypted by watchtower. The first
-bytes of the file contain the character length (int) of the encrypted Fernet
+This program is used for decrypting files encrypted by watchtower. Two file
+formats are supported.
+
+Version 1 files start with the character length (int) of the encrypted Fernet
 key. The key is expected to be base64 encoded and to appear in the file
 following the length and a space.
 
-File format:
+Version 1 file format:
 "{length_int} {encoded_encrypted_key}{encrypted_data}"
 
-The supplied private pem path is used to decrypt the Fernet key.
+Version 2 files start with b'WTE' and the version byte. A data key encrypted
+with the public key is followed by authenticated frames of AES-GCM or
+ChaCha20-Poly1305 data. The format is described in
+watchtower/streamer/writer/envelope_encryption.py. Version 2 files are
+decrypted one frame at a time. When several input files are supplied, they
+are decrypted as one file, which joins the parts of an upload session that
+continued in numbered files. A file that follows the final frame of another
+starts a new one, so the numbered files of a recording, which each have their
+own data key, can be decrypted with one call too. Version 1 files are each
+decrypted on their own.
+
+The supplied private pem path is used to decrypt the Fernet key or data key.
 """
 
+MAGIC = b'WTE'
+CIPHERS = {1: AESGCM, 2: ChaCha20Poly1305}
+FINAL_FLAG = 0x80000000
+NONCE_PREFIX_SIZE = 8
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-k', '--private-pem', type=str, help='path to the private key', required=True)
-parser.add_argument('-i', '--file-path', type=str, help='path to encrypted file', required=True)
+parser.add_argument('-i', '--file-path', type=str, nargs='+', help='path to encrypted file, or the paths of its parts in order', required=True)
 parser.add_argument('-o', '--output-path', type=str, help='path to output decrypted file', required=True)
 supplied_args = vars(parser.parse_args())
 
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                            algorithm=hashes.SHA256(),
+                            label=None)
+
+
+class ConcatenatedReader(io.RawIOBase):
+    """
+    Reads the supplied files as if they were one file.
+    """
+    def __init__(self, paths):
+        self.__files = [open(path, 'rb') for path in paths]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.__files) > 0:
+            count = self.__files[0].readinto(buffer)
+            if count > 0:
+                return count
+            self.__files.pop(0).close()
+        return 0
+
+
+def read_exactly(encrypted_file, size):
+    data = encrypted_file.read(size)
+    if len(data) != size:
+        raise ValueError('The file is truncated.')
+    return data
+
+
+def decrypt_v1(encrypted_file, output_file):
+    file_string = encrypted_file.read()
+    separator = file_string.find(b' ')
+    key_size = int(file_string[:separator])
+    encrypted_key = base64.b64decode(file_string[separator+1:key_size+separator+1])
+    decrypted_key = private_key.decrypt(encrypted_key, OAEP_PADDING)
+    f = Fernet(decrypted_key)
+    output_file.write(f.decrypt(file_string[separator + key_size:]))
+
+
+def decrypt_v2(encrypted_file, output_file):
+    prefix = read_exactly(encrypted_file, len(MAGIC) + 4)
+    version, cipher, key_size = struct.unpack('>BBH', prefix[len(MAGIC):])
+    if version != 2 or cipher not in CIPHERS:
+        raise ValueError('Unsupported version %d or cipher %d.' % (version, cipher))
+    wrapped_key = read_exactly(encrypted_file, key_size)
+    nonce_prefix = read_exactly(encrypted_file, NONCE_PREFIX_SIZE)
+    header = prefix + wrapped_key + nonce_prefix
+    aead = CIPHERS[cipher](private_key.decrypt(wrapped_key, OAEP_PADDING))
+    frame_index = 0
+    final = False
+    while not final:
+        length, = struct.unpack('>I', read_exactly(encrypted_file, 4))
+        final = length & FINAL_FLAG != 0
+        ciphertext = read_exactly(encrypted_file, length & ~FINAL_FLAG)
+        nonce = nonce_prefix + struct.pack('>I', frame_index)
+        associated_data = header + struct.pack('>IB', frame_index, 1 if final else 0)
+        output_file.write(aead.decrypt(nonce, ciphertext, associated_data))
+        frame_index += 1
+
 
 with open(supplied_args['private_pem'], 'rb') as key_file:
     private_key = serialization.load_pem_private_key(key_file.read(),
                                                      password=None,
                                                      backend=default_backend())
-    with open(supplied_args['file_path'], 'rb') as encrypted_file:
-        file_string = encrypted_file.read()
-        separator = file_string.find(b' ')
-        key_size = int(file_string[:separator])
-        encrypted_key = base64.b64decode(file_string[separator+1:key_size+separator+1])
-        decrypted_key = private_key.decrypt(encrypted_key,
-                                            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                         algorithm=hashes.SHA256(),
-                                                         label=None))
-        f = Fernet(decrypted_key)
-        decrypted_data = f.decrypt(file_string[separator + key_size:])
-        with open(supplied_args['output_path'], 'ab') as output_file:
-            output_file.write(decrypted_data)
+    encrypted_file = io.BufferedReader(ConcatenatedReader(supplied_args['file_path']))
+    with open(supplied_args['output_path'], 'ab') as output_file:
+        if encrypted_file.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+            while len(encrypted_file.peek(1)) > 0:
+                decrypt_v2(encrypted_file, output_file)
+        else:
+            encrypted_file.close()
+            for path in supplied_args['file_path']:
+                with open(path, 'rb') as f:
+                    decrypt_v1(f, output_file)
@@ -46,17 +46,30 @@ while getopts ":hi:o:k:f:" opt; do
     esac
 done
 
-# Optionally decrypt all h264e files and append all the h264 data into one
-find "$input_path" -name "*.h264" | sort -V | while read file; do
-    short_path=${file//"$input_path"/}
-    short_dir=`dirname "$short_path"`
+# Optionally decrypt the h264 files and append each directory's data into one.
+# An upload session that failed partway continues video.h264 in numbered
+# files, so video.h264 comes first, followed by the numbered files in order.
+# The encrypted parts of a directory are decrypted by one call to decrypt.py.
+find "$input_path" -name "*.h264" -exec dirname {} \; | sort -u | while read dir; do
+    short_dir=${dir//"$input_path"/}
     short_dir=${short_dir//[[:blank:]]/} # MP4Box does not like spaces
     new_file="$output_path$short_dir"/blended_video.h264
     mkdir -p "`dirname "$new_file"`"
+    set --
+    if [ -f "$dir/video.h264" ]; then
+        set -- "$dir/video.h264"
+    fi
+    while read file; do
+        if [ -n "$file" ]; then
+            set -- "$@" "$file"
+        fi
+    done <<EOF
+$(find "$dir" -maxdepth 1 -name "*.h264" ! -name "video.h264" | sort -V)
+EOF
     if [[ -z "$key_path" ]]; then
-        cat "$file" >> "$new_file"
+        cat "$@" >> "$new_file"
     else
-        python decryption/decrypt.py -k "$key_path" -i "$file" -o $"$new_file"
+        python decryption/decrypt.py -k "$key_path" -i "$@" -o "$new_file"
     fi
 done
 
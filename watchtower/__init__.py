@@ -12,9 +12,11 @@ import logging.config
 import os
 import picamera
 import time
+from werkzeug.http import is_resource_modified
 from .remote.servo import Servo
 from .run_loop import RunLoop
-from .streamer.mjpeg_streamer import MJPEGStreamer
+from .streamer.async_mjpeg_server import AsyncMJPEGServer, MJPEG_PATHS, INTERNAL_MJPEG_PATH
+from .streamer.mjpeg_broadcaster import stream_options
 from .streamer.writer import http_writer
 from .util import file_system as fs
 
@@ -25,6 +27,8 @@ __version__ = "1.6.0"
 __maintainer__ = "John Newman"
 __status__ = "Production"
 
+DEFAULT_PAGE_DAYS = 7  # The days of recordings in each page of the web app
+
 def setup_logging(app):
     with open(os.environ.get('LOG_CONFIG'), 'r') as log_config_file:
         logging.config.dictConfig(json.load(log_config_file))
@@ -46,12 +50,20 @@ def create_app(test_config=None):
 
     # The web routes are not required and can be omitted. However, they do
     # require the API routes, so to use the web app, you MUST enable the API.
-    if 'WEB_APP_ENABLED' in app.config:
-        if app.config['WEB_APP_ENABLED'] == True:
-            add_web_routes(app, main)
-            logging.getLogger(__name__).info('Adding web app routes.')
+    web_app_enabled = app.config.get('WEB_APP_ENABLED') == True
+    if web_app_enabled:
+        add_web_routes(app, main)
+        logging.getLogger(__name__).info('Adding web app routes.')
 
     main.start()
+
+    # The MJPEG endpoints are served from an asyncio event loop so open
+    # streams don't hold uWSGI workers. nginx routes them to this socket. Like
+    # the other web routes, /mjpeg is only served when the web app is enabled.
+    mjpeg_socket = os.environ.get('MJPEG_SOCKET')
+    if mjpeg_socket:
+        paths = MJPEG_PATHS if web_app_enabled else (INTERNAL_MJPEG_PATH,)
+        AsyncMJPEGServer(main.mjpeg_hub, mjpeg_socket, paths=paths).start()
     return app
 
 def add_api_routes(app, main_loop):
@@ -66,6 +78,14 @@ def add_api_routes(app, main_loop):
     def status():
         return dict(monitoring=main_loop.camera.should_monitor)
 
+    @app.route('/api/uploads')
+    def uploads():
+        return main_loop.upload_metrics()
+
+    @app.route('/api/writers')
+    def writers():
+        return dict(writers=main_loop.writer_metrics())
+
     @app.route('/api/stop')
     def stop():
         main_loop.camera.should_monitor = False
@@ -93,12 +113,38 @@ def add_api_routes(app, main_loop):
     @app.route('/api/recordings')
     def recordings():
         """
-        GET all recordings in Watchtower.
+        GET all recordings in Watchtower, or a page of them if a limit is
+        supplied.
         """
-        recordings = fs.all_recordings(path=os.path.join(app.instance_path, 'recordings'),
-                                       day_format=day_format,
-                                       time_format=time_format)
-        return jsonify(recordings), 200
+        if 'limit' not in request.args:
+            return conditional_listing(main_loop.recording_index.all_recordings)
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            return '', 422
+        if limit < 1:
+            return '', 422
+        def page():
+            recordings, next_cursor = main_loop.recording_index.recordings_page(limit, request.args.get('cursor'))
+            return dict(recordings=recordings, next_cursor=next_cursor)
+        return conditional_listing(page)
+
+    @app.route('/api/recordings/changes')
+    def recording_changes():
+        """
+        GET the recordings added and removed since a cursor.
+        """
+        since = request.args.get('since')
+        if since is None:
+            return jsonify(cursor=main_loop.recording_index.cursor, changes=[]), 200
+        try:
+            since = int(since)
+        except ValueError:
+            return '', 422
+        cursor, changes = main_loop.recording_index.changes(since)
+        if changes is None:
+            return jsonify(cursor=cursor), 410
+        return jsonify(cursor=cursor, changes=changes), 200
 
     @app.route('/api/recordings/<day>', methods=['GET', 'DELETE'])
     def recordings_for_day(day):
@@ -109,10 +155,7 @@ def add_api_routes(app, main_loop):
             return delete_recording(day)
         try:
             if datetime.strptime(day, day_format) is not None:
-                times = fs.all_recording_times_for_day(path=os.path.join(app.instance_path, 'recordings'),
-                                                       day_dirname=day,
-                                                       time_format=time_format)
-                return jsonify(times), 200
+                return conditional_listing(lambda: main_loop.recording_index.times_for_day(day))
         except ValueError:
             pass
         return '', 422
@@ -132,7 +175,8 @@ def add_api_routes(app, main_loop):
                 if time is None or datetime.strptime(time, time_format) is not None:
                     successful = fs.delete_recording(path=os.path.join(app.instance_path, 'recordings'),
                                                      day_dirname=day,
-                                                     time_dirname=time)
+                                                     time_dirname=time,
+                                                     index=main_loop.recording_index)
                     if successful:
                         return '', 204
                     return '', 404
@@ -140,6 +184,22 @@ def add_api_routes(app, main_loop):
             pass
         return '', 422
 
+    def conditional_listing(listing):
+        """
+        Responds with the JSON of ``listing()``, or with 304 Not Modified
+        without calling it if the client's copy is current.
+        """
+        etag, last_modified = main_loop.recording_index.version()
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = jsonify(listing())
+        else:
+            response = Response(status=304)
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.headers['Last-Modified'] = last_modified
+        response.cache_control.no_cache = True
+        return response
+
     @app.route('/api/recordings/<path:path>/trigger')
     def video_recording(path):
         """
@@ -180,6 +240,13 @@ def add_api_routes(app, main_loop):
         if main_loop.servo is not None:
             main_loop.servo.disable()
 
+    @app.route('/api/streams')
+    def streams():
+        """
+        GET the active MJPEG broadcasters and their client counts.
+        """
+        return jsonify(main_loop.mjpeg_hub.client_counts()), 200
+
     @app.route('/api/internal_mjpeg')
     def internal_stream():
         return shared_stream(main_loop)
@@ -194,9 +261,6 @@ def add_web_routes(app, main_loop):
     Adds all of the routes for Watchtower's the web app.
     """
 
-    day_format = app.config['DIR_DAY_FORMAT']
-    time_format = app.config['DIR_TIME_FORMAT']
-
     @app.route('/')
     def index():
         config_params = dict(
@@ -205,12 +269,15 @@ def add_web_routes(app, main_loop):
             image_effects=picamera.PiCamera.IMAGE_EFFECTS,
             meter_modes=picamera.PiCamera.METER_MODES
         )
-        recordings = fs.all_recordings(path=os.path.join(app.instance_path, 'recordings'),
-                                       day_format=day_format,
-                                       time_format=time_format)
+        # Only the newest days are rendered. recordings.js loads the rest as
+        # the list is scrolled.
+        page_days = app.config.get('WEB_APP_PAGE_DAYS', DEFAULT_PAGE_DAYS)
+        recordings, next_cursor = main_loop.recording_index.recordings_page(page_days)
         return render_template('base.html',
                                camera=main_loop.camera,
                                recordings=recordings,
+                               recordings_next_cursor=next_cursor,
+                               recordings_page_days=page_days,
                                config_params=config_params)
     
     @app.route('/mjpeg')
@@ -219,31 +286,29 @@ def add_web_routes(app, main_loop):
 
 def shared_stream(main_loop):
     """
-    Starts an MJPEG stream using an HTTPMultipartWriter fed to an instance
-    of MJPEGStreamer. A generator is used to continuously block, waiting on
-    a signal from the writer when a new frame is ready for output to the
-    client.
+    Starts an MJPEG stream by attaching an HTTPMultipartWriter to the run
+    loop's MJPEGHub. Clients requesting the same options share a single
+    broadcaster, so each frame is formatted once for all of them. A generator
+    is used to continuously block, waiting on a signal from the writer when a
+    new frame is ready for output to the client.
 
     An optional encoding=base64 parameter can be supplied to encode the raw
     image data in the response.
+
+    The nginx configuration sends these requests to the AsyncMJPEGServer on
+    MJPEG_SOCKET instead, so this only serves them when Watchtower is run
+    without nginx.
     """
-    encoding = request.args.get('encoding', type=str)
-    fps = 4
-    writer = http_writer.HTTPMultipartWriter(use_base64=(encoding == 'base64'))
-    streamer = MJPEGStreamer(main_loop.camera,
-                            byte_writers=[writer],
-                            name='MJPEG',
-                            servo=main_loop.servo,
-                            rate=fps)
-    streamer.start()
+    writer = http_writer.HTTPMultipartWriter(max_frames=main_loop.mjpeg_hub.client_buffer_frames)
+    main_loop.mjpeg_hub.attach(writer, **stream_options(request.args))
 
     @stream_with_context
     def generate():
         try:
             while True:
                 yield(writer.blocking_read())
-        except:
-            streamer.stop()
+        finally:
+            main_loop.mjpeg_hub.detach(writer)
 
     mimetype = 'multipart/x-mixed-replace; boundary=' + http_writer.MULTIPART_BOUNDARY
     return Response(generate(), mimetype=mimetype)
\ No newline at end of file
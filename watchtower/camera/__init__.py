@@ -3,13 +3,20 @@ import logging
 import os
 import picamera
 import time
-from threading import Lock
+from collections import namedtuple
+from threading import Condition, Lock
+
+Frame = namedtuple('Frame', 'sequence timestamp data')
 
 
 class SafeCamera (picamera.PiCamera):
     """
     A camera class that provides a safe mechanism for multiple threads to
     capture an image using ``jpeg_data`` or get/set the monitoring status.
+
+    JPEG frames are published with ``publish_frame()``. Each published frame
+    is assigned a monotonically increasing sequence number, which consumers
+    can hand to ``wait_for_frame()`` to block until a newer frame arrives.
     """
 
     def __init__(self, name, resolution, framerate, config_path):
@@ -18,8 +25,8 @@ class SafeCamera (picamera.PiCamera):
         self.__should_record = False
         self.__motion_detected = False
         self.__lock = Lock()
-        self.__jpeg_lock = Lock()
-        self.__jpeg_data = b''
+        self.__frame_condition = Condition(Lock())
+        self.__frame = Frame(sequence=0, timestamp=0, data=b'')
         self.__name = name
         self.__config_path = config_path
         self.load_config()
@@ -69,17 +76,49 @@ class SafeCamera (picamera.PiCamera):
 
     @property
     def jpeg_data(self):
-        data = None
-        self.__jpeg_lock.acquire()
-        data = self.__jpeg_data
-        self.__jpeg_lock.release()
-        return data
+        return self.latest_frame().data
 
     @jpeg_data.setter
     def jpeg_data(self, value):
-        self.__jpeg_lock.acquire()
-        self.__jpeg_data = value
-        self.__jpeg_lock.release()
+        self.publish_frame(value)
+
+    def publish_frame(self, data):
+        """
+        Stores the JPEG data as the newest frame and wakes every thread blocked
+        in ``wait_for_frame()``.
+
+        :param data: The raw JPEG bytes.
+        :return: The published Frame.
+        """
+        with self.__frame_condition:
+            self.__frame = Frame(sequence=self.__frame.sequence + 1,
+                                 timestamp=time.time(),
+                                 data=data)
+            self.__frame_condition.notify_all()
+            return self.__frame
+
+    def latest_frame(self):
+        """
+        :return: The most recently published Frame. Its sequence is 0 if no
+        frame has been published yet.
+        """
+        with self.__frame_condition:
+            return self.__frame
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        """
+        Blocks until a frame newer than ``after_seq`` has been published.
+
+        :param after_seq: The sequence number of the last frame the caller has
+        seen. The newest frame is returned immediately if it is already newer.
+        :param timeout: The maximum number of seconds to wait. ``None`` waits
+        indefinitely.
+        :return: The newest Frame, or ``None`` if the timeout expired.
+        """
+        with self.__frame_condition:
+            if self.__frame_condition.wait_for(lambda: self.__frame.sequence > after_seq, timeout):
+                return self.__frame
+            return None
 
     def load_config(self):
         if os.path.exists(self.__config_path):
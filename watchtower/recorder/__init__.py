@@ -2,8 +2,14 @@ import logging
 import os
 import picamera
 from enum import Enum
-from ..streamer.writer import dropbox_writer, disk_writer
+from threading import Lock
+from .circular_io import IndexedCircularIO
+from .mmap_circular_io import MmapCircularIO
+from ..streamer.writer import async_disk_writer, dropbox_writer, disk_writer, queued_writer, upload_service
 from ..streamer import stream_saver, video_stream_saver
+from ..streamer.stream_notifier import StreamNotifier
+
+VIDEO_BITRATE = 17000000  # picamera's default h264 bitrate
 
 
 class Destination(Enum):
@@ -19,6 +25,27 @@ class Destination(Enum):
         self.token = None
         self.pem_path = None
         self.instance_path = None
+        self.async_writes = False
+        self.fsync_policy = async_disk_writer.FSYNC_ON_CLOSE
+        self.expected_size = 0
+        # Uploads spill to disk rather than holding up the other destinations.
+        self.overflow_policy = queued_writer.OVERFLOW_SPILL if value == 1 else queued_writer.OVERFLOW_BLOCK
+        self.max_queue_bytes = queued_writer.DEFAULT_MAX_QUEUE_BYTES
+        self.upload_session = False
+        self.spool = None  # An UploadSpool for the failed uploads
+        self.upload_monitor = None  # An UploadMonitor shared by the uploads
+
+    def create_queued_writer(self, path, camera_name, video=True):
+        """
+        Wraps the writer from ``create_writer()`` in a QueuedWriter, which gives
+        this destination its own queue and worker thread.
+        """
+        return queued_writer.QueuedWriter(
+            self.create_writer(path, camera_name, video),
+            name=self.name,
+            overflow_policy=self.overflow_policy,
+            max_queue_bytes=self.max_queue_bytes
+        )
 
     def create_writer(self, path, camera_name, video=True):
         """
@@ -32,13 +59,24 @@ class Destination(Enum):
         """
         if self is Destination.disk:
             disk_path = os.path.join(self.instance_path, 'recordings', path)
+            if self.async_writes:
+                return async_disk_writer.AsyncDiskWriter(
+                    disk_path,
+                    expected_size=self.expected_size if video else 0,
+                    fsync_policy=self.fsync_policy
+                )
             return disk_writer.DiskWriter(disk_path)
         else:
             return dropbox_writer.DropboxWriter(
                 full_path='/'+os.path.join(camera_name, path),
                 dropbox_token=self.token,
                 file_chunk_size=self.file_chunk_size if video else -1,
-                public_pem_path=self.pem_path if video else None
+                public_pem_path=self.pem_path if video else None,
+                upload_session=self.upload_session if video else False,
+                spool=self.spool,
+                upload_monitor=self.upload_monitor,
+                # Trigger JPEGs jump ahead of the queued video chunks.
+                priority=upload_service.PRIORITY_VIDEO if video else upload_service.PRIORITY_TRIGGER
             )
 
 
@@ -49,7 +87,7 @@ class Recorder:
     can persist its stream's data to any number of Destination instances.
     """
 
-    def __init__(self, camera, padding_sec=0, destinations=None, splitter_port=0, resize_resolution=None):
+    def __init__(self, camera, padding_sec=0, destinations=None, splitter_port=0, resize_resolution=None, buffer_dir=None, intra_period=None, recording_index=None):
         """
         :param camera: the PiCamera used for recordings.
         :param padding_sec: the amount of time to record before a motion event.
@@ -58,17 +96,38 @@ class Recorder:
         the primary port used. 0-3 are valid.
         :param resize_resolution: the resolution to resize from the camera's
         resolution. If used, this should be smaller than the camera resolution.
+        :param buffer_dir: if supplied, the padding is buffered in a
+        memory-mapped file in this directory instead of in RAM.
+        :param intra_period: the number of frames between key frames. Saved
+        video starts on a key frame, so this bounds how much earlier than the
+        padding a recording can start. ``None`` uses the camera's default.
+        :param recording_index: the RecordingIndex that recordings saved to
+        disk are added to.
         """
 
         self.__camera = camera
         self.__destinations = destinations
         self.__resize_resolution = resize_resolution
         self.__splitter_port = splitter_port
+        self.__buffer_dir = buffer_dir
+        self.__intra_period = intra_period
+        self.__recording_index = recording_index
         self.__stream = self.create_stream(padding_sec)
         self.__stream_saver = None
+        # The (Destination, QueuedWriter) pairs of the recordings that may
+        # still be writing. Writers keep draining after persisting stops.
+        self.__writers = []
+        self.__writers_lock = Lock()
 
     def create_stream(self, padding_sec):
-        return picamera.PiCameraCircularIO(
+        if self.__buffer_dir is not None:
+            return MmapCircularIO(
+                self.camera,
+                seconds=padding_sec,
+                splitter_port=self.splitter_port,
+                directory=self.__buffer_dir
+            )
+        return IndexedCircularIO(
             self.camera,
             seconds=padding_sec,
             splitter_port=self.splitter_port
@@ -88,13 +147,16 @@ class Recorder:
 
     def start_recording(self):
         """
-        Begins saving video data to an in-memory stream.
+        Begins saving video data to an in-memory stream. SPS/PPS headers are
+        written before every key frame so recordings can start on any of them.
         """
         self.camera.start_recording(
             self.__stream,
             format='h264',
             resize=self.resize_resolution,
-            splitter_port=self.splitter_port
+            splitter_port=self.splitter_port,
+            intra_period=self.__intra_period,
+            inline_headers=True
         )
 
     def stop_recording():
@@ -117,26 +179,38 @@ class Recorder:
         if self.__stream_saver is not None:
             logging.getLogger(__name__).error('Call to persist() but already recording.')
             return None
+        self.__active_writers()  # Forget the writers that have finished
+
+        if self.__recording_index is not None and Destination.disk in self.__destinations:
+            day, time = os.path.split(directory)
+            self.__recording_index.add(day, time)
 
         def create_writers(file_name, video=True):
             """
             Returns writers for all destinations using the specified file name.
             """
-            return list(map(
-                lambda dest: dest.create_writer(
+            writers = list(map(
+                lambda dest: dest.create_queued_writer(
                     path=os.path.join(directory, file_name),
                     camera_name=self.camera.name,
                     video=video
                 ),
                 self.__destinations
             ))
+            with self.__writers_lock:
+                self.__writers.extend(zip(self.__destinations, writers))
+            return writers
 
         jpeg_writers = create_writers('trigger.jpg', video=False)
+        # The frame is already complete, so the saver never waits for data.
+        jpeg_notifier = StreamNotifier()
+        jpeg_notifier.close()
         jpeg_streamer = stream_saver.StreamSaver(
             stream=frame,
             byte_writers=jpeg_writers,
             name=('%s%s.jpeg' % (directory, self.__destinations)),
-            stop_when_empty=True
+            stop_when_empty=True,
+            notifier=jpeg_notifier
         )
         jpeg_streamer.start()
 
@@ -145,7 +219,8 @@ class Recorder:
             stream=self.__stream,
             byte_writers=video_writers,
             name=('%s%s.video' % (directory, self.__destinations)),
-            start_time=start_time
+            start_time=start_time,
+            notifier=self.__stream.notifier
         )
         self.__stream_saver.start()
 
@@ -158,3 +233,30 @@ class Recorder:
             return
         self.__stream_saver.stop()
         self.__stream_saver = None
+
+    def writer_metrics(self):
+        """
+        :return: A list with a dict for each file of this recorder that is
+        still being written. Each dict has the ``destination``, the ``path``,
+        the ``queue`` metrics of the destination's QueuedWriter, which include
+        its lag, and the ``writer`` metrics of the destination's writer, or
+        ``None`` if it doesn't report any.
+        """
+        metrics = []
+        for destination, queued in self.__active_writers():
+            writer_metrics = getattr(queued.writer, 'metrics', None)
+            metrics.append(dict(destination=destination.name,
+                                path=queued.full_path,
+                                queue=queued.metrics(),
+                                writer=writer_metrics() if writer_metrics is not None else None))
+        return metrics
+
+    def __active_writers(self):
+        """
+        Drops the writers that have finished writing.
+
+        :return: A list of the remaining (Destination, QueuedWriter) pairs.
+        """
+        with self.__writers_lock:
+            self.__writers = [(d, w) for d, w in self.__writers if not w.is_finished_writing()]
+            return list(self.__writers)
@@ -0,0 +1,123 @@
+import picamera
+from ..streamer.frame_index import FrameIndex, SPS_HEADER
+from ..streamer.stream_notifier import StreamNotifier
+
+
+class IndexedCircularIO(picamera.PiCameraCircularIO):
+    """
+    A ``PiCameraCircularIO`` that maintains a FrameIndex of its frames as the
+    camera writes to it. Only the frames added by each write are inspected,
+    so readers can locate frames without walking the whole buffer.
+
+    ``start_offset`` is the absolute position of the oldest byte still held,
+    which converts the index's absolute positions into stream positions.
+
+    ``segments()`` exposes a range of the buffer as memoryviews over the
+    buffer's own chunks, so the range can be written out without copying it.
+
+    ``notifier`` is notified after every write with the bytes written and the
+    frames completed, so savers can wait for data instead of polling.
+
+    ``headers`` holds a copy of the most recent SPS/PPS header written by the
+    encoder, which can be prepended to make a key frame decodable.
+    """
+
+    def __init__(self, camera, size=None, seconds=None, bitrate=17000000, splitter_port=1):
+        super(IndexedCircularIO, self).__init__(camera,
+                                                size=size,
+                                                seconds=seconds,
+                                                bitrate=bitrate,
+                                                splitter_port=splitter_port)
+        self.__bytes_written = 0
+        self.__start_offset = 0
+        self.frame_index = FrameIndex()
+        self.notifier = StreamNotifier()
+        self.__headers = None
+
+    @property
+    def start_offset(self):
+        with self.lock:
+            return self.__start_offset
+
+    @property
+    def headers(self):
+        with self.lock:
+            return self.__headers
+
+    def write(self, b):
+        with self.lock:
+            written = super(IndexedCircularIO, self).write(b)
+            self.__bytes_written += written
+            # CircularIO keeps the number of bytes held in _length. Seeking to
+            # the end to find it would walk the chunks.
+            self.__start_offset = self.__bytes_written - self._length
+            new_frame_count = self.__index_new_frames()
+        self.notifier.notify(written, new_frame_count)
+        return written
+
+    def segments(self, position, length):
+        """
+        :param position: The stream position of the first byte.
+        :param length: The number of bytes.
+        :return: A list of memoryviews that together cover the range. The views
+        reference the buffer's immutable chunks, so they stay valid after the
+        camera overwrites or discards that part of the buffer.
+
+        The chunks are walked from the end of the buffer nearest to the range,
+        so reading the newest frames, like an SPS header, or the oldest ones,
+        like the start of the padding, doesn't walk the whole buffer.
+        """
+        views = []
+        if length <= 0:
+            return views
+        end = position + length
+        with self.lock:
+            # PiCameraDequeHack stores (chunk, frame) pairs. Iterating and
+            # indexing return the chunks, but reversed() doesn't, so the newest
+            # chunks are indexed from the end. A deque looks an index up from
+            # its nearer end.
+            if position < self._length - end:
+                chunk_start = 0
+                for chunk in self._data:
+                    chunk_end = chunk_start + len(chunk)
+                    if chunk_end > position:
+                        views.append(memoryview(chunk)[max(0, position - chunk_start):min(len(chunk), end - chunk_start)])
+                    if chunk_end >= end:
+                        break
+                    chunk_start = chunk_end
+            else:
+                chunk_end = self._length
+                for i in range(len(self._data) - 1, -1, -1):
+                    chunk = self._data[i]
+                    chunk_start = chunk_end - len(chunk)
+                    if chunk_start < end:
+                        views.append(memoryview(chunk)[max(0, position - chunk_start):min(len(chunk), end - chunk_start)])
+                    if chunk_start <= position:
+                        break
+                    chunk_end = chunk_start
+                views.reverse()
+        return views
+
+    def __index_new_frames(self):
+        """
+        Adds the frames completed since the last write to the index, caches
+        any new SPS/PPS header and drops the frames whose data has been
+        discarded.
+
+        :return: The number of frames added.
+        """
+        last_index = self.frame_index.last_index
+        new_frames = []
+        for frame in reversed(self.frames):
+            if frame.index <= last_index:
+                break
+            new_frames.append(frame)
+        for frame in reversed(new_frames):
+            self.frame_index.append(index=frame.index,
+                                    timestamp=frame.timestamp,
+                                    position=self.__start_offset + frame.position,
+                                    frame_type=frame.frame_type)
+            if frame.frame_type == SPS_HEADER:
+                self.__headers = b''.join(self.segments(frame.position, frame.frame_size))
+        self.frame_index.discard_before(self.__start_offset)
+        return len(new_frames)
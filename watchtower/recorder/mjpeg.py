@@ -1,3 +1,5 @@
+import time
+from threading import Lock
 from . import Recorder
 
 class MJPEGRecorder(Recorder):
@@ -5,8 +7,41 @@ class MJPEGRecorder(Recorder):
     Special type of Recorder that will continuously stream an MJPEG feed and
     supply the most recent JPEG to the camera instance. This is a much faster
     way to capture stills than using the ``capture(...)`` function on PiCamera.
+
+    The encoder runs at the camera's framerate, but only ``frame_rate`` frames
+    per second are published to the camera. Decimated frames are dropped in
+    ``write()`` before they wake any consumers. That saves the CPU time spent
+    on the frames after encoding, but not the encoding, because picamera
+    can't run a splitter port slower than the camera.
     """
 
+    def __init__(self, camera, splitter_port=0, resize_resolution=None, frame_rate=None):
+        """
+        :param frame_rate: The maximum frames per second published to the
+        camera. ``None`` publishes every frame.
+        """
+        self.__lock = Lock()
+        self.__frame_interval = 0
+        self.__next_publish_time = 0
+        self.__last_publish_time = 0
+        super(MJPEGRecorder, self).__init__(camera,
+                                            splitter_port=splitter_port,
+                                            resize_resolution=resize_resolution)
+        self.frame_rate = frame_rate
+
+    @property
+    def frame_rate(self):
+        with self.__lock:
+            return 1/self.__frame_interval if self.__frame_interval > 0 else None
+
+    @frame_rate.setter
+    def frame_rate(self, value):
+        with self.__lock:
+            self.__frame_interval = 1/value if value else 0
+            # Apply a faster rate right away instead of after the old interval.
+            self.__next_publish_time = min(self.__next_publish_time,
+                                           self.__last_publish_time + self.__frame_interval)
+
     def create_stream(self, padding_sec):
         """
         Overridden since we don't use a stream. We only hold the raw jpeg data.
@@ -40,8 +75,19 @@ class MJPEGRecorder(Recorder):
         pass
 
     def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            self.camera.jpeg_data = buf
+        if not buf.startswith(b'\xff\xd8'):
+            return
+        now = time.time()
+        with self.__lock:
+            if now < self.__next_publish_time:
+                return  # Decimated.
+            if now - self.__next_publish_time < self.__frame_interval:
+                # Stay on schedule so the average rate matches frame_rate.
+                self.__next_publish_time += self.__frame_interval
+            else:
+                self.__next_publish_time = now + self.__frame_interval
+            self.__last_publish_time = now
+        self.camera.publish_frame(buf)
 
     def flush(self):
         pass
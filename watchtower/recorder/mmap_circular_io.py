@@ -0,0 +1,176 @@
+import mmap
+import tempfile
+from threading import RLock
+from ..streamer.frame_index import FrameIndex, SPS_HEADER
+from ..streamer.stream_notifier import StreamNotifier
+
+RELEASE_BYTES = 4*1024*1024  # Written bytes between releasing resident pages
+
+
+class MmapCircularIO:
+    """
+    A ring buffer for camera video backed by a memory-mapped temporary file
+    instead of RAM. It provides the same interface ``VideoStreamSaver`` uses
+    on ``IndexedCircularIO``: ``lock``, ``frame_index``, ``start_offset``,
+    ``segments()``, ``headers`` and ``notifier``.
+
+    The mapped pages are file-backed, so the kernel can write them out and
+    reclaim them under memory pressure instead of running out of memory. On
+    Python 3.8+ pages behind the write position are also released from this
+    process every ``RELEASE_BYTES``, which keeps the resident memory bounded
+    regardless of the buffer's size. Use a directory on an SSD for minutes of
+    pre-roll. A tmpfs directory avoids disk writes but is still held in RAM.
+
+    Unlike ``IndexedCircularIO``, ``segments()`` returns copies of the range
+    because the camera overwrites the file in place. The copy is made while
+    the camera's writes are locked out, so read bounded ranges, like the
+    ``max_read_bytes`` of a ``VideoStreamSaver``.
+    """
+
+    def __init__(self, camera, size=None, seconds=None, bitrate=17000000, splitter_port=1, directory=None):
+        """
+        :param camera: the PiCamera writing to the buffer. Its encoder on
+        ``splitter_port`` supplies the frame metadata.
+        :param size: the size of the buffer in bytes.
+        :param seconds: used with ``bitrate`` to compute ``size`` if it isn't
+        supplied.
+        :param bitrate: the bitrate of the video in bits per second.
+        :param splitter_port: the splitter port being recorded.
+        :param directory: the directory of the backing file. ``None`` uses the
+        system's temporary directory.
+        """
+        if size is None:
+            if seconds is None:
+                raise ValueError('You must specify either size, or seconds')
+            size = bitrate * seconds // 8
+        self.camera = camera
+        self.splitter_port = splitter_port
+        self.size = max(mmap.PAGESIZE, int(size))
+        self.lock = RLock()
+        self.frame_index = FrameIndex()
+        self.notifier = StreamNotifier()
+        self.__bytes_written = 0
+        self.__released_position = 0  # Absolute position of the last release
+        self.__headers = None
+        self.__file = tempfile.TemporaryFile(dir=directory)
+        self.__file.truncate(self.size)
+        self.__map = mmap.mmap(self.__file.fileno(), self.size)
+
+    @property
+    def start_offset(self):
+        """
+        :return: The absolute position of the oldest byte in the buffer.
+        """
+        with self.lock:
+            return max(0, self.__bytes_written - self.size)
+
+    @property
+    def headers(self):
+        """
+        :return: A copy of the most recent SPS/PPS header, or ``None``.
+        """
+        with self.lock:
+            return self.__headers
+
+    @property
+    def closed(self):
+        return self.__map.closed
+
+    def write(self, b):
+        data = memoryview(b).cast('B')
+        written = len(data)
+        with self.lock:
+            if self.__map.closed:
+                raise ValueError('I/O operation on closed buffer.')
+            kept = data[-self.size:]  # Older bytes would be overwritten anyway
+            self.__copy_in(kept, self.__bytes_written + written - len(kept))
+            self.__bytes_written += written
+            new_frame_count = self.__index_frame()
+            self.frame_index.discard_before(self.start_offset)
+            self.__release_pages()
+        self.notifier.notify(written, new_frame_count)
+        return written
+
+    def flush(self):
+        pass
+
+    def segments(self, position, length):
+        """
+        :param position: The stream position of the first byte, relative to
+        ``start_offset``.
+        :param length: The number of bytes.
+        :return: A list of bytes objects that together cover the range.
+        """
+        with self.lock:
+            held = self.__bytes_written - self.start_offset
+            position = max(0, position)
+            length = min(length, held - position)
+            if length <= 0:
+                return []
+            offset = (self.start_offset + position) % self.size
+            first_length = min(length, self.size - offset)
+            segments = [self.__map[offset:offset + first_length]]
+            if first_length < length:
+                segments.append(self.__map[:length - first_length])
+            return segments
+
+    def close(self):
+        with self.lock:
+            if not self.__map.closed:
+                self.__map.close()
+                self.__file.close()
+
+    def __copy_in(self, data, position):
+        """
+        Copies the data into the ring at the absolute position, wrapping
+        around the end of the file.
+        """
+        offset = position % self.size
+        first_length = min(len(data), self.size - offset)
+        self.__map[offset:offset + first_length] = data[:first_length]
+        if first_length < len(data):
+            self.__map[:len(data) - first_length] = data[first_length:]
+
+    def __index_frame(self):
+        """
+        Adds the encoder's current frame to the index if this write completed
+        it. SPS/PPS headers are also cached.
+
+        :return: The number of frames added.
+        """
+        try:
+            frame = self.camera._encoders[self.splitter_port].frame
+        except (AttributeError, KeyError):
+            return 0
+        if frame is None or not frame.complete or frame.index <= self.frame_index.last_index:
+            return 0
+        frame_type = getattr(frame, 'frame_type', None)
+        position = self.__bytes_written - frame.frame_size
+        self.frame_index.append(index=frame.index,
+                                timestamp=frame.timestamp,
+                                position=position,
+                                frame_type=frame_type)
+        if frame_type == SPS_HEADER:
+            self.__headers = b''.join(self.segments(position - self.start_offset, frame.frame_size))
+        return 1
+
+    def __release_pages(self):
+        """
+        Drops the pages written since the last release from this process's
+        resident memory. Their data stays in the file.
+        """
+        if not hasattr(self.__map, 'madvise'):
+            return  # Requires Python 3.8
+        if self.__bytes_written - self.__released_position < RELEASE_BYTES:
+            return
+        start = self.__released_position % self.size
+        start -= start % mmap.PAGESIZE
+        end = self.__bytes_written % self.size
+        end -= end % mmap.PAGESIZE
+        if end > start:
+            self.__map.madvise(mmap.MADV_DONTNEED, start, end - start)
+        elif end < start:  # Wrapped around the end of the file
+            self.__map.madvise(mmap.MADV_DONTNEED, start, self.size - start)
+            if end > 0:
+                self.__map.madvise(mmap.MADV_DONTNEED, 0, end)
+        self.__released_position = self.__bytes_written
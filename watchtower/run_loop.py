@@ -8,15 +8,21 @@ import os
 import picamera
 import time
 from .camera import SafeCamera
-from .recorder import Recorder, Destination
+from .recorder import Recorder, Destination, VIDEO_BITRATE
 from .recorder.mjpeg import MJPEGRecorder
 from .remote import micro
 from .remote.servo import Servo
+from .streamer.mjpeg_broadcaster import MJPEGHub, DEFAULT_CLIENT_BUFFER_FRAMES, DEFAULT_IDLE_RATE
+from .streamer.writer.upload_monitor import UploadMonitor
+from .streamer.writer.upload_service import UploadService
+from .streamer.writer.upload_spool import UploadSpool, DEFAULT_MAX_BYTES
+from .util.recording_index import RecordingIndex
 from .util.shutdown import TerminableThread
 
 WAIT_TIME = 0.1
 INITIALIZATION_TIME = 10  # In Seconds
 MOTION_INTERVAL_WHILE_SAVING = 1.0  # In Seconds
+TRIGGER_FRAME_TIMEOUT = 1.0  # In Seconds
 
 
 class RunLoop(TerminableThread):
@@ -39,7 +45,19 @@ class RunLoop(TerminableThread):
         self.__padding = app.config['RECORDING_PADDING']
         self.__max_event_time = app.config['MAX_EVENT_TIME']
         self.__instance_path = app.instance_path
+        self.__recording_index = RecordingIndex(
+            db_path=os.path.join(app.instance_path, 'recording_index.sqlite3'),
+            recordings_path=os.path.join(app.instance_path, 'recordings'),
+            day_format=app.config['DIR_DAY_FORMAT'],
+            time_format=app.config['DIR_TIME_FORMAT']
+        )
         self.__recorders, self.camera = self.setup_destinations(app)
+        mjpeg_recorder = next(r for r in self.__recorders if isinstance(r, MJPEGRecorder))
+        self.__mjpeg_hub = MJPEGHub(self.camera,
+                                    servo=self.servo,
+                                    client_buffer_frames=app.config.get('MJPEG_CLIENT_BUFFER_FRAMES', DEFAULT_CLIENT_BUFFER_FRAMES),
+                                    frame_source=mjpeg_recorder,
+                                    idle_rate=app.config.get('MJPEG_IDLE_FRAMERATE', DEFAULT_IDLE_RATE))
         self.__start_time = None
         self.__day_format = app.config['DIR_DAY_FORMAT']
         self.__time_format = app.config['DIR_TIME_FORMAT']
@@ -53,6 +71,33 @@ class RunLoop(TerminableThread):
     def servo(self, value):
         self.__servo = value
 
+    @property
+    def mjpeg_hub(self) -> MJPEGHub:
+        return self.__mjpeg_hub
+
+    @property
+    def recording_index(self) -> RecordingIndex:
+        return self.__recording_index
+
+    def upload_metrics(self):
+        """
+        :return: A dict of the Dropbox upload rate, the upload queue and the
+        spool, or an empty dict if Dropbox isn't used.
+        """
+        dropbox_dest = Destination.dropbox
+        if dropbox_dest.upload_monitor is None:
+            return {}
+        return dict(dropbox=dropbox_dest.upload_monitor.metrics(),
+                    queued_uploads=UploadService.shared().pending_count,
+                    spool=dropbox_dest.spool.metrics())
+
+    def writer_metrics(self):
+        """
+        :return: A list of the metrics of the recording files still being
+        written. See ``Recorder.writer_metrics()``.
+        """
+        return [metrics for recorder in self.__recorders for metrics in recorder.writer_metrics()]
+
     def setup_microcontroller_comm(self, app):
         controller_config = app.config.get_namespace('SERVO_')
         angle_on = controller_config['angle_on']
@@ -77,6 +122,14 @@ class RunLoop(TerminableThread):
                 sizes[size_tuple] = []
             sizes[size_tuple].append(destination)
 
+        def set_queue_options(options, destination):
+            """
+            Applies the optional settings of the destination's write queue.
+            """
+            destination.overflow_policy = options.get('overflow', destination.overflow_policy)
+            if 'queue_kb' in options:
+                destination.max_queue_bytes = options['queue_kb']*1024
+
         destinations = app.config.get('DESTINATIONS')
         if destinations is None:
             logging.getLogger(__name__).error('DESTINATIONS key does not exist in config file.')
@@ -86,6 +139,11 @@ class RunLoop(TerminableThread):
             options = destinations['disk']
             disk_dest = Destination.disk
             disk_dest.instance_path = self.__instance_path
+            disk_dest.async_writes = options.get('async_writes', False)
+            disk_dest.fsync_policy = options.get('fsync', disk_dest.fsync_policy)
+            # Enough for the longest event, including the padding on both ends.
+            disk_dest.expected_size = VIDEO_BITRATE // 8 * (self.__max_event_time + 2 * self.__padding)
+            set_queue_options(options, disk_dest)
             add_destination(options, disk_dest)
         if 'dropbox' in destinations:
             options = destinations['dropbox']
@@ -94,7 +152,20 @@ class RunLoop(TerminableThread):
             if 'public_key_path' in options:
                 dropbox_dest.pem_path = options['public_key_path']
             dropbox_dest.file_chunk_size = options['file_chunk_kb']*1024
+            dropbox_dest.upload_session = options.get('upload_session', False)
+            set_queue_options(options, dropbox_dest)
             add_destination(options, dropbox_dest)
+            dropbox_dest.upload_monitor = UploadMonitor(
+                rate_limit=options.get('rate_limit_kb', 0)*1024,
+                adaptive=options.get('adaptive_chunks', True)
+            )
+            # Connect now so the first event doesn't wait for the handshake.
+            UploadService.shared().warm_up(dropbox_dest.token)
+            dropbox_dest.spool = UploadSpool(
+                os.path.join(self.__instance_path, 'upload_spool'),
+                dropbox_dest.upload_monitor.client(UploadService.shared().client(dropbox_dest.token)),
+                max_bytes=options['spool_mb']*1024*1024 if 'spool_mb' in options else DEFAULT_MAX_BYTES
+            )
         # Future destinations can be set up here.
         
         # Sort with the biggest resolution first.
@@ -119,12 +190,16 @@ class RunLoop(TerminableThread):
                     padding_sec=self.__padding,
                     destinations=sizes[size],
                     splitter_port=splitter_port,
-                    resize_resolution=resize_resolution
+                    resize_resolution=resize_resolution,
+                    buffer_dir=app.config.get('RECORDING_BUFFER_DIR'),
+                    intra_period=app.config.get('VIDEO_INTRA_PERIOD', app.config['VIDEO_FRAMERATE']),
+                    recording_index=self.__recording_index
                 )
             )
             splitter_port += 1
 
-        # Always create an MJPEG recorder, regardless of user settings.
+        # Always create an MJPEG recorder, regardless of user settings. It
+        # starts at the idle rate and the MJPEGHub raises it for live viewers.
         mjpeg_port = 0
         mjpeg_size = tuple(app.config['MJPEG_SIZE'])
         logging.getLogger(__name__).info('Creating mjpeg recorder at %s with splitter port %d.' % (mjpeg_size, mjpeg_port))
@@ -132,7 +207,8 @@ class RunLoop(TerminableThread):
             MJPEGRecorder(
                 camera=camera,
                 splitter_port=mjpeg_port,
-                resize_resolution=mjpeg_size
+                resize_resolution=mjpeg_size,
+                frame_rate=app.config.get('MJPEG_IDLE_FRAMERATE', DEFAULT_IDLE_RATE)
             )
         )
         return recorders, camera
@@ -206,11 +282,14 @@ class RunLoop(TerminableThread):
                     camera.motion_detected = False
 
                     start_frame_time = max(0, int(time.time() - self.__start_time - self.__padding))
+                    # Only blocks if the MJPEG recorder hasn't published yet.
+                    trigger_frame = camera.wait_for_frame(timeout=TRIGGER_FRAME_TIMEOUT)
+                    trigger_data = trigger_frame.data if trigger_frame is not None else b''
                     for recorder in self.__recorders:
                         recorder.persist(
                             directory=full_dir,
                             start_time=start_frame_time,
-                            frame=io.BytesIO(camera.jpeg_data)
+                            frame=io.BytesIO(trigger_data)
                         )
                     self.wait() # Update the annotation area after the heavy persist() call.
 
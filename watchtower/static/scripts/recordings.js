@@ -1,14 +1,24 @@
 $(document).ready(function(){
 
-    // Iterate over every button, adding listeners to download and delete.
-    var buttons = $('button')
-    for (i = 0; i < buttons.length; i++) { 
-        button = buttons[i];
-        if (button.id.startsWith('recording-download-button-')) {
-            button.addEventListener("click", downloadRecording)
-        } else if (button.id.startsWith('recording-delete-button-')) {
-            button.addEventListener("click", deleteRecording)
-        }
+    // Listen to the buttons of every recording, including those of the pages
+    // loaded later, for downloads and deletes.
+    var accordion = $('#recording-accordion')
+    accordion.on('click', 'button[id^="recording-download-button-"]', downloadRecording)
+    accordion.on('click', 'button[id^="recording-delete-button-"]', deleteRecording)
+
+    // Only the newest days are part of the page. The next page is loaded when
+    // the loader at the end of the list is scrolled into view.
+    var loader = $('#recording-page-loader')
+    var loading = false
+    if ('IntersectionObserver' in window) {
+        var observer = new IntersectionObserver(function(entries) {
+            if (entries[0].isIntersecting) {
+                loadNextPage()
+            }
+        })
+        observer.observe(loader[0])
+    } else {
+        loader.text('Load more').addClass('btn btn-link btn-block').on('click', loadNextPage)
     }
 
     /**
@@ -19,14 +29,14 @@ $(document).ready(function(){
         var button = this
         var datetime = button.id.substring('recording-download-button-'.length)
         var elements = datetime.split(" ")
-        var downloadLink = document.createElement('a'); 
-        downloadLink.setAttribute('href', encodeURIComponent('api/recordings/'+elements[0]+'/'+elements[1]+'/video')); 
-        downloadLink.setAttribute('download', elements[0]+';'+elements[1]); 
-        document.body.appendChild(downloadLink);  
-        downloadLink.click(); 
-        document.body.removeChild(downloadLink); 
+        var downloadLink = document.createElement('a');
+        downloadLink.setAttribute('href', encodeURIComponent('api/recordings/'+elements[0]+'/'+elements[1]+'/video'));
+        downloadLink.setAttribute('download', elements[0]+';'+elements[1]);
+        document.body.appendChild(downloadLink);
+        downloadLink.click();
+        document.body.removeChild(downloadLink);
     }
-    
+
     /**
      * Deletes the selected recording using an ajax call. If the call was
      * successful, the row for the day & time will be removed.
@@ -47,4 +57,70 @@ $(document).ready(function(){
             }
         });
     }
-  })
\ No newline at end of file
+
+    /**
+     * Fetches the days after the last one in the list and appends them. The
+     * loader is hidden once the oldest day is in the list.
+     */
+    function loadNextPage() {
+        var cursor = accordion.attr('data-next-cursor')
+        if (loading || !cursor) {
+            return
+        }
+        loading = true
+        $.ajax({
+            type: 'GET',
+            url: 'api/recordings',
+            data: {limit: accordion.attr('data-page-days'), cursor: cursor},
+            dataType: 'json',
+            success: function (result, status, xhr) {
+                for (i = 0; i < result.recordings.length; i++) {
+                    accordion.append(dayCard(result.recordings[i].day, result.recordings[i].times))
+                }
+                accordion.attr('data-next-cursor', result.next_cursor || '')
+                loader.prop('hidden', !result.next_cursor)
+            },
+            error: function (xhr, status, error) {
+                console.log(status + ' ' + error + ' ' + xhr.status + ' ' + xhr.statusText)
+            },
+            complete: function () {
+                loading = false
+                // A short page can leave the loader in view, which doesn't
+                // trigger the observer again.
+                if (!loader.prop('hidden') && loader[0].getBoundingClientRect().top < window.innerHeight) {
+                    loadNextPage()
+                }
+            }
+        });
+    }
+
+    /**
+     * Creates the card of a day in the same way as recordings.html.
+     */
+    function dayCard(day, times) {
+        var list = $('<ul class="list-group list-group-flush"></ul>')
+        for (j = 0; j < times.length; j++) {
+            var buttons = $('<div class="row row-eq-height"></div>').append(
+                $('<button type="button" class="btn btn-secondary btn-sm">Download</button>')
+                    .attr('id', 'recording-download-button-'+day+' '+times[j]),
+                $('<button type="button" class="btn btn-danger btn-sm ml-1">Delete</button>')
+                    .attr('id', 'recording-delete-button-'+day+' '+times[j]))
+            list.append($('<li class="list-group-item"></li>')
+                .attr('id', 'list-group-'+day+' '+times[j])
+                .append($('<div class="d-flex w-100 justify-content-between align-items-center"></div>').append(
+                    $('<h6 class="mb-1"></h6>').text(times[j]),
+                    buttons)))
+        }
+        var header = $('<div class="card-header"></div>').attr('id', 'day-heading-'+day).append(
+            $('<h2 class="mb-0"></h2>').append(
+                $('<button class="btn btn-link btn-block text-left" type="button" data-toggle="collapse" aria-expanded="false"></button>')
+                    .attr('data-target', '#'+$.escapeSelector('day-'+day))
+                    .attr('aria-controls', 'day-'+day)
+                    .text(day)))
+        var body = $('<div class="collapse" data-parent="#recording-accordion"></div>')
+            .attr('id', 'day-'+day)
+            .attr('aria-labelledby', 'day-heading-'+day)
+            .append($('<div class="card-body"></div>').append(list))
+        return $('<div class="card"></div>').append(header, body)
+    }
+  })
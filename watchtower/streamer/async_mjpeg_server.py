@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from .mjpeg_broadcaster import stream_options
+from .writer import http_writer
+from ..util.shutdown import TerminableThread
+
+WEB_MJPEG_PATH = '/mjpeg'  # Part of the web app
+INTERNAL_MJPEG_PATH = '/api/internal_mjpeg'  # Used by the motion container
+MJPEG_PATHS = (WEB_MJPEG_PATH, INTERNAL_MJPEG_PATH)
+SHUTDOWN_CHECK_INTERVAL = 1.0  # In Seconds
+REQUEST_TIMEOUT = 10  # In Seconds
+
+
+class AsyncMJPEGClient:
+    """
+    An MJPEGHub client that hands frames to a coroutine running on an asyncio
+    event loop. ``append_frame()`` is called from a broadcaster thread and
+    schedules the frame onto the loop. Like ``HTTPMultipartWriter``, at most
+    ``max_frames`` frames are held and the oldest pending frame is dropped.
+    """
+
+    def __init__(self, loop, max_frames=None):
+        self.__loop = loop
+        self.__frames = deque(maxlen=max_frames)
+        self.__frame_event = asyncio.Event()
+        self.dropped_frames = 0
+
+    def append_frame(self, payload):
+        self.__loop.call_soon_threadsafe(self.__append_frame, payload)
+
+    def __append_frame(self, payload):
+        if len(self.__frames) == self.__frames.maxlen:
+            self.dropped_frames += 1
+        self.__frames.append(payload)
+        self.__frame_event.set()
+
+    async def read(self):
+        """
+        Waits for at least one frame and returns every pending frame.
+        """
+        await self.__frame_event.wait()
+        payload = b''.join(self.__frames)
+        self.__frames.clear()
+        self.__frame_event.clear()
+        return payload
+
+
+class AsyncMJPEGServer(TerminableThread):
+    """
+    A threaded class that runs an asyncio event loop serving the MJPEG
+    endpoints on a unix socket. Every connection is a coroutine on the same
+    loop, so any number of viewers can stream without holding a uWSGI worker.
+    Frames come from the MJPEGHub and are sent with the same multipart
+    boundary as the Flask endpoints.
+    """
+
+    def __init__(self, hub, socket_path, paths=MJPEG_PATHS):
+        """
+        :param hub: The MJPEGHub that supplies frames.
+        :param socket_path: The path of the unix socket to listen on. Any
+        existing file at this path is replaced.
+        :param paths: The paths that are streamed. Other paths get a 404.
+        """
+        super(AsyncMJPEGServer, self).__init__()
+        self.name = 'AsyncMJPEGServer'
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.__hub = hub
+        self.__socket_path = socket_path
+        self.__paths = paths
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.__serve())
+        except Exception as e:
+            self.logger.exception('An exception occurred: %s' % e)
+        finally:
+            loop.close()
+        self.logger.debug('Thread stopped.')
+
+    async def __serve(self):
+        if os.path.exists(self.__socket_path):
+            os.remove(self.__socket_path)
+        server = await asyncio.start_unix_server(self.__handle, path=self.__socket_path)
+        os.chmod(self.__socket_path, 0o660)
+        self.logger.info('Serving MJPEG on %s.' % self.__socket_path)
+        try:
+            while self.should_run:
+                await asyncio.sleep(SHUTDOWN_CHECK_INTERVAL)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def __handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # Discard the headers. Nothing in them changes the response.
+            while True:
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            elements = request_line.decode('latin-1').split()
+            if len(elements) != 3 or elements[0] != 'GET':
+                await self.__respond(writer, '405 Method Not Allowed')
+                return
+            url = urlsplit(elements[1])
+            if url.path not in self.__paths:
+                await self.__respond(writer, '404 Not Found')
+                return
+            args = {key: values[0] for key, values in parse_qs(url.query).items()}
+            await self.__stream(reader, writer, stream_options(args))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.exception('An exception occurred: %s' % e)
+        finally:
+            writer.close()
+
+    async def __respond(self, writer, status):
+        writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status).encode())
+        await writer.drain()
+
+    async def __stream(self, reader, writer, options):
+        writer.write(('HTTP/1.1 200 OK\r\n' + \
+            'Content-Type: multipart/x-mixed-replace; boundary=' + http_writer.MULTIPART_BOUNDARY + '\r\n' + \
+            'Cache-Control: no-cache\r\n' + \
+            'Connection: close\r\n\r\n').encode())
+        await writer.drain()
+
+        client = AsyncMJPEGClient(asyncio.get_event_loop(),
+                                  max_frames=self.__hub.client_buffer_frames)
+        self.__hub.attach(client, **options)
+        # The client never sends anything else, so reaching EOF means it left.
+        # Watching for it detaches the client even if no frames are arriving.
+        disconnected = asyncio.ensure_future(reader.read())
+        try:
+            while self.should_run:
+                frame_read = asyncio.ensure_future(client.read())
+                done, _ = await asyncio.wait({frame_read, disconnected},
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    frame_read.cancel()
+                    break
+                writer.write(frame_read.result())
+                await writer.drain()
+        finally:
+            disconnected.cancel()
+            self.__hub.detach(client)
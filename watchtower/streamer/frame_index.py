@@ -0,0 +1,133 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+IndexedFrame = namedtuple('IndexedFrame', 'index timestamp position frame_type')
+COMPACT_THRESHOLD = 1024  # Discarded entries kept before the lists are trimmed
+KEY_FRAME = 1  # picamera.PiVideoFrameType.key_frame
+SPS_HEADER = 2  # picamera.PiVideoFrameType.sps_header
+TRACKED_TYPES = (KEY_FRAME, SPS_HEADER)  # Frame types that can be looked up
+
+
+class FrameIndex:
+    """
+    An ordered index of the frames in a camera stream, used to find frames by
+    frame index or timestamp with binary searches instead of walking the
+    stream's ``frames``.
+
+    Positions are absolute: they count every byte ever written to the stream,
+    so they stay valid while a circular stream discards its oldest data.
+    Timestamps are in microseconds, like ``PiVideoFrame.timestamp``, and may be
+    ``None``. The positions of key frames and SPS headers are also kept so the
+    newest one before a frame can be found with ``last_of_type()``.
+    """
+
+    def __init__(self):
+        self.__indices = []
+        self.__positions = []
+        self.__timestamps = []  # Real timestamps, which may be None
+        self.__search_timestamps = []  # Timestamps with None filled forward
+        self.__frame_types = []
+        self.__type_positions = {frame_type: [] for frame_type in TRACKED_TYPES}
+        self.__head = 0  # The first entry that hasn't been discarded
+
+    def __len__(self):
+        return len(self.__indices) - self.__head
+
+    def __entry(self, i):
+        return IndexedFrame(index=self.__indices[i],
+                            timestamp=self.__timestamps[i],
+                            position=self.__positions[i],
+                            frame_type=self.__frame_types[i])
+
+    @property
+    def last_index(self):
+        """
+        :return: The index of the newest frame, or -1 if the index is empty.
+        """
+        return self.__indices[-1] if len(self) > 0 else -1
+
+    def append(self, index, timestamp, position, frame_type=None):
+        """
+        Adds a frame newer than every frame already in the index.
+
+        :param index: The frame's index.
+        :param timestamp: The frame's timestamp in microseconds, or ``None``.
+        :param position: The absolute position of the frame's first byte.
+        :param frame_type: The frame's ``PiVideoFrameType``, or ``None``.
+        """
+        search_timestamp = timestamp
+        if search_timestamp is None:
+            search_timestamp = self.__search_timestamps[-1] if len(self) > 0 else -1
+        self.__indices.append(index)
+        self.__positions.append(position)
+        self.__timestamps.append(timestamp)
+        self.__search_timestamps.append(search_timestamp)
+        self.__frame_types.append(frame_type)
+        if frame_type in self.__type_positions:
+            self.__type_positions[frame_type].append(position)
+
+    def discard_before(self, position):
+        """
+        Discards frames that start before the absolute position. Used when the
+        stream no longer holds their data.
+        """
+        self.__head = max(self.__head, bisect_left(self.__positions, position, lo=self.__head))
+        if self.__head >= COMPACT_THRESHOLD and self.__head * 2 >= len(self.__indices):
+            for entries in (self.__indices, self.__positions, self.__timestamps, self.__search_timestamps, self.__frame_types):
+                del entries[:self.__head]
+            self.__head = 0
+            first_position = self.__positions[0] if len(self) > 0 else position
+            for positions in self.__type_positions.values():
+                del positions[:bisect_left(positions, first_position)]
+
+    def first(self):
+        return self.__entry(self.__head) if len(self) > 0 else None
+
+    def last(self):
+        return self.__entry(len(self.__indices) - 1) if len(self) > 0 else None
+
+    def find(self, index):
+        """
+        :return: The frame with the index, or ``None`` if it isn't indexed.
+        """
+        i = bisect_left(self.__indices, index, lo=self.__head)
+        if i < len(self.__indices) and self.__indices[i] == index:
+            return self.__entry(i)
+        return None
+
+    def before_time(self, seconds):
+        """
+        :param seconds: A stream time in seconds.
+        :return: The newest frame with a timestamp at or before the time. If no
+        frame is that old, the oldest frame is returned. ``None`` if the index
+        is empty.
+        """
+        if len(self) == 0:
+            return None
+        i = bisect_right(self.__search_timestamps, seconds * 1000000, lo=self.__head) - 1
+        # Skip back over frames without a timestamp of their own.
+        while i >= self.__head and self.__timestamps[i] is None:
+            i -= 1
+        return self.__entry(max(i, self.__head))
+
+    def last_of_type(self, frame_type, position):
+        """
+        :param frame_type: One of ``TRACKED_TYPES``.
+        :param position: An absolute position.
+        :return: The newest frame of the type that starts at or before the
+        position, or ``None`` if there isn't one in the index.
+        """
+        if len(self) == 0:
+            return None
+        positions = self.__type_positions[frame_type]
+        i = bisect_right(positions, position) - 1
+        if i < 0 or positions[i] < self.__positions[self.__head]:
+            return None
+        return self.__entry(bisect_left(self.__positions, positions[i], lo=self.__head))
+
+    def previous(self, frame):
+        """
+        :return: The frame indexed immediately before the frame, or ``None``.
+        """
+        i = bisect_left(self.__positions, frame.position, lo=self.__head) - 1
+        return self.__entry(i) if i >= self.__head else None
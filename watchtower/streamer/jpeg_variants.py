@@ -0,0 +1,91 @@
+import io
+import logging
+from threading import RLock
+from .writer import http_writer
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_QUALITY = 85  # JPEG quality used when only a width is requested
+
+
+class JPEGVariantCache:
+    """
+    Produces downscaled or re-quantized copies of the camera's JPEG frames and
+    the multipart payloads sent to MJPEG clients. Each variant, and each
+    payload including its base64 encoding and multipart header, is produced at
+    most once per frame and shared by every caller asking for it. Everything
+    cached for older frames is discarded as soon as a newer frame is
+    requested, and nothing is produced unless a caller asks for it.
+
+    Pillow is required for variants. Without it, the original frame is always
+    returned.
+    """
+
+    def __init__(self):
+        self.__lock = RLock()
+        self.__sequence = 0
+        self.__variants = {}
+        if Image is None:
+            logging.getLogger(__name__).warning('Pillow is not installed. MJPEG width and quality options are ignored.')
+
+    def jpeg(self, frame, width=None, quality=None):
+        """
+        :param frame: A Frame published by the camera.
+        :param width: The maximum width of the JPEG. The aspect ratio is kept.
+        ``None`` keeps the original size.
+        :param quality: The JPEG quality from 1 to 95. ``None`` keeps the
+        original quality unless the frame is resized.
+        :return: The JPEG bytes for the requested variant.
+        """
+        if Image is None or (width is None and quality is None):
+            return frame.data
+
+        return self.__cached(frame, (width, quality),
+                             lambda: self.__encode(frame.data, width, quality))
+
+    def payload(self, frame, width=None, quality=None, use_base64=False):
+        """
+        :param frame: A Frame published by the camera.
+        :param width: See ``jpeg()``.
+        :param quality: See ``jpeg()``.
+        :param use_base64: If True, the JPEG is base64 encoded.
+        :return: The multipart part for the requested variant, ready to be sent
+        to every client.
+        """
+        return self.__cached(frame, (width, quality, use_base64),
+                             lambda: http_writer.multipart_frame(self.jpeg(frame, width, quality), use_base64))
+
+    def __cached(self, frame, key, produce):
+        """
+        Returns the value cached for the key and frame, calling ``produce()``
+        to create it if needed.
+        """
+        with self.__lock:
+            if frame.sequence < self.__sequence:
+                # A newer frame was already requested, don't cache this one.
+                return produce()
+            if frame.sequence > self.__sequence:
+                self.__sequence = frame.sequence
+                self.__variants = {}
+            value = self.__variants.get(key)
+            if value is None:
+                value = produce()
+                self.__variants[key] = value
+            return value
+
+    def __encode(self, data, width, quality):
+        image = Image.open(io.BytesIO(data))
+        if width is not None and width < image.width:
+            size = (width, max(1, round(image.height * width / image.width)))
+            # Lets the JPEG decoder skip detail that the resize discards.
+            image.draft('RGB', size)
+            image = image.resize(size, Image.BILINEAR)
+        elif quality is None:
+            return data  # Already small enough.
+
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=(quality if quality is not None else DEFAULT_QUALITY))
+        return output.getvalue()
@@ -0,0 +1,254 @@
+import logging
+import time
+from threading import Lock
+from .jpeg_variants import JPEGVariantCache
+from ..util.shutdown import TerminableThread
+
+FRAME_WAIT_TIMEOUT = 0.5  # Max time to block waiting for a new frame
+DEFAULT_CLIENT_BUFFER_FRAMES = 1  # Frames a client may have waiting
+DEFAULT_STREAM_RATE = 4  # Frames per second
+DEFAULT_IDLE_RATE = 4  # Frames per second published with no extra viewers
+MAX_STREAM_RATE = 30  # Frames per second
+
+
+def stream_options(args):
+    """
+    Converts the query string arguments of an MJPEG request into keyword
+    arguments for ``MJPEGHub.attach()``. Supported arguments are
+    ``encoding=base64``, ``fps``, ``width`` and ``quality``. Missing or invalid
+    values fall back to the defaults.
+
+    :param args: A mapping of query string names to string values.
+    """
+    def int_arg(name, minimum, maximum, default=None):
+        try:
+            value = int(args.get(name))
+        except (TypeError, ValueError):
+            return default
+        return max(minimum, min(value, maximum))
+
+    return dict(use_base64=(args.get('encoding') == 'base64'),
+                rate=int_arg('fps', 1, MAX_STREAM_RATE, DEFAULT_STREAM_RATE),
+                width=int_arg('width', 16, 4096),
+                quality=int_arg('quality', 1, 95))
+
+
+class MJPEGBroadcaster(TerminableThread):
+    """
+    A threaded class that pulls JPEG frames from the camera at up to ``rate``
+    frames per second and fans them out to every attached client. Each frame
+    is formatted as a multipart part exactly once and the same immutable bytes
+    are handed to every client's ``append_frame()``.
+    """
+
+    def __init__(self, camera, name, use_base64=False, rate=1, width=None, quality=None, variants=None):
+        """
+        :param camera: The SafeCamera publishing JPEG frames.
+        :param name: Used for log statements.
+        :param use_base64: If True, each JPEG is base64 encoded.
+        :param rate: The maximum frames per second sent to clients.
+        :param width: The maximum JPEG width. ``None`` keeps the camera's size.
+        :param quality: The JPEG quality. ``None`` keeps the camera's quality.
+        :param variants: The JPEGVariantCache used to produce each frame's
+        payload. Sharing one lets broadcasters reuse payloads.
+        """
+        super(MJPEGBroadcaster, self).__init__()
+        self.name = name
+        self.logger = logging.getLogger(__name__ + '.' + self.name)
+        self.__camera = camera
+        self.__use_base64 = use_base64
+        self.__width = width
+        self.__quality = quality
+        self.__variants = variants if variants is not None else JPEGVariantCache()
+        self.__frame_interval = 1/rate
+        self.__clients = ()
+        self.__lock = Lock()
+        self.__stop = False
+
+    @property
+    def client_count(self):
+        with self.__lock:
+            return len(self.__clients)
+
+    @property
+    def dropped_frames(self):
+        """
+        :return: The total frames dropped by the attached clients.
+        """
+        with self.__lock:
+            clients = self.__clients
+        return sum(client.dropped_frames for client in clients)
+
+    def add_client(self, client):
+        """
+        :param client: Must respond to ``append_frame(payload)`` and have a
+        ``dropped_frames`` property.
+        :return: The number of attached clients.
+        """
+        with self.__lock:
+            self.__clients += (client,)
+            return len(self.__clients)
+
+    def remove_client(self, client):
+        """
+        :return: The number of clients still attached.
+        """
+        with self.__lock:
+            self.__clients = tuple(c for c in self.__clients if c is not client)
+            return len(self.__clients)
+
+    def __stop_called(self):
+        with self.__lock:
+            return self.__stop
+
+    def stop(self):
+        with self.__lock:
+            self.__stop = True
+
+    def run(self):
+        last_sequence = 0
+        next_frame_time = 0
+        frame_count = 0
+        self.logger.debug('Broadcaster running.')
+        while not self.__stop_called() and self.should_run:
+            delay = next_frame_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            frame = self.__camera.wait_for_frame(after_seq=last_sequence,
+                                                 timeout=FRAME_WAIT_TIMEOUT)
+            if frame is None:
+                continue
+            last_sequence = frame.sequence
+            next_frame_time = time.time() + self.__frame_interval
+
+            payload = self.__variants.payload(frame,
+                                              width=self.__width,
+                                              quality=self.__quality,
+                                              use_base64=self.__use_base64)
+            with self.__lock:
+                clients = self.__clients
+            for client in clients:
+                client.append_frame(payload)
+            frame_count += 1
+        self.logger.debug('Broadcaster stopped after %d frames.' % frame_count)
+
+
+class MJPEGHub:
+    """
+    Shares one MJPEGBroadcaster between every HTTP client that requests the
+    same encoding, frame rate, width and quality. A broadcaster is started when
+    its first client attaches and stopped when its last client detaches. All
+    broadcasters share one JPEGVariantCache, so a variant and its multipart
+    payload are only encoded once per frame while some client wants them, even
+    across broadcasters with different frame rates.
+
+    If a frame source is supplied, the hub sets its ``frame_rate`` to the
+    highest rate any attached client needs, but never lower than the idle
+    rate. The idle rate covers what always runs, like the motion feed and the
+    trigger frame, and the extra rate is only produced while viewers want it.
+    """
+
+    def __init__(self, camera, servo=None, client_buffer_frames=DEFAULT_CLIENT_BUFFER_FRAMES, frame_source=None, idle_rate=DEFAULT_IDLE_RATE):
+        """
+        :param camera: The SafeCamera publishing JPEG frames.
+        :param servo: If supplied, the servo is disabled when the last client
+        detaches while the camera is not monitoring.
+        :param client_buffer_frames: The maximum number of frames each client
+        may have waiting. Older frames are dropped for slow clients.
+        :param frame_source: An object with a ``frame_rate`` property that
+        controls how often frames are published, like the MJPEGRecorder.
+        :param idle_rate: The rate the frame source runs at when no client
+        needs more.
+        """
+        self.__camera = camera
+        self.__servo = servo
+        self.client_buffer_frames = client_buffer_frames
+        self.__frame_source = frame_source
+        self.__idle_rate = idle_rate
+        self.__variants = JPEGVariantCache()
+        self.__broadcasters = {}
+        self.__lock = Lock()
+
+    def attach(self, client, use_base64=False, rate=1, width=None, quality=None):
+        """
+        Starts sending frames to the client, sharing a broadcaster with any
+        other client using the same options.
+
+        :param client: Must respond to ``append_frame(payload)`` and have a
+        ``dropped_frames`` property.
+        :param width: The maximum JPEG width. ``None`` keeps the camera's size.
+        :param quality: The JPEG quality. ``None`` keeps the camera's quality.
+        """
+        key = (use_base64, rate, width, quality)
+        with self.__lock:
+            broadcaster = self.__broadcasters.get(key)
+            if broadcaster is None:
+                name = '%s@%sfps' % ('base64' if use_base64 else 'jpeg', rate)
+                if width is not None:
+                    name += ',w%d' % width
+                if quality is not None:
+                    name += ',q%d' % quality
+                broadcaster = MJPEGBroadcaster(self.__camera,
+                                               name=name,
+                                               use_base64=use_base64,
+                                               rate=rate,
+                                               width=width,
+                                               quality=quality,
+                                               variants=self.__variants)
+                self.__broadcasters[key] = broadcaster
+                self.__update_frame_rate()
+                broadcaster.start()
+            count = broadcaster.add_client(client)
+        logging.getLogger(__name__).info('Client attached to %s. %d client(s).' % (broadcaster.name, count))
+
+    def detach(self, client):
+        """
+        Stops sending frames to the client. The client's broadcaster is stopped
+        if no other clients are using it.
+        """
+        with self.__lock:
+            for key, broadcaster in list(self.__broadcasters.items()):
+                count = broadcaster.remove_client(client)
+                if count == 0:
+                    broadcaster.stop()
+                    del self.__broadcasters[key]
+                    self.__update_frame_rate()
+            remaining = len(self.__broadcasters)
+        logging.getLogger(__name__).info('Client detached after dropping %d frame(s). %d client(s) remaining.' % \
+            (client.dropped_frames, self.client_count))
+
+        if remaining == 0 and \
+                not self.__camera.should_monitor and \
+                self.__servo is not None:
+            self.__servo.disable()
+
+    def __update_frame_rate(self):
+        """
+        Sets the frame source's rate to what the broadcasters need. Must be
+        called while holding the lock.
+        """
+        if self.__frame_source is None:
+            return
+        rate = max([self.__idle_rate] + [rate for (_, rate, _, _) in self.__broadcasters])
+        if rate != self.__frame_source.frame_rate:
+            logging.getLogger(__name__).info('Publishing frames at %d fps.' % rate)
+            self.__frame_source.frame_rate = rate
+
+    @property
+    def client_count(self):
+        with self.__lock:
+            return sum(b.client_count for b in self.__broadcasters.values())
+
+    def client_counts(self):
+        """
+        :return: A list of dictionaries describing each active broadcaster, the
+        number of clients attached to it, and the frames those clients dropped.
+        """
+        with self.__lock:
+            return [dict(encoding=('base64' if use_base64 else 'jpeg'),
+                         fps=rate,
+                         width=width,
+                         quality=quality,
+                         clients=broadcaster.client_count,
+                         dropped_frames=broadcaster.dropped_frames)
+                    for (use_base64, rate, width, quality), broadcaster in self.__broadcasters.items()]
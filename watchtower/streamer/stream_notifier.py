@@ -0,0 +1,97 @@
+import time
+from threading import Condition, Lock
+
+
+class StreamNotifier:
+    """
+    Signals readers of a stream that new data has been written to it. The
+    writer of the stream calls ``notify()`` with the number of bytes and
+    frames it added, and readers block in ``wait()`` instead of polling the
+    stream on a fixed interval.
+
+    Calling ``close()`` marks the end of the stream: no more data will be
+    written, so ``wait()`` returns immediately.
+    """
+
+    def __init__(self):
+        self.__condition = Condition(Lock())
+        self.__bytes = 0
+        self.__frames = 0
+        self.__closed = False
+
+    @property
+    def position(self):
+        """
+        :return: A tuple of the total bytes and frames notified so far. Hand it
+        to ``wait()`` to wait for data written after this point.
+        """
+        with self.__condition:
+            return self.__bytes, self.__frames
+
+    @property
+    def closed(self):
+        with self.__condition:
+            return self.__closed
+
+    def notify(self, byte_count, frame_count=0):
+        """
+        Called by the writer of the stream after it appends data.
+
+        :param byte_count: The number of bytes written.
+        :param frame_count: The number of frames completed by the write.
+        """
+        with self.__condition:
+            self.__bytes += byte_count
+            self.__frames += frame_count
+            self.__condition.notify_all()
+
+    def close(self):
+        """
+        Marks the end of the stream and wakes every waiting reader.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def interrupt(self):
+        """
+        Wakes every waiting reader so it can check its ``interrupted``
+        callable.
+        """
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def wait(self, since, min_bytes, min_frames, max_latency, idle_timeout, interrupted=None):
+        """
+        Blocks until data written after ``since`` should be read. This is
+        whichever of these comes first:
+        1) ``min_bytes`` bytes or ``min_frames`` frames were written.
+        2) Some data was written and ``max_latency`` seconds have passed.
+        3) Nothing was written and ``idle_timeout`` seconds have passed.
+        4) The stream was closed or ``interrupted()`` returns True.
+
+        :param since: A ``position`` from an earlier call.
+        :param min_bytes: The number of new bytes that wakes the reader.
+        :param min_frames: The number of new frames that wakes the reader.
+        :param max_latency: The longest time in seconds that new data waits
+        before the reader is woken.
+        :param idle_timeout: The longest time in seconds to wait while nothing
+        is written. This lets the reader check whether it should stop.
+        :param interrupted: An optional callable checked on every wake up. If
+        it returns True, the wait ends. See ``interrupt()``.
+        :return: The current ``position``.
+        """
+        start_time = time.time()
+        since_bytes, since_frames = since
+        with self.__condition:
+            while not self.__closed and not (interrupted is not None and interrupted()):
+                new_bytes = self.__bytes - since_bytes
+                new_frames = self.__frames - since_frames
+                if new_bytes >= min_bytes or new_frames >= min_frames:
+                    break
+                timeout = max_latency if new_bytes > 0 or new_frames > 0 else idle_timeout
+                remaining = start_time + timeout - time.time()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+            return self.__bytes, self.__frames
@@ -7,15 +7,24 @@ import logging
 MAX_READ_BYTES = int(1024*1024*2.5)  # 2.5 MB
 READ_DATA_WAIT_TIME = 0.3  # Wait time for the next upload if data was read
 EMPTY_WAIT_TIME = 0.5  # Wait time for next read if no data found
+WAKE_BYTES = 256*1024  # With a notifier, wake once this much data is written
+WAKE_FRAMES = 10  # With a notifier, wake once this many frames are written
+MAX_LATENCY = 0.1  # With a notifier, the longest time new data waits
+IDLE_CHECK_TIME = 1.0  # With a notifier, how often to check for shutdown
 
 
 class StreamSaver(TerminableThread):
     """
     A threaded class that loops over its stream in chunks and uploads read
     bytes into its ``byte_writer`` instances.
+
+    Without a notifier, the stream is polled using ``read_wait_time`` and
+    ``empty_wait_time``. With a ``StreamNotifier``, the saver sleeps until the
+    stream signals new data, waking on ``wake_bytes`` or ``wake_frames`` or
+    after ``max_latency``, whichever comes first.
     """
 
-    def __init__(self, stream, byte_writers, name, stop_when_empty=False):
+    def __init__(self, stream, byte_writers, name, stop_when_empty=False, notifier=None):
         """Initializes the streamer.
 
         :param stream: must respond to ``read()`` and ``seek()``. If it is a
@@ -28,6 +37,9 @@ class StreamSaver(TerminableThread):
         :param stop_when_empty: if True, the streamer will stop writing to the
         ByteWriter and will close the ByteWriter when it reaches the end of the
         stream. This is useful for finite streams.
+        :param notifier: an optional ``StreamNotifier`` that the stream's writer
+        notifies after it writes. A closed notifier can be used for a stream
+        that is already complete.
         """
         super(StreamSaver, self).__init__()
         self.stream = stream
@@ -38,6 +50,12 @@ class StreamSaver(TerminableThread):
         self.name = name
         self.logger = logging.getLogger(__name__ + '.' + self.name)
         self.read_wait_time = READ_DATA_WAIT_TIME
+        self.empty_wait_time = EMPTY_WAIT_TIME
+        self.notifier = notifier
+        self.wake_bytes = WAKE_BYTES
+        self.wake_frames = WAKE_FRAMES
+        self.max_latency = MAX_LATENCY
+        self.max_read_bytes = MAX_READ_BYTES
 
     def __stop_called(self):
         self.__lock.acquire()
@@ -54,6 +72,8 @@ class StreamSaver(TerminableThread):
         self.__lock.acquire()
         self.__stop = True
         self.__lock.release()
+        if self.notifier is not None:
+            self.notifier.interrupt()  # Save the final bytes without waiting
 
     def start_pos(self):
         """
@@ -62,25 +82,46 @@ class StreamSaver(TerminableThread):
         """
         return 0
 
-    def read(self, position, length=MAX_READ_BYTES):
+    def read(self, position, length=None):
         """
         :param position: The position to start reading.
-        :param length: The length of bytes to read.
+        :param length: The length of bytes to read. Defaults to
+        ``max_read_bytes``.
         :return: a tuple of the bytes read and the position where reading
         stopped.
         """
+        if length is None:
+            length = self.max_read_bytes
         original_position = self.stream.tell()
         self.stream.seek(position)
         read_bytes = self.stream.read(length)
         self.stream.seek(original_position)  # Restore where the stream was
         if read_bytes is None:
-            read_bytes = ''
+            read_bytes = b''
         return read_bytes, position + len(read_bytes)
 
+    def read_buffers(self, position):
+        """
+        Like ``read()``, but returns the data as a list of bytes-like objects.
+        Subclasses can override this to hand out views of the stream instead
+        of copies. At most ``max_read_bytes`` are read.
+
+        :param position: The position to start reading.
+        :return: a tuple of the list of buffers read and the position where
+        reading stopped.
+        """
+        read_bytes, position = self.read(position)
+        return [read_bytes], position
+
     def run(self):
         """
-        Loops over the stream and calls ``read()`` to read bytes in chunks. All
-        bytes are sent to the ``byte_writer`` instances.
+        Saves the stream in two phases. First, the data already in the stream
+        is handed to the ``byte_writer`` instances in reads of at most
+        ``max_read_bytes``, without waiting between them, and flushed. For a
+        camera stream that's the padding before the recording was triggered,
+        which is never held in memory all at once. Then the stream is tailed,
+        calling ``read_buffers()`` to read the new bytes in small increments as
+        soon as they are written.
 
         Reading stops when one of these conditions is met:
         1) ``stop()`` is called
@@ -90,22 +131,39 @@ class StreamSaver(TerminableThread):
            the TerminableThread superclass.
         """
         try:
+            notified_pos = self.notifier.position if self.notifier is not None else None
+            start_time = time.time()
             stream_pos = self.start_pos()
-            stopped = False
             total_bytes = 0
-            while not stopped:
-                read_bytes, stream_pos = self.read(stream_pos)
-                total_bytes += len(read_bytes)
+            while True:
+                buffers, stream_pos = self.read_buffers(stream_pos)
+                read_length = sum(len(b) for b in buffers)
+                total_bytes += read_length
+                caught_up = read_length < self.max_read_bytes
+                # stop() only takes effect once the whole backlog is written.
+                stopped = self.__write(buffers, read_length, can_stop=caught_up)
+                if stopped or caught_up:
+                    break
+            for writer in self.__byte_writers:
+                writer.flush()
+            self.logger.debug('Persisted %d backlog bytes. Time: %.3f sec' % (total_bytes, time.time() - start_time))
 
-                stopped = self.__stop_called() or \
-                    (self.__stop_when_empty and len(read_bytes) == 0) or \
-                    not self.should_run
-
-                for writer in self.__byte_writers:
-                    writer.append_bytes(read_bytes, stopped)
-                self.logger.debug('Read %d bytes.' % len(read_bytes)) if len(read_bytes) > 0 else None
-                if len(read_bytes) == 0:
-                    time.sleep(EMPTY_WAIT_TIME)  # Wait for more data
+            while not stopped:
+                buffers, stream_pos = self.read_buffers(stream_pos)
+                read_length = sum(len(b) for b in buffers)
+                total_bytes += read_length
+                stopped = self.__write(buffers, read_length)
+                if stopped:
+                    break
+                if self.notifier is not None:
+                    notified_pos = self.notifier.wait(notified_pos,
+                                                      min_bytes=self.wake_bytes,
+                                                      min_frames=self.wake_frames,
+                                                      max_latency=self.max_latency,
+                                                      idle_timeout=IDLE_CHECK_TIME,
+                                                      interrupted=self.__stop_called)
+                elif read_length == 0:
+                    time.sleep(self.empty_wait_time)  # Wait for more data
                 else:
                     time.sleep(self.read_wait_time)  # Avoid consuming the CPU
             self.logger.debug('Processed %d total bytes.' % total_bytes)
@@ -122,6 +180,21 @@ class StreamSaver(TerminableThread):
         finally:
             self.ended()
 
+    def __write(self, buffers, read_length, can_stop=True):
+        """
+        Sends the buffers to every writer, closing them if saving should stop.
+
+        :param can_stop: If False, only the termination of the program stops
+        saving.
+        :return: True if saving stopped.
+        """
+        stopped = (can_stop and (self.__stop_called() or (self.__stop_when_empty and read_length == 0))) or \
+            not self.should_run
+        for writer in self.__byte_writers:
+            writer.append_buffers(buffers, stopped)
+        self.logger.debug('Read %d bytes.' % read_length) if read_length > 0 else None
+        return stopped
+
     def ended(self):
         """
         Useful for subclasses for cleaning up after streaming ends.
@@ -1,5 +1,5 @@
-import io
 import time
+from .frame_index import KEY_FRAME, SPS_HEADER
 from .stream_saver import StreamSaver
 
 
@@ -8,83 +8,120 @@ class VideoStreamSaver(StreamSaver):
     A StreamSaver that uses a camera stream. Safely locks the camera stream
     while accessing it. Also determines the best starting point to read the
     stream based on frame timestamps.
+
+    The stream must provide a ``frame_index`` (a FrameIndex kept up to date by
+    the stream) and a ``start_offset``, like ``IndexedCircularIO``. Frames are
+    located with binary searches, so the time spent holding the stream's lock
+    doesn't grow with the length of the buffer.
+
+    Reading starts on a key frame so the saved video is decodable from its
+    first byte. The stream's ``headers`` are written first if the key frame
+    isn't preceded by an SPS/PPS header in the stream.
     """
 
-    def __init__(self, stream, byte_writers, name, start_time, stop_when_empty=False):
-        super(VideoStreamSaver, self).__init__(stream, byte_writers, name, stop_when_empty)
+    def __init__(self, stream, byte_writers, name, start_time, stop_when_empty=False, notifier=None):
+        super(VideoStreamSaver, self).__init__(stream, byte_writers, name, stop_when_empty, notifier)
         self.__start_time = start_time
-        self.__last_streamed_frame = None
+        self.__last_streamed_position = None  # Absolute position
+        self.__headers = None  # Written before the first read
 
     def start_pos(self):
         """
-        :return: The position of the most recent frame before ``__start_time``.
+        :return: The position of the most recent SPS header or key frame at or
+        before the most recent frame before ``__start_time``.
         """
         self.logger.debug('Using start timestamp %ds.' % self.__start_time)
         with self.stream.lock:
-            start_frame = None
-            for frame in self.stream.frames:
-                is_before_start_time = frame.timestamp is not None and (frame.timestamp / 1000000) <= self.__start_time
-                if start_frame is None or is_before_start_time:
-                    start_frame = frame
+            start_offset = self.stream.start_offset
+            start_frame = self.stream.frame_index.before_time(self.__start_time)
+            if start_frame is None:
+                self.logger.debug('No frames in the stream yet.')
+                self.__last_streamed_position = start_offset
+                return 0
+            start_frame = self.__decodable_frame(start_frame)
             timestamp = (start_frame.timestamp / 1000000) if start_frame.timestamp is not None else 0
             self.logger.debug('Using frame with timestamp: %d' % timestamp)
-            self.__last_streamed_frame = start_frame
-            return start_frame.position
+            self.__last_streamed_position = start_frame.position
+            return start_frame.position - start_offset
+
+    def __decodable_frame(self, frame):
+        """
+        Finds the newest key frame at or before the frame. If the SPS header
+        written with it is in the stream, that header is used instead.
+        Otherwise the stream's cached ``headers`` will be written first.
+
+        :return: The frame to start reading from. The original frame if the
+        stream has no key frame before it.
+        """
+        frame_index = self.stream.frame_index
+        key_frame = frame_index.last_of_type(KEY_FRAME, frame.position)
+        if key_frame is None:
+            header = frame_index.last_of_type(SPS_HEADER, frame.position)
+            if header is None:
+                self.logger.warning('No key frame before the start frame. The video may not be decodable.')
+                return frame
+            return header
+        previous_frame = frame_index.previous(key_frame)
+        if previous_frame is not None and previous_frame.frame_type == SPS_HEADER:
+            return previous_frame
+        self.__headers = self.stream.headers
+        return key_frame
 
     def read(self, position, length=None):
         """
-        Overridden to use the stream's ``frames`` property to locate the read
-        position (useful if the stream is still being appended to) and compute
-        the distance to the last frame in the stream.
+        Overridden to read up to the last frame in the stream, or
+        ``max_read_bytes``. See ``read_buffers()``.
 
         :param position: Not used because it is recalculated using the
-        ``frames`` property of the stream.
+        ``frame_index`` of the stream.
         :param length: Not used because the length is computed using the last
         frame in the stream.
         :return: a tuple of the bytes read and the position where reading
         stopped.
         """
+        buffers, new_position = self.read_buffers(position)
+        return b''.join(buffers), new_position
 
-        bytes_read = None
+    def read_buffers(self, position):
+        """
+        Overridden to use the stream's ``frame_index`` to locate the read
+        position (useful if the stream is still being appended to) and compute
+        the distance to the last frame in the stream. At most
+        ``max_read_bytes`` are read, so the time the stream is locked and the
+        memory used don't depend on the size of the stream.
+
+        The data is returned as the stream's ``segments()``, which are
+        memoryviews over the chunks of an ``IndexedCircularIO`` and copies
+        for an ``MmapCircularIO``.
+
+        :param position: Not used because it is recalculated using the
+        ``frame_index`` of the stream.
+        :return: a tuple of the list of buffers read and the position where
+        reading stopped.
+        """
         with self.stream.lock:
-            last_streamed_index = self.__last_streamed_frame.index
-            for frame in reversed(self.stream.frames):
-                # We have to find the frame in the updated stream each time the
-                # stream is read. In the case of a circular stream that's still
-                # being written to, the frame will likely have a new position.
-                self.__last_streamed_frame = frame
-                if frame.index == last_streamed_index:
-                    break
-            position = self.__last_streamed_frame.position
-            last_frame = next(reversed(self.stream.frames))  # Read up to the last frame
-            length = last_frame.position - self.__last_streamed_frame.position
-            self.__last_streamed_frame = last_frame
-            
-            if length < 1000000: #1 mbit
-                # Using read() uses less memory but consumes more CPU cycles.
-                # To avoid blocking, only do this when the stream is small.
-                start_time = time.time()
-                bytes_read, new_position = super(VideoStreamSaver, self).read(position, length)
-                self.logger.debug('Using read() for length of %i bytes. Time: %.2f sec' % (length, time.time() - start_time))
-                return bytes_read, new_position
-            else:
-                # Creating a copy of the stream via getvalue() and then creating
-                # a sub array will consume a large amount of memory, depending
-                # on the stream's bitrate and its total length in seconds. This
-                # is necessary because read() and copy_to() are too slow and
-                # will cause frames to drop.
-                start_time = time.time()
-                bytes_read = self.stream.getvalue()
-                self.logger.debug('Using getvalue() for length of %i bytes. Time: %.2f sec' % (len(bytes_read), time.time() - start_time))
-                # At this point, let the stream unlock. Creating a sub array can
-                # take almost as long as the call to getvalue() if we're dealing
-                # with tens of megabytes.
+            # The index holds absolute positions. In the case of a circular
+            # stream that's still being written to, convert them using the
+            # current offset of the oldest byte in the stream.
+            start_offset = self.stream.start_offset
+            last_frame = self.stream.frame_index.last()  # Read up to the last frame
+            if last_frame is None:
+                return [], 0
+            position = self.__last_streamed_position - start_offset
+            if position < 0:
+                self.logger.warning('Stream overran %d unsaved bytes.' % -position)
+                position = 0
+            end_position = last_frame.position - start_offset
+            length = min(max(0, end_position - position), self.max_read_bytes)
+            self.__last_streamed_position = start_offset + position + length
 
-        start_time = time.time()
-        bytes_read = bytes_read[position:last_frame.position]
-        self.logger.debug('Time to slice array for %i bytes. Time: %.2f sec' % (len(bytes_read), time.time() - start_time))
-        return bytes_read, position + len(bytes_read)
-                
+            start_time = time.time()
+            buffers = self.stream.segments(position, length)
+            if self.__headers is not None and length > 0:
+                buffers.insert(0, self.__headers)
+                self.__headers = None
+            self.logger.debug('Exported %i bytes in %i segments. Time: %.3f sec' % (length, len(buffers), time.time() - start_time))
+        return buffers, position + length
 
     def ended(self):
         """
@@ -0,0 +1,240 @@
+import logging
+import os
+import queue
+import time
+from collections import namedtuple
+from threading import Lock
+from . import byte_writer
+from ...util.shutdown import TerminableThread
+
+ALIGNMENT = 64*1024  # Writes end on multiples of this file offset
+DEFAULT_COALESCE_BYTES = 1024*1024  # 1 MB
+DEFAULT_MAX_QUEUE = 64  # Queued writes before append_buffers() blocks
+FLUSH_INTERVAL = 1.0  # Pending bytes are written at least this often
+PUT_INTERVAL = 0.5  # Time between checks of the I/O thread while the queue is full
+FSYNC_NEVER = 'never'
+FSYNC_ON_CLOSE = 'close'
+FSYNC_ON_FLUSH = 'flush'  # Also syncs when the writer is flushed
+FSYNC_ALWAYS = 'always'
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_ON_CLOSE, FSYNC_ON_FLUSH, FSYNC_ALWAYS)
+WriteRequest = namedtuple('WriteRequest', 'buffers flush close')
+
+
+class AsyncDiskWriter(byte_writer.ByteWriter):
+    """
+    A class that writes all supplied bytes to a file on a dedicated I/O
+    thread, so a slow disk doesn't stall the ``StreamSaver`` reading the
+    camera stream. Bytes are queued and coalesced into large writes that end
+    on ``ALIGNMENT`` boundaries, which is much cheaper for SD cards than many
+    small writes.
+
+    The file is preallocated with ``posix_fallocate`` using the expected size
+    of the recording, and trimmed to the bytes written when it's closed.
+    ``fsync_policy`` controls when the file is synced to the disk.
+
+    If the I/O thread stops on an error, like a full disk, the file is closed
+    and every later append or flush raises an ``IOError`` instead of queuing
+    bytes that will never be written.
+    """
+
+    def __init__(self, full_path, expected_size=0, fsync_policy=FSYNC_ON_CLOSE,
+                 coalesce_bytes=DEFAULT_COALESCE_BYTES, max_queue=DEFAULT_MAX_QUEUE):
+        """
+        :param full_path: The full path of the file. Bytes are appended if it
+        already exists.
+        :param expected_size: The expected size of the file in bytes. The file
+        is preallocated in increments of this size. 0 disables preallocation.
+        :param fsync_policy: One of ``FSYNC_POLICIES``.
+        :param coalesce_bytes: The number of pending bytes that triggers a
+        write.
+        :param max_queue: The maximum number of queued writes. When the queue
+        is full, ``append_buffers()`` blocks until the I/O thread catches up.
+        """
+        super(AsyncDiskWriter, self).__init__(full_path)
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy "%s".' % fsync_policy)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        self.__closed = False
+        self.__requests = queue.Queue(maxsize=max_queue)
+        self.__io_thread = DiskIOThread(full_path, self.__requests, expected_size, fsync_policy, coalesce_bytes)
+        self.__io_thread.start()
+
+    def append_bytes(self, bts, close=False):
+        self.append_buffers([bts], close)
+
+    def append_buffers(self, buffers, close=False):
+        """
+        Queues the buffers for the I/O thread. The buffers must not be
+        modified afterwards, which is true of the views a stream exports.
+        """
+        if self.__closed:
+            return
+        buffers = [b for b in buffers if len(b) > 0]
+        if len(buffers) > 0 or close:
+            self.__put(WriteRequest(buffers=buffers, flush=False, close=close))
+        self.__closed = close
+
+    def flush(self):
+        """
+        Writes the pending bytes without waiting for more to coalesce.
+        """
+        if not self.__closed:
+            self.__put(WriteRequest(buffers=[], flush=True, close=False))
+
+    def is_finished_writing(self):
+        return not self.__io_thread.is_alive()
+
+    def metrics(self):
+        """
+        :return: A dict with the ``queue_depth``, the ``bytes_written``, the
+        number of ``writes`` and the average, maximum and last write latency
+        in seconds.
+        """
+        metrics = self.__io_thread.metrics()
+        metrics['queue_depth'] = self.__requests.qsize()
+        return metrics
+
+    def __put(self, request):
+        """
+        Queues the request, waiting while the queue is full as long as the I/O
+        thread is running.
+
+        :raise IOError: If the I/O thread has stopped.
+        """
+        while True:
+            if not self.__io_thread.is_alive():
+                raise IOError('The I/O thread writing "%s" stopped: %s' %
+                              (self.full_path, self.__io_thread.error or 'shutting down'))
+            try:
+                self.__requests.put(request, timeout=PUT_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+
+class DiskIOThread(TerminableThread):
+    """
+    A threaded class that performs the file I/O of an ``AsyncDiskWriter``.
+    """
+
+    def __init__(self, full_path, requests, expected_size, fsync_policy, coalesce_bytes):
+        super(DiskIOThread, self).__init__()
+        self.name = 'DiskIOThread'
+        self.logger = logging.getLogger(__name__)
+        self.__full_path = full_path
+        self.__requests = requests
+        self.__expected_size = expected_size
+        self.__fsync_policy = fsync_policy
+        self.__coalesce_bytes = coalesce_bytes
+        self.__pending = bytearray()
+        self.__fd = None
+        self.__offset = 0
+        self.__allocated = 0
+        self.__lock = Lock()
+        self.__bytes_written = 0
+        self.__writes = 0
+        self.__total_latency = 0.0
+        self.__max_latency = 0.0
+        self.__last_latency = 0.0
+        self.error = None  # The exception that stopped the thread
+
+    def metrics(self):
+        with self.__lock:
+            return dict(bytes_written=self.__bytes_written,
+                        writes=self.__writes,
+                        write_latency_avg=(self.__total_latency / self.__writes) if self.__writes > 0 else 0.0,
+                        write_latency_max=self.__max_latency,
+                        write_latency_last=self.__last_latency)
+
+    def run(self):
+        try:
+            self.__fd = os.open(self.__full_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            self.__offset = os.fstat(self.__fd).st_size  # Append like DiskWriter
+            self.__allocated = self.__offset
+            self.__preallocate(self.__offset)
+
+            closed = False
+            while not closed:
+                try:
+                    request = self.__requests.get(timeout=FLUSH_INTERVAL)
+                except queue.Empty:
+                    self.__write_pending(aligned=False)  # Don't hold bytes for long
+                    closed = not self.should_run
+                    continue
+                for buffer in request.buffers:
+                    self.__pending += buffer
+                if request.flush or request.close:
+                    self.__write_pending(aligned=False)
+                    if request.flush and self.__fsync_policy == FSYNC_ON_FLUSH:
+                        os.fsync(self.__fd)
+                elif len(self.__pending) >= self.__coalesce_bytes:
+                    self.__write_pending(aligned=True)
+                closed = request.close
+        except Exception as e:
+            self.error = e
+            self.logger.exception('An exception occurred: %s' % e)
+        finally:
+            self.__close()
+
+    def __preallocate(self, end):
+        """
+        Extends the file's allocation by ``expected_size`` past ``end``.
+        """
+        if self.__expected_size <= 0 or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self.__fd, end, self.__expected_size)
+            self.__allocated = end + self.__expected_size
+        except OSError as e:
+            self.logger.debug('Preallocation is not supported: %s' % e)
+            self.__expected_size = 0
+
+    def __write_pending(self, aligned):
+        """
+        Writes the pending bytes to the file.
+
+        :param aligned: If True, only the bytes up to the last ``ALIGNMENT``
+        boundary are written. The rest are kept for the next write.
+        """
+        length = len(self.__pending)
+        if aligned:
+            length = (self.__offset + length) // ALIGNMENT * ALIGNMENT - self.__offset
+        if length <= 0:
+            return
+        if self.__offset + length > self.__allocated:
+            self.__preallocate(self.__offset + length)
+
+        start_time = time.time()
+        with memoryview(self.__pending) as data:
+            written = 0
+            while written < length:
+                written += os.pwrite(self.__fd, data[written:length], self.__offset + written)
+        if self.__fsync_policy == FSYNC_ALWAYS:
+            os.fsync(self.__fd)
+        latency = time.time() - start_time
+        del self.__pending[:length]
+        self.__offset += length
+
+        with self.__lock:
+            self.__bytes_written += length
+            self.__writes += 1
+            self.__total_latency += latency
+            self.__max_latency = max(self.__max_latency, latency)
+            self.__last_latency = latency
+
+    def __close(self):
+        if self.__fd is None:
+            return
+        try:
+            self.__write_pending(aligned=False)
+            if self.__allocated > self.__offset:
+                os.ftruncate(self.__fd, self.__offset)  # Drop the unused preallocation
+            if self.__fsync_policy != FSYNC_NEVER:
+                os.fsync(self.__fd)
+        except Exception as e:
+            self.logger.exception('An exception occurred closing "%s": %s' % (self.__full_path, e))
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+        self.logger.debug('Closed "%s". Metrics: %s' % (self.__full_path, self.metrics()))
@@ -15,5 +15,20 @@ class ByteWriter:
     def append_bytes(self, bts, close=False):
         pass
 
+    def append_buffers(self, buffers, close=False):
+        """
+        Appends a list of bytes-like objects, such as memoryviews exported by
+        a stream. By default they are joined into one call to
+        ``append_bytes``. Subclasses can write them without joining.
+        """
+        self.append_bytes(b''.join(buffers), close)
+
+    def flush(self):
+        """
+        Called after a large write, like the backlog of a stream, that should
+        be persisted before waiting for more bytes.
+        """
+        pass
+
     def append_string(self, string, close=False):
         self.append_bytes(string.encode(), close)
@@ -19,3 +19,16 @@ class DiskWriter(byte_writer.ByteWriter):
             self.file.write(bts) if len(bts) > 0 else None
             if close:
                 self.file.close()
+
+    def append_buffers(self, buffers, close=False):
+        """
+        Overridden to write each buffer directly instead of joining them.
+        """
+        if self.file is not None:
+            self.file.writelines(buffers)
+            if close:
+                self.file.close()
+
+    def flush(self):
+        if self.file is not None and not self.file.closed:
+            self.file.flush()
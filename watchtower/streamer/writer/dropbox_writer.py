@@ -1,20 +1,19 @@
-import base64
 import dropbox
 import logging
 import os
-import queue
 import sys
 import time
 from . import byte_writer
-from collections import namedtuple
-from cryptography.fernet import Fernet
+from .encryption_pool import EncryptionPool
+from .envelope_encryption import EnvelopeEncryptor
+from .upload_service import UploadService, PRIORITY_VIDEO
+from collections import deque, namedtuple
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from threading import Thread, Lock
+from cryptography.hazmat.primitives import serialization
+from threading import BoundedSemaphore, Lock
 
-THREAD_COUNT = 2
 DEFAULT_FILE_CHUNK_SIZE = 512*1024 # 512 KB
+MAX_CHUNKS_AHEAD = 4  # Chunks that can be encrypting or waiting for their upload
 NumberedFile = namedtuple('NumberedFile', 'number bytes')
 
 
@@ -22,26 +21,66 @@ class DropboxWriter(byte_writer.ByteWriter):
     """
     A class that accumulates bytes to upload to Dropbox and uploads chunks sized
     according to the ``file_chunk_size``. If the provided size is <= 0, the file
-    is not broken apart and only one upload thread is used. Otherwise, this
-    class creates additional files as the chunk size is reached.
-    
-    If the path to a public key file is supplied, the bytes will be encrypted
-    and the random symmetric encryption key used to encrypt the data will
-    itself be encrypted and prepended to the front of the file. Fernet
-    encryption is used. The key itself is encrypted using the public key.
+    is not broken apart. Otherwise, this class creates additional files as the
+    chunk size is reached.
+
+    Uploads are submitted to the shared UploadService, whose worker pool and
+    Dropbox clients are reused by every writer. ``priority`` orders this
+    writer's uploads against the other writers'. At most ``max_chunks_ahead``
+    chunks can be encrypting or waiting for their upload; appending blocks
+    until one of them is uploaded. A slow upload therefore holds up the caller,
+    such as a QueuedWriter whose overflow policy then applies, instead of
+    growing the service's queue.
+
+    If the path to a public key file is supplied, the bytes are encrypted
+    with a random data key as they are appended, using the format described
+    in envelope_encryption. One data key is used for the whole recording. It
+    is encrypted using the public key and stored at the front of each file.
+    The frames of each chunk are encrypted by the shared EncryptionPool while
+    earlier chunks upload. If a chunk fails to encrypt, it isn't uploaded. An
+    upload session's stream can't continue without it, so the rest of the
+    recording is discarded and the session commits the frames before it,
+    which decrypt as a truncated file.
+
+    With ``upload_session``, the chunks are instead appended to a single file
+    at ``full_path`` using a Dropbox upload session. Each chunk is uploaded
+    as soon as it's ready while the next one accumulates.
+
+    With an UploadMonitor, the uploads are limited to its rate, and each
+    chunk's size after the first comes from the monitor's measurements.
+
+    When an UploadSpool is supplied, failed uploads are stored in it and
+    retried later instead of being lost. If a chunk of an upload session
+    fails, the rest of the recording is uploaded as numbered files next to
+    the part of the file uploaded by the session. Concatenated in order,
+    they hold the rest of the file.
     """
 
-    def __init__(self, full_path, dropbox_token, file_chunk_size=DEFAULT_FILE_CHUNK_SIZE, public_pem_path=None, test_dropbox_uploader=None):
+    def __init__(self, full_path, dropbox_token, file_chunk_size=DEFAULT_FILE_CHUNK_SIZE, public_pem_path=None, test_dropbox_uploader=None, upload_session=False, priority=PRIORITY_VIDEO, upload_service=None, spool=None, encryption_pool=None, max_chunks_ahead=MAX_CHUNKS_AHEAD, upload_monitor=None):
         """
         :param full_path: The full path of the file.
         :param dropbox_token: Token that will be supplied to Dropbox.
         :param file_chunk_size: A maximum size, in bytes, before a new file
         will be created. Actual size will be larger if encryption is used.
+        With an adaptive UploadMonitor, this is the size of the first chunk.
         :param public_pem_path: A path to the public key to encrypt each file's
         encryption key.
         :param test_dropbox_uploader: An object that will be used in place of
         the normal Dropbox uploader. Useful for testing. Object must implement
-        the files_upload(bytes, path) method.
+        the files_upload(bytes, path) method, and the upload session methods
+        if ``upload_session`` is used.
+        :param upload_session: If True, a single file is written using an
+        upload session instead of one file per chunk.
+        :param priority: The UploadService priority of the uploads.
+        :param upload_service: The UploadService to use. Defaults to the shared
+        service.
+        :param spool: An optional UploadSpool for the failed uploads.
+        :param encryption_pool: The EncryptionPool to use. Defaults to the
+        shared pool.
+        :param max_chunks_ahead: The number of chunks that can be encrypting or
+        waiting for their upload.
+        :param upload_monitor: An optional UploadMonitor that limits and
+        measures the uploads and adapts the chunk size.
         """
         super(DropboxWriter, self).__init__(full_path)
         if file_chunk_size <= 0:
@@ -50,148 +89,297 @@ class DropboxWriter(byte_writer.ByteWriter):
             self.__file_chunk_size = file_chunk_size
         
         self.__file_count = 0
-        self.__byte_pool = ''.encode()
+        self.__byte_pool = []  # Views of the appended bytes, or encrypted bytes
+        self.__chunk_length = 0  # Bytes appended to the current chunk
+        self.__priority = priority
+        self.__service = upload_service if upload_service is not None else UploadService.shared()
+        self.__lock = Lock()
+        self.__pending_uploads = 0
+        self.__closed = False
+        self.__order_lock = Lock()
+        self.__pending_chunks = deque()  # Chunks waiting to upload, in order
+        self.__chunks_ahead = BoundedSemaphore(max_chunks_ahead)
+        self.__failed = False  # True once an upload session's stream is broken
+        self.__upload_monitor = upload_monitor
 
         dbx = None
         if test_dropbox_uploader is None:
-            dbx = dropbox.Dropbox(dropbox_token)
+            dbx = self.__service.client(dropbox_token)
         else:
             dbx = test_dropbox_uploader
+        if upload_monitor is not None:
+            dbx = upload_monitor.client(dbx)
         public_key = None
         if public_pem_path:
             with open(public_pem_path, "rb") as public_key_file:
                 public_key = serialization.load_pem_public_key(public_key_file.read(), backend=default_backend())
                 
+        self.__encryptor = None
+        self.__stream = None
         if public_key is not None:
             logging.getLogger(__name__).debug('Using encryption!')
+            self.__encryptor = EnvelopeEncryptor(public_key)
+            self.__stream = self.__encryptor.stream()
+            self.__encryption_pool = encryption_pool if encryption_pool is not None else EncryptionPool.shared()
 
+        # The spooled uploads of the newest events are retried first.
+        failure_spool = FailureSpool(spool, priority, time.time()) if spool is not None else None
         path, extension = os.path.splitext(full_path)
-        self.__uploader_threads = []
-        thread_count = THREAD_COUNT if file_chunk_size > 0 else 1
-        for i in range(thread_count):
-            uploader = DropboxFileUploader(dbx, path, extension, public_key, i)
-            self.__uploader_threads.append(uploader)
-            uploader.start()
-        self.__thread_index = 0
+        self.__file_uploader = DropboxFileUploader(dbx, path, extension, failure_spool)
+        self.__session_uploader = None
+        if upload_session:
+            self.__session_uploader = DropboxSessionUploader(dbx, full_path, self.__file_uploader, failure_spool)
 
     def append_bytes(self, bts, close=False):
+        self.append_buffers([bts], close)
+
+    def append_buffers(self, buffers, close=False):
         """
-        This method will append the bytes to a small array. When enough bytes
-        have been appended, one or more chunks is broken off and distributed to
-        an uploader thread.
+        This method will append the buffers to a pool of views, encrypting
+        them first if needed. When enough bytes have been appended, a chunk is
+        broken off and submitted for upload. The appended bytes are only
+        copied once, when a chunk is joined, so they must not be modified
+        afterwards.
         """
-        self.__byte_pool += bts
-        logging.getLogger(__name__).debug('Byte pool length: %i bytes' % len(self.__byte_pool))
-        if len(self.__byte_pool) < self.__file_chunk_size and not close:
-            return # Wait for more data.
-        
-        # Break apart the bytes and distribute each chunk to an uploader.
-        sub_bytes = self.__byte_pool[:self.__file_chunk_size]
-        while len(sub_bytes) == self.__file_chunk_size:
-            self.__distribute_file_bytes(sub_bytes)
-            self.__byte_pool = self.__byte_pool[self.__file_chunk_size:]  # Remove the chunk.
-            sub_bytes = self.__byte_pool[:self.__file_chunk_size]  # Fetch the next chunk.
-        self.__byte_pool = sub_bytes  # The last chunk, smaller than file_chunk_size.
-        
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            while len(view) > 0:
+                length = min(len(view), self.__file_chunk_size - self.__chunk_length)
+                self.__append_to_pool(view[:length])
+                self.__chunk_length += length
+                view = view[length:]
+                if self.__chunk_length == self.__file_chunk_size:
+                    self.__end_chunk(close=False)
+        logging.getLogger(__name__).debug('Chunk length: %i bytes' % self.__chunk_length)
+
         if close == True:
-            # Dump the remaining data.
-            if len(self.__byte_pool) > 0:
-                self.__distribute_file_bytes(self.__byte_pool)
-            # Stop all threads.
-            list(map(lambda x: x.stop(), self.__uploader_threads))
+            # Dump the remaining data. An upload session's stream must be
+            # finished even if no bytes are left.
+            if self.__chunk_length > 0 or (self.__stream is not None and self.__stream.started):
+                self.__end_chunk(close=True)
+            self.__close()
+
+    def __append_to_pool(self, view):
+        if self.__stream is None:
+            self.__byte_pool.append(view)
+        else:
+            self.__byte_pool.extend(self.__stream.update(view))
+
+    def __end_chunk(self, close):
+        """
+        Breaks off the pool as a chunk and submits it for encryption or
+        upload. Separate files each get their own encrypted stream, while an
+        upload session's stream continues until it's closed.
+        """
+        parts = self.__byte_pool
+        stream = self.__stream
+        if stream is not None and (close or self.__session_uploader is None):
+            parts.extend(stream.finalize())
+            self.__stream = self.__encryptor.stream()
+        self.__byte_pool = []
+        self.__chunk_length = 0
+        with self.__order_lock:
+            if self.__failed:
+                return  # Nothing more can be uploaded to the stream.
+        if self.__upload_monitor is not None and self.__file_chunk_size != sys.maxsize:
+            self.__file_chunk_size = self.__upload_monitor.chunk_size(self.__file_chunk_size)
+
+        self.__chunks_ahead.acquire()  # Waits for an upload if too far ahead
+        chunk = PendingChunk(limited=True)
+        if stream is None:
+            self.__queue_chunk(chunk)
+            self.__chunk_ready(chunk, b''.join(parts))
+            return
+        self.__queue_chunk(chunk)
+        self.__encryption_pool.submit(lambda: self.__encrypt_chunk(chunk, stream, parts))
+
+    def __encrypt_chunk(self, chunk, stream, parts):
+        try:
+            bts = stream.encrypt(parts)
+        except Exception as e:
+            if self.__session_uploader is not None:
+                logging.getLogger(__name__).exception('Encryption failed. Ending the upload session: %s' % e)
+            else:
+                logging.getLogger(__name__).exception('Encryption failed. Dropping a chunk: %s' % e)
+            chunk.failed = True
+            bts = b''
+        self.__chunk_ready(chunk, bts)
+
+    def __queue_chunk(self, chunk):
+        with self.__order_lock:
+            self.__pending_chunks.append(chunk)
+
+    def __chunk_ready(self, chunk, bts):
+        """
+        Stores the chunk's bytes and submits the ready chunks at the front of
+        the queue, so uploads start in order even if encryption finishes out
+        of order.
+        """
+        with self.__order_lock:
+            chunk.bytes = bts
+            while len(self.__pending_chunks) > 0 and self.__pending_chunks[0].bytes is not None:
+                chunk = self.__pending_chunks.popleft()
+                if chunk.failed and self.__session_uploader is not None:
+                    # The following chunks continue the frames of this one.
+                    self.__failed = True
+                if chunk.close:
+                    self.__close_ready()
+                elif len(chunk.bytes) > 0 and not self.__failed:
+                    self.__distribute_file_bytes(chunk.bytes, chunk.limited)
+                elif chunk.limited:
+                    self.__chunks_ahead.release()
 
     def is_finished_writing(self):
-        for uploader_thread in self.__uploader_threads:
-            if uploader_thread.is_alive():
-                return False
-        return True
-    
-    def __distribute_file_bytes(self, bts):
+        with self.__lock:
+            return self.__closed and self.__pending_uploads == 0
+
+    def __submit(self, task, lane=None, limited=False, byte_count=0):
+        def run():
+            try:
+                task()
+            finally:
+                with self.__lock:
+                    self.__pending_uploads -= 1
+                if limited:
+                    self.__chunks_ahead.release()
+                if self.__upload_monitor is not None:
+                    self.__upload_monitor.queued(-byte_count)
+        with self.__lock:
+            self.__pending_uploads += 1
+        if self.__upload_monitor is not None:
+            self.__upload_monitor.queued(byte_count)
+        self.__service.submit(run, self.__priority, lane)
+
+    def __distribute_file_bytes(self, bts, limited):
         """
-        Creates a unique file with the supplied bytes and passes this to an
-        uploader thread in a round robin fashion.
+        Creates a unique file with the supplied bytes and submits its upload to
+        the UploadService.
         """
         numbered_file = NumberedFile(self.__file_count, bts)
-        self.__uploader_threads[self.__thread_index].append_file(numbered_file)
-        logging.getLogger(__name__).debug('Distributed file to DropboxFileUploader #%i' % self.__thread_index)
-        self.__file_count += 1
-        if self.__thread_index == len(self.__uploader_threads) - 1:
-            self.__thread_index = 0
+        if self.__session_uploader is not None:
+            self.__submit(lambda: self.__session_uploader.upload(numbered_file), lane=self.__session_uploader, limited=limited, byte_count=len(bts))
         else:
-            self.__thread_index += 1
+            self.__submit(lambda: self.__file_uploader.upload(numbered_file), limited=limited, byte_count=len(bts))
+        logging.getLogger(__name__).debug('Submitted file %i.' % self.__file_count)
+        self.__file_count += 1
+
+    def __close(self):
+        chunk = PendingChunk(limited=False, close=True)
+        self.__queue_chunk(chunk)
+        self.__chunk_ready(chunk, b'')
 
+    def __close_ready(self):
+        """
+        Called once every chunk was submitted.
+        """
+        if self.__session_uploader is not None:
+            self.__submit(self.__session_uploader.finish, lane=self.__session_uploader)
+        with self.__lock:
+            self.__closed = True
 
-class DropboxFileUploader(Thread):
+
+class PendingChunk:
     """
-    Threaded class used to accumulate data that needs to be uploaded to Dropbox.
-    If a public key is supplied, this class will optionally encrypt the data
-    before uploading.
+    A chunk, or the writer's close, waiting for its turn to upload. ``bytes``
+    is None until the chunk is encrypted.
     """
 
-    def __init__(self, dbx: dropbox.Dropbox, path: str, extension: str, public_key=None, log_number=0):
-        super(DropboxFileUploader, self).__init__()
-        self.__dbx = dbx
-        self.__path = path
-        self.__extension = extension
-        self.__public_key = public_key
-        self.__log_number = log_number
-        self.__stop = False
-        self.__lock = Lock()
-        self.__queue = queue.Queue()
+    def __init__(self, limited, close=False):
+        self.bytes = None
+        self.limited = limited  # True if it holds one of the chunks ahead
+        self.close = close
+        self.failed = False  # True if it couldn't be encrypted
 
-    def __should_stop(self):
-        self.__lock.acquire()
-        should_stop = self.__stop
-        self.__lock.release()
-        return should_stop
 
-    def stop(self):
-        self.__lock.acquire()
-        self.__stop = True
-        self.__lock.release()
+FailureSpool = namedtuple('FailureSpool', 'spool priority event_time')
 
-    def append_file(self, numbered_file: NumberedFile):
-        self.__queue.put(numbered_file)
+
+class DropboxFileUploader:
+    """
+    Uploads numbered files to Dropbox. Files that fail to upload are added
+    to the FailureSpool's spool, if there is one.
+    """
+
+    def __init__(self, dbx: dropbox.Dropbox, path: str, extension: str, failure_spool=None):
+        self.__dbx = dbx
+        self.__path = path
+        self.__extension = extension
+        self.__failure_spool = failure_spool
 
     def __logger(self) -> logging.Logger:
-        return logging.getLogger("%s.%i" % (__name__, self.__log_number))
+        return logging.getLogger(__name__)
 
-    def __encrypt(self, numbered_file: NumberedFile):
-        """
-        Encrypts the supplied file's data and prepends the encrypted symmetric
-        key to that data.
-        """
-        if self.__public_key is None:
-            self.__logger().debug('Skipping encryption.')
-            return numbered_file
-
-        start_time = time.time()
-        fernet_key = Fernet.generate_key()
-        encrypted_fernet_key = self.__public_key.encrypt(fernet_key,
-                                                         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                                      algorithm=hashes.SHA256(),
-                                                                      label=None))
-        encoded_fernet_key = base64.b64encode(encrypted_fernet_key)
-        encrypted_bytes = Fernet(fernet_key).encrypt(numbered_file.bytes)
-        self.__logger().debug('Done encrypting. Took %.2f sec.' % (time.time() - start_time))
-        return numbered_file._replace(bytes=str(len(encoded_fernet_key)).encode() + b' ' + encoded_fernet_key + encrypted_bytes)
-
-    def __upload(self, numbered_file: NumberedFile):
+    def upload(self, numbered_file: NumberedFile):
         full_path = self.__path + str(numbered_file.number) + self.__extension
         self.__logger().debug('Uploading file \"%s\"...' % full_path)
-        self.__dbx.files_upload(numbered_file.bytes, full_path)
+        try:
+            self.__dbx.files_upload(numbered_file.bytes, full_path)
+        except Exception as e:
+            if self.__failure_spool is None:
+                raise
+            self.__logger().warning('Upload of \"%s\" failed. Spooling it: %s' % (full_path, e))
+            spool, priority, event_time = self.__failure_spool
+            spool.add(full_path, numbered_file.bytes, priority, event_time)
+            return
         self.__logger().debug('Done uploading \"%s\".' % full_path)
 
-    def run(self):
-        self.__logger().debug('Uploader thread running.')
-        # Only stop if the queue is also empty.
-        while not self.__should_stop() or not self.__queue.empty():
-            try:
-                numbered_file = self.__queue.get(block=True, timeout=0.5)
-                self.__logger().debug('Ready to process file %i' % numbered_file.number)
-                self.__upload(self.__encrypt(numbered_file))
-            except queue.Empty:
-                pass
-            except Exception as e:
-                logging.getLogger(__name__).debug('Exception %s.' % e)
-        self.__logger().debug('Uploader thread stopped.')
+
+class DropboxSessionUploader:
+    """
+    Uploads chunks to a single Dropbox file using an upload session. The
+    session is started with the first chunk, each following chunk is
+    appended, and the session is finished by ``finish()``. The calls must be
+    made in order, one at a time.
+
+    After a chunk fails, it and the following chunks are uploaded as
+    numbered files by ``file_uploader``, and ``finish()`` commits the part
+    of the file that was uploaded. A commit that fails is added to the
+    FailureSpool's spool, if there is one.
+    """
+
+    def __init__(self, dbx: dropbox.Dropbox, full_path: str, file_uploader: DropboxFileUploader, failure_spool=None):
+        self.__dbx = dbx
+        self.__full_path = full_path
+        self.__file_uploader = file_uploader
+        self.__failure_spool = failure_spool
+        self.__cursor = None
+        self.__failed = False
+
+    def __logger(self) -> logging.Logger:
+        return logging.getLogger("%s.session" % __name__)
+
+    def upload(self, numbered_file: NumberedFile):
+        if self.__failed:
+            # The session's offset is unknown after a failure.
+            self.__file_uploader.upload(numbered_file)
+            return
+        bts = numbered_file.bytes
+        try:
+            if self.__cursor is None:
+                self.__logger().debug('Starting upload session for \"%s\"...' % self.__full_path)
+                result = self.__dbx.files_upload_session_start(bts)
+                self.__cursor = dropbox.files.UploadSessionCursor(session_id=result.session_id, offset=0)
+            else:
+                self.__dbx.files_upload_session_append_v2(bts, self.__cursor)
+        except Exception as e:
+            self.__logger().warning('Upload session for \"%s\" failed. Uploading numbered files: %s' % (self.__full_path, e))
+            self.__failed = True
+            self.__file_uploader.upload(numbered_file)
+            return
+        self.__cursor.offset += len(bts)
+        self.__logger().debug('Uploaded chunk %i. Offset: %i' % (numbered_file.number, self.__cursor.offset))
+
+    def finish(self):
+        if self.__cursor is None:
+            return  # Nothing was uploaded.
+        commit = dropbox.files.CommitInfo(path=self.__full_path)
+        try:
+            self.__dbx.files_upload_session_finish(b'', self.__cursor, commit)
+        except Exception as e:
+            if self.__failure_spool is None:
+                raise
+            self.__logger().warning('Commit of \"%s\" failed. Spooling it: %s' % (self.__full_path, e))
+            spool, priority, event_time = self.__failure_spool
+            spool.add_commit(self.__full_path, self.__cursor.session_id, self.__cursor.offset, priority, event_time)
+            return
+        self.__logger().debug('Done uploading \"%s\".' % self.__full_path)
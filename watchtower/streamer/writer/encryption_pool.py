@@ -0,0 +1,79 @@
+import logging
+import os
+import queue
+from threading import Lock
+from ...util.shutdown import TerminableThread
+
+WAIT_TIME = 0.5  # Time between shutdown checks while the queue is empty
+
+
+class EncryptionPool:
+    """
+    A process-wide pool of threads that encrypt chunks for every
+    DropboxWriter, so encryption runs alongside the uploads instead of
+    before them. The cryptography package releases the GIL while OpenSSL
+    encrypts, so the threads use every core without copying the chunks into
+    other processes.
+    """
+
+    __shared = None
+    __shared_lock = Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        :return: The EncryptionPool used by all DropboxWriter instances.
+        """
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = EncryptionPool()
+            return cls.__shared
+
+    def __init__(self, worker_count=None):
+        """
+        :param worker_count: The number of threads. Defaults to the number of
+        CPUs.
+        """
+        self.__queue = queue.Queue()
+        self.__workers = []
+        for i in range(worker_count or os.cpu_count() or 1):
+            worker = EncryptionWorker(self.__queue, i)
+            self.__workers.append(worker)
+            worker.start()
+
+    @property
+    def worker_count(self):
+        return len(self.__workers)
+
+    def submit(self, task):
+        """
+        Queues a task for a worker.
+
+        :param task: A callable taking no arguments.
+        """
+        self.__queue.put(task)
+
+
+class EncryptionWorker(TerminableThread):
+    """
+    A threaded class that runs the tasks of an EncryptionPool.
+    """
+
+    def __init__(self, task_queue, number):
+        super(EncryptionWorker, self).__init__()
+        self.name = 'EncryptionWorker%i' % number
+        self.daemon = True
+        self.logger = logging.getLogger('%s.%i' % (__name__, number))
+        self.__queue = task_queue
+
+    def run(self):
+        while self.should_run:
+            try:
+                task = self.__queue.get(timeout=WAIT_TIME)
+            except queue.Empty:
+                continue
+            try:
+                task()
+            except Exception as e:
+                self.logger.exception('An exception occurred: %s' % e)
+        self.logger.debug('Thread stopped.')
@@ -0,0 +1,148 @@
+"""
+The version 2 encryption format. A file starts with a header:
+
+    b'WTE' | version (1 byte) | cipher (1 byte) | wrapped key length (2 bytes)
+    | wrapped key | nonce prefix (8 bytes)
+
+The wrapped key is the data key encrypted with the RSA public key using
+OAEP and SHA256. It's followed by frames:
+
+    length and final flag (4 bytes) | ciphertext and tag
+
+The high bit of the length is set on the last frame. Each frame's nonce is
+the nonce prefix followed by the frame's index (4 bytes), and its associated
+data is the header followed by the index and the final flag, so frames can't
+be reordered, truncated or moved to another file. Integers are big-endian.
+The format is read by ancillary/decryption/decrypt.py.
+"""
+
+import os
+import struct
+from collections import namedtuple
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+MAGIC = b'WTE'
+VERSION = 2
+CIPHER_AES_GCM = 1
+CIPHER_CHACHA20_POLY1305 = 2
+CIPHERS = {CIPHER_AES_GCM: AESGCM, CIPHER_CHACHA20_POLY1305: ChaCha20Poly1305}
+# The Pi's CPUs don't have AES instructions, which makes ChaCha20 faster.
+DEFAULT_CIPHER = CIPHER_CHACHA20_POLY1305
+FRAME_SIZE = 64*1024  # Bytes of plaintext per frame
+FINAL_FLAG = 0x80000000
+NONCE_PREFIX_SIZE = 8
+
+# A frame's plaintext, before it's encrypted.
+PlainFrame = namedtuple('PlainFrame', 'index data final')
+
+
+class EnvelopeEncryptor:
+    """
+    Holds the data key of one event. The key is generated and wrapped with
+    the public key once, and every stream of the event is encrypted with it.
+    """
+
+    def __init__(self, public_key, cipher=DEFAULT_CIPHER):
+        """
+        :param public_key: The RSA public key that wraps the data key.
+        :param cipher: ``CIPHER_AES_GCM`` or ``CIPHER_CHACHA20_POLY1305``.
+        """
+        if cipher not in CIPHERS:
+            raise ValueError('Unknown cipher %s.' % cipher)
+        data_key = os.urandom(32)
+        self.__aead = CIPHERS[cipher](data_key)
+        wrapped_key = public_key.encrypt(data_key,
+                                         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                                      algorithm=hashes.SHA256(),
+                                                      label=None))
+        self.__key_header = MAGIC + struct.pack('>BBH', VERSION, cipher, len(wrapped_key)) + wrapped_key
+
+    def stream(self):
+        """
+        :return: A new EncryptedStream, which is one encrypted file.
+        """
+        return EncryptedStream(self.__aead, self.__key_header + os.urandom(NONCE_PREFIX_SIZE))
+
+
+class EncryptedStream:
+    """
+    Encrypts the bytes of one file incrementally. The bytes are cut into
+    frames as they arrive, and ``encrypt()`` encrypts a list of frames. Each
+    frame's nonce depends only on its index, so the frames can be encrypted
+    on any thread and in any order.
+    """
+
+    def __init__(self, aead, header):
+        self.__aead = aead
+        self.__header = header
+        self.__nonce_prefix = header[-NONCE_PREFIX_SIZE:]
+        self.__frame_index = 0
+        self.__pending = bytearray()
+        self.__started = False
+
+    @property
+    def started(self):
+        """
+        :return: True once any parts were returned.
+        """
+        return self.__started
+
+    def update(self, bts):
+        """
+        Only a partial frame is copied. The bytes must not be modified
+        afterwards.
+
+        :return: A list of the parts that are ready: the header's bytes and
+        PlainFrames.
+        """
+        output = self.__start()
+        view = memoryview(bts).cast('B')
+        if len(self.__pending) > 0:
+            needed = FRAME_SIZE - len(self.__pending)
+            self.__pending += view[:needed]
+            view = view[needed:]
+            if len(self.__pending) < FRAME_SIZE:
+                return output
+            output.append(self.__frame(self.__pending, final=False))
+            self.__pending = bytearray()
+        while len(view) >= FRAME_SIZE:
+            output.append(self.__frame(view[:FRAME_SIZE], final=False))
+            view = view[FRAME_SIZE:]
+        self.__pending += view
+        return output
+
+    def finalize(self):
+        """
+        :return: The last parts of the file, including the final frame.
+        """
+        output = self.__start()
+        output.append(self.__frame(self.__pending, final=True))
+        self.__pending = bytearray()
+        return output
+
+    def encrypt(self, parts):
+        """
+        :param parts: Parts returned by ``update()`` and ``finalize()``.
+        :return: The encrypted bytes of the parts, joined.
+        """
+        return b''.join(part if isinstance(part, bytes) else self.__encrypt_frame(part) for part in parts)
+
+    def __start(self):
+        if self.__started:
+            return []
+        self.__started = True
+        return [self.__header]
+
+    def __frame(self, plaintext, final):
+        frame = PlainFrame(self.__frame_index, plaintext, final)
+        self.__frame_index += 1
+        return frame
+
+    def __encrypt_frame(self, frame):
+        flag = FINAL_FLAG if frame.final else 0
+        nonce = self.__nonce_prefix + struct.pack('>I', frame.index)
+        associated_data = self.__header + struct.pack('>IB', frame.index, 1 if frame.final else 0)
+        ciphertext = self.__aead.encrypt(nonce, frame.data, associated_data)
+        return struct.pack('>I', len(ciphertext) | flag) + ciphertext
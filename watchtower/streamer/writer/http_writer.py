@@ -1,4 +1,5 @@
 import base64
+from collections import deque
 from io import BytesIO
 from . import byte_writer
 import time
@@ -8,35 +9,75 @@ from threading import Lock, Event
 MULTIPART_BOUNDARY = 'FRAME'
 
 
+def multipart_frame(bts, use_base64=False):
+    """
+    Wraps JPEG bytes in one HTTP multipart part.
+
+    :param bts: The raw JPEG bytes.
+    :param use_base64: If True, the JPEG is base64 encoded inside the part.
+    :return: The bytes of the part, ready to be sent to a client.
+    """
+    if use_base64:
+        bts = base64.standard_b64encode(bts)
+    payload = '--' + MULTIPART_BOUNDARY + '\r\n' + \
+        'Content-Type: image/jpeg\r\n' + \
+        'Content-Length: ' + str(len(bts)) + '\r\n\r\n'
+    return payload.encode() + bts + b'\r\n\r\n'
+
+
 class HTTPMultipartWriter(byte_writer.ByteWriter):
     """
     A class that writes all bytes has HTTP formatted mutipart data to a BytesIO
     stream.
+
+    Pending frames are held until the next ``blocking_read()``. If
+    ``max_frames`` is set, at most that many frames are held and the oldest
+    pending frame is dropped when a new one arrives, so a slow client always
+    receives the latest frames and its memory use stays constant.
     """
-    def __init__(self, use_base64=False):
+    def __init__(self, use_base64=False, max_frames=None):
+        """
+        :param use_base64: If True, frames passed to ``append_bytes`` are
+        base64 encoded.
+        :param max_frames: The maximum number of frames waiting to be read.
+        ``None`` holds every frame.
+        """
         super(HTTPMultipartWriter, self).__init__(None)
-        self.__bytes = b''
+        self.__frames = deque(maxlen=max_frames)
+        self.__dropped_frames = 0
         self.__lock = Lock()
         self.__write_event = Event()
         self.__use_base64 = use_base64
 
-    def append_bytes(self, bts, close=False):
-        if self.__use_base64:
-            bts = base64.standard_b64encode(bts)
-        payload = '--' + MULTIPART_BOUNDARY + '\r\n' + \
-            'Content-Type: image/jpeg\r\n' + \
-            'Content-Length: ' + str(len(bts)) + '\r\n\r\n'
-        bts = payload.encode() + bts + b'\r\n\r\n'
+    @property
+    def dropped_frames(self):
+        """
+        :return: The number of frames replaced before they were read.
+        """
         with self.__lock:
-            self.__bytes += bts
-        self.__write_event.set()
+            return self.__dropped_frames
 
+    def append_bytes(self, bts, close=False):
+        if len(bts) == 0:
+            return # No new frame to send.
+        self.append_frame(multipart_frame(bts, self.__use_base64))
+
+    def append_frame(self, payload):
+        """
+        Queues an already formatted multipart part for the next
+        ``blocking_read()``. Used when the part is shared by many writers.
+        """
+        with self.__lock:
+            if len(self.__frames) == self.__frames.maxlen:
+                self.__dropped_frames += 1
+            self.__frames.append(payload)
+            self.__write_event.set()
 
     def blocking_read(self):
         self.__write_event.wait()
         with self.__lock:
-            payload = self.__bytes
-            self.__bytes = b''
-        self.__write_event.clear()
+            payload = b''.join(self.__frames)
+            self.__frames.clear()
+            self.__write_event.clear()
         return payload
 
@@ -0,0 +1,245 @@
+import logging
+import os
+import tempfile
+import time
+from collections import deque, namedtuple
+from threading import Condition, Lock
+from . import byte_writer
+from ...util.shutdown import TerminableThread
+
+DEFAULT_MAX_QUEUE_BYTES = 8*1024*1024  # 8 MB
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+WAIT_TIME = 0.5  # Time between shutdown checks while the queue is empty
+
+# A queued write. Spilled chunks have no buffers; their bytes are in the spill
+# file at spill_offset.
+QueuedChunk = namedtuple('QueuedChunk', 'buffers spill_offset length flush close queued_time')
+
+
+class QueuedWriter(byte_writer.ByteWriter):
+    """
+    A ByteWriter that hands everything appended to it to another ByteWriter
+    on a worker thread. Wrapping each destination's writer gives every
+    destination its own queue, so a slow upload can't delay the other
+    destinations or the reads from the camera stream.
+
+    The queue holds at most ``max_queue_bytes`` in memory. When it's full,
+    ``overflow_policy`` decides what happens to a new chunk:
+    - ``block`` waits until the worker catches up.
+    - ``drop_oldest`` discards the oldest queued chunks to make room.
+    - ``spill`` writes the chunk to a temporary file. It is read back in
+      order once the worker reaches it.
+    """
+
+    def __init__(self, writer, name, overflow_policy=OVERFLOW_BLOCK,
+                 max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES, spill_dir=None):
+        """
+        :param writer: The ByteWriter that receives the bytes.
+        :param name: Used for log statements.
+        :param overflow_policy: One of ``OVERFLOW_POLICIES``.
+        :param max_queue_bytes: The number of bytes that can be queued in
+        memory.
+        :param spill_dir: The directory of the spill file. ``None`` uses the
+        system's temporary directory.
+        """
+        super(QueuedWriter, self).__init__(writer.full_path)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy "%s".' % overflow_policy)
+        self.writer = writer
+        self.logger = logging.getLogger(__name__ + '.' + name)
+        self.__overflow_policy = overflow_policy
+        self.__max_queue_bytes = max_queue_bytes
+        self.__spill_dir = spill_dir
+        self.__spill_file = None
+        self.__spill_end = 0
+        self.__condition = Condition(Lock())
+        self.__chunks = deque()
+        self.__queued_bytes = 0  # Bytes held in memory
+        self.__spilled_bytes = 0  # Bytes waiting in the spill file
+        self.__spilled_chunks = 0
+        self.__dropped_chunks = 0
+        self.__dropped_bytes = 0
+        self.__max_lag = 0.0
+        self.__writing = False  # True while the worker writes the first chunk
+        self.__closed = False
+        self.__worker = QueuedWriterThread(self, name)
+        self.__worker.start()
+
+    def append_bytes(self, bts, close=False):
+        self.append_buffers([bts], close)
+
+    def append_buffers(self, buffers, close=False):
+        """
+        Queues the buffers. The buffers must not be modified afterwards, which
+        is true of the views a stream exports.
+        """
+        buffers = [b for b in buffers if len(b) > 0]
+        if len(buffers) == 0 and not close:
+            return
+        self.__enqueue(buffers, flush=False, close=close)
+
+    def flush(self):
+        self.__enqueue([], flush=True, close=False)
+
+    def is_finished_writing(self):
+        if self.__worker.is_alive():
+            return False
+        is_finished = getattr(self.writer, 'is_finished_writing', None)
+        return is_finished() if is_finished is not None else True
+
+    def metrics(self):
+        """
+        :return: A dict of the destination's lag: the bytes and chunks queued
+        in memory, the bytes spilled to disk, the chunks and bytes dropped,
+        the age in seconds of the oldest queued chunk and the largest age
+        seen.
+        """
+        with self.__condition:
+            lag = (time.time() - self.__chunks[0].queued_time) if len(self.__chunks) > 0 else 0.0
+            return dict(queued_bytes=self.__queued_bytes,
+                        queued_chunks=len(self.__chunks),
+                        spilled_bytes=self.__spilled_bytes,
+                        dropped_chunks=self.__dropped_chunks,
+                        dropped_bytes=self.__dropped_bytes,
+                        lag_sec=lag,
+                        max_lag_sec=max(self.__max_lag, lag))
+
+    def __enqueue(self, buffers, flush, close):
+        length = sum(len(b) for b in buffers)
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = close
+            chunk = QueuedChunk(buffers=buffers, spill_offset=None, length=length,
+                                flush=flush, close=close, queued_time=time.time())
+            if length > 0 and not self.__fits(length):
+                if self.__overflow_policy == OVERFLOW_BLOCK:
+                    self.__condition.wait_for(lambda: self.__fits(length))
+                elif self.__overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self.__drop_oldest(length)
+                else:
+                    chunk = self.__spill(chunk)
+            if chunk.spill_offset is None:
+                self.__queued_bytes += length
+            self.__chunks.append(chunk)
+            self.__condition.notify_all()
+
+    def __fits(self, length):
+        # A chunk larger than the queue, like a stream's backlog, is accepted
+        # once the queue is empty.
+        return self.__queued_bytes == 0 or self.__queued_bytes + length <= self.__max_queue_bytes
+
+    def __drop_oldest(self, length):
+        kept = deque()
+        while len(self.__chunks) > 0 and not self.__fits(length):
+            chunk = self.__chunks.popleft()
+            if (len(kept) == 0 and self.__writing) or chunk.length == 0 or chunk.close or chunk.spill_offset is not None:
+                # Markers and the chunk being written are never dropped.
+                kept.append(chunk)
+                continue
+            self.__queued_bytes -= chunk.length
+            self.__dropped_chunks += 1
+            self.__dropped_bytes += chunk.length
+        self.__chunks.extendleft(reversed(kept))
+        self.logger.warning('Queue full. Dropped %d chunks so far.' % self.__dropped_chunks)
+
+    def __spill(self, chunk):
+        """
+        Writes the chunk's bytes to the end of the spill file.
+
+        :return: The chunk to queue in place of the original.
+        """
+        if self.__spill_file is None:
+            self.__spill_file = tempfile.TemporaryFile(dir=self.__spill_dir)
+            self.__spill_end = 0
+        offset = self.__spill_end
+        for buffer in chunk.buffers:
+            self.__spill_end += os.pwrite(self.__spill_file.fileno(), buffer, self.__spill_end)
+        self.__spilled_bytes += chunk.length
+        self.__spilled_chunks += 1
+        return chunk._replace(buffers=None, spill_offset=offset)
+
+    def next_chunk(self, timeout):
+        """
+        Called by the worker. Waits for the next chunk and reads it back from
+        the spill file if needed.
+
+        :return: A tuple of the QueuedChunk and its buffers, or ``None`` if the
+        timeout expired.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: len(self.__chunks) > 0, timeout):
+                return None
+            chunk = self.__chunks[0]
+            self.__writing = True
+            self.__max_lag = max(self.__max_lag, time.time() - chunk.queued_time)
+            if chunk.spill_offset is None:
+                return chunk, chunk.buffers
+            spill_fd = self.__spill_file.fileno()
+        # The spilled range is never rewritten until it's consumed.
+        return chunk, [os.pread(spill_fd, chunk.length, chunk.spill_offset)]
+
+    def chunk_written(self, chunk):
+        """
+        Called by the worker after the chunk at the front of the queue was
+        handed to the writer.
+        """
+        with self.__condition:
+            self.__chunks.popleft()
+            self.__writing = False
+            if chunk.spill_offset is None:
+                self.__queued_bytes -= chunk.length
+            else:
+                self.__spilled_bytes -= chunk.length
+                self.__spilled_chunks -= 1
+                if self.__spilled_chunks == 0:
+                    self.__spill_file.truncate(0)  # Reuse the file from the start
+                    self.__spill_end = 0
+            self.__condition.notify_all()
+
+    def worker_stopped(self):
+        with self.__condition:
+            if self.__spill_file is not None:
+                self.__spill_file.close()
+                self.__spill_file = None
+        self.logger.debug('Queue stopped. Metrics: %s' % self.metrics())
+
+
+class QueuedWriterThread(TerminableThread):
+    """
+    A threaded class that passes the chunks queued in a ``QueuedWriter`` to
+    its writer until the writer is closed.
+    """
+
+    def __init__(self, queued_writer, name):
+        super(QueuedWriterThread, self).__init__()
+        self.name = 'QueuedWriter.' + name
+        self.logger = logging.getLogger(__name__ + '.' + name)
+        self.__queued_writer = queued_writer
+
+    def run(self):
+        writer = self.__queued_writer.writer
+        try:
+            closed = False
+            while not closed:
+                result = self.__queued_writer.next_chunk(WAIT_TIME)
+                if result is None:
+                    if not self.should_run:
+                        self.logger.debug('Thread stopped.')
+                        break
+                    continue
+                chunk, buffers = result
+                try:
+                    if chunk.flush:
+                        writer.flush()
+                    else:
+                        writer.append_buffers(buffers, chunk.close)
+                except Exception as e:
+                    self.logger.exception('An exception occurred writing %d bytes: %s' % (chunk.length, e))
+                self.__queued_writer.chunk_written(chunk)
+                closed = chunk.close
+        finally:
+            self.__queued_writer.worker_stopped()
@@ -0,0 +1,198 @@
+import logging
+import time
+from collections import deque
+from threading import Lock
+
+MIN_CHUNK_SIZE = 64*1024  # 64 KB
+MAX_CHUNK_SIZE = 8*1024*1024  # 8 MB
+TARGET_REQUEST_TIME = 2.0  # In seconds
+LATENCY_FACTOR = 4  # A request's transfer time is kept this many times its latency
+SMALL_REQUEST_SIZE = 16*1024  # Requests this small measure the latency
+SMOOTHING = 0.3  # The weight of a new measurement
+RATE_WINDOW = 10.0  # In seconds
+
+
+class TokenBucket:
+    """
+    Limits a byte rate shared by any number of threads. ``consume()`` takes
+    tokens for the bytes about to be sent and waits until the bucket is no
+    longer in debt, so a request larger than the burst is allowed but the
+    following requests wait for it.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: The rate in bytes per second.
+        :param burst: The bytes that can be sent at once after a pause.
+        Defaults to one second at ``rate``.
+        """
+        self.__rate = rate
+        self.__burst = burst if burst is not None else rate
+        self.__tokens = self.__burst
+        self.__last_time = time.monotonic()
+        self.__lock = Lock()
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def consume(self, byte_count):
+        """
+        :return: The number of seconds waited.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__last_time) * self.__rate)
+            self.__last_time = now
+            self.__tokens -= byte_count
+            wait_time = max(0, -self.__tokens / self.__rate)
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+
+class UploadMonitor:
+    """
+    Measures the uploads of one destination and optionally limits them to
+    ``rate_limit`` bytes per second with a TokenBucket shared by all of its
+    uploads. Clients returned by ``client()`` are limited and measured.
+
+    The measurements give the latency of a request, from the small ones, and
+    the bandwidth, from the rest. When ``adaptive`` is set, ``chunk_size()``
+    sizes chunks to take about ``TARGET_REQUEST_TIME`` to send at the
+    bandwidth or the rate limit, whichever is lower, and at least
+    ``LATENCY_FACTOR`` times the latency.
+    """
+
+    def __init__(self, rate_limit=0, adaptive=True, min_chunk_size=MIN_CHUNK_SIZE, max_chunk_size=MAX_CHUNK_SIZE):
+        """
+        :param rate_limit: The maximum rate in bytes per second. 0 doesn't
+        limit the rate.
+        :param adaptive: If False, ``chunk_size()`` keeps the configured size.
+        :param min_chunk_size: The smallest adaptive chunk size.
+        :param max_chunk_size: The largest adaptive chunk size.
+        """
+        self.__bucket = TokenBucket(rate_limit) if rate_limit > 0 else None
+        self.__adaptive = adaptive
+        self.__min_chunk_size = min_chunk_size
+        self.__max_chunk_size = max_chunk_size
+        self.__lock = Lock()
+        self.__latency = None
+        self.__bandwidth = None
+        self.__throttled_time = 0.0
+        self.__uploads = deque()  # Times and sizes of the recent uploads
+        self.__backlog_bytes = 0
+        self.__chunk_size = None
+
+    @property
+    def rate_limit(self):
+        return self.__bucket.rate if self.__bucket is not None else 0
+
+    def client(self, dbx):
+        """
+        :return: A client that passes the uploads of ``dbx`` through this
+        monitor.
+        """
+        return MonitoredClient(dbx, self)
+
+    def upload(self, byte_count, request):
+        """
+        Waits for the rate limit, then runs and measures the request.
+
+        :param request: A callable that sends ``byte_count`` bytes.
+        :return: The request's result.
+        """
+        if self.__bucket is not None:
+            waited = self.__bucket.consume(byte_count)
+            with self.__lock:
+                self.__throttled_time += waited
+        start_time = time.monotonic()
+        result = request()
+        self.__record(byte_count, time.monotonic() - start_time)
+        return result
+
+    def queued(self, byte_count):
+        """
+        Adds to the bytes waiting for an upload. Negative counts remove them.
+        """
+        with self.__lock:
+            self.__backlog_bytes += byte_count
+
+    def chunk_size(self, configured_size):
+        """
+        :return: The size of the next chunk. The configured size is kept until
+        the bandwidth is measured.
+        """
+        with self.__lock:
+            if not self.__adaptive or self.__bandwidth is None:
+                return configured_size
+            rate = self.__bandwidth
+            if self.__bucket is not None:
+                rate = min(rate, self.__bucket.rate)
+            request_time = max(TARGET_REQUEST_TIME, LATENCY_FACTOR * (self.__latency or 0))
+            size = int(rate * request_time) // MIN_CHUNK_SIZE * MIN_CHUNK_SIZE
+            self.__chunk_size = max(self.__min_chunk_size, min(self.__max_chunk_size, size))
+            return self.__chunk_size
+
+    def metrics(self):
+        """
+        :return: A dict of the rate limit, the rate achieved over the last
+        ``RATE_WINDOW`` seconds, the measured bandwidth and latency, the time
+        spent waiting for the rate limit, the bytes waiting for an upload and
+        the last adaptive chunk size. All rates are in bytes per second.
+        """
+        with self.__lock:
+            self.__trim_uploads(time.monotonic())
+            return dict(rate_limit=self.rate_limit,
+                        achieved_rate=sum(size for _, size in self.__uploads) / RATE_WINDOW,
+                        bandwidth=self.__bandwidth,
+                        latency_sec=self.__latency,
+                        throttled_sec=self.__throttled_time,
+                        backlog_bytes=self.__backlog_bytes,
+                        chunk_size=self.__chunk_size)
+
+    def __record(self, byte_count, duration):
+        with self.__lock:
+            now = time.monotonic()
+            self.__uploads.append((now, byte_count))
+            self.__trim_uploads(now)
+            if byte_count <= SMALL_REQUEST_SIZE:
+                self.__latency = self.__smooth(self.__latency, duration)
+                return
+            transfer_time = max(duration - (self.__latency or 0), duration / 10)
+            self.__bandwidth = self.__smooth(self.__bandwidth, byte_count / transfer_time)
+        logging.getLogger(__name__).debug('Uploaded %d bytes in %.2f sec.' % (byte_count, duration))
+
+    def __trim_uploads(self, now):
+        while len(self.__uploads) > 0 and self.__uploads[0][0] < now - RATE_WINDOW:
+            self.__uploads.popleft()
+
+    @staticmethod
+    def __smooth(average, value):
+        return value if average is None else average + SMOOTHING * (value - average)
+
+
+class MonitoredClient:
+    """
+    Wraps a Dropbox client so its uploads go through an UploadMonitor. Other
+    calls are passed to the client.
+    """
+
+    def __init__(self, dbx, monitor):
+        self.__dbx = dbx
+        self.__monitor = monitor
+
+    def __getattr__(self, name):
+        return getattr(self.__dbx, name)
+
+    def files_upload(self, f, path):
+        return self.__monitor.upload(len(f), lambda: self.__dbx.files_upload(f, path))
+
+    def files_upload_session_start(self, f):
+        return self.__monitor.upload(len(f), lambda: self.__dbx.files_upload_session_start(f))
+
+    def files_upload_session_append_v2(self, f, cursor):
+        return self.__monitor.upload(len(f), lambda: self.__dbx.files_upload_session_append_v2(f, cursor))
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        return self.__monitor.upload(len(f), lambda: self.__dbx.files_upload_session_finish(f, cursor, commit))
@@ -0,0 +1,167 @@
+import dropbox
+import logging
+import queue
+from collections import deque
+from threading import Lock
+from ...util.shutdown import TerminableThread
+
+WORKER_COUNT = 4
+MAX_CONNECTIONS = 8  # Pooled HTTP connections per Dropbox client
+PRIORITY_TRIGGER = 0  # Trigger JPEGs are uploaded first
+PRIORITY_VIDEO = 10
+WAIT_TIME = 0.5  # Time between shutdown checks while the queue is empty
+
+
+class UploadService:
+    """
+    A process-wide service that performs Dropbox uploads for every
+    DropboxWriter. It keeps one long-lived Dropbox client per token, whose
+    pooled HTTP session reuses its connections across events, and a fixed
+    pool of worker threads, so bursts of events don't create more threads.
+
+    Tasks are run in priority order, lowest first, and in submission order
+    within a priority. Tasks submitted with the same ``lane`` never run at the
+    same time and always run in submission order, which upload sessions need.
+    """
+
+    __shared = None
+    __shared_lock = Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        :return: The UploadService used by all DropboxWriter instances.
+        """
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = UploadService()
+            return cls.__shared
+
+    def __init__(self, worker_count=WORKER_COUNT):
+        self.__lock = Lock()
+        self.__clients = {}
+        self.__queue = queue.PriorityQueue()
+        self.__sequence = 0
+        self.__lanes = {}  # Busy lanes and their waiting tasks
+        self.__running = 0
+        self.__workers = []
+        for i in range(worker_count):
+            worker = UploadWorker(self, i)
+            self.__workers.append(worker)
+            worker.start()
+
+    @property
+    def worker_count(self):
+        return len(self.__workers)
+
+    @property
+    def pending_count(self):
+        """
+        :return: The number of tasks waiting to run.
+        """
+        with self.__lock:
+            return self.__queue.qsize() + sum(len(waiting) for waiting in self.__lanes.values())
+
+    @property
+    def idle(self):
+        """
+        :return: True if no task is running or waiting to run.
+        """
+        with self.__lock:
+            return self.__running == 0 and self.__queue.qsize() == 0
+
+    def client(self, token):
+        """
+        :return: The shared Dropbox client for the token.
+        """
+        with self.__lock:
+            dbx = self.__clients.get(token)
+            if dbx is None:
+                dbx = dropbox.Dropbox(token, session=dropbox.create_session(max_connections=MAX_CONNECTIONS))
+                self.__clients[token] = dbx
+            return dbx
+
+    def warm_up(self, token):
+        """
+        Opens a connection for the token's client ahead of the first upload.
+        """
+        def connect():
+            self.client(token).users_get_current_account()
+            logging.getLogger(__name__).debug('Dropbox connection ready.')
+        self.submit(connect, PRIORITY_VIDEO)
+
+    def submit(self, task, priority, lane=None):
+        """
+        Queues a task for a worker.
+
+        :param task: A callable taking no arguments.
+        :param priority: ``PRIORITY_TRIGGER``, ``PRIORITY_VIDEO`` or any other
+        number. Lower numbers run first.
+        :param lane: An optional hashable key. See the class description.
+        """
+        with self.__lock:
+            self.__sequence += 1
+            item = (priority, self.__sequence, task, lane)
+            if lane is not None:
+                waiting = self.__lanes.get(lane)
+                if waiting is not None:
+                    waiting.append(item)  # Runs after the lane's current task
+                    return
+                self.__lanes[lane] = deque()
+            self.__queue.put(item)
+
+    def next_task(self, timeout):
+        """
+        Called by the workers.
+
+        :return: A tuple of the task and its lane, or ``None`` if the timeout
+        expired.
+        """
+        try:
+            _, _, task, lane = self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.__lock:
+            self.__running += 1
+        return task, lane
+
+    def task_done(self, lane):
+        """
+        Called by the workers after a task ran. Queues the lane's next task.
+        """
+        with self.__lock:
+            self.__running -= 1
+            if lane is None:
+                return
+            waiting = self.__lanes[lane]
+            if len(waiting) > 0:
+                self.__queue.put(waiting.popleft())
+            else:
+                del self.__lanes[lane]
+
+
+class UploadWorker(TerminableThread):
+    """
+    A threaded class that runs the tasks of an UploadService.
+    """
+
+    def __init__(self, service, number):
+        super(UploadWorker, self).__init__()
+        self.name = 'UploadWorker%i' % number
+        self.daemon = True
+        self.logger = logging.getLogger('%s.%i' % (__name__, number))
+        self.__service = service
+
+    def run(self):
+        while self.should_run:
+            result = self.__service.next_task(WAIT_TIME)
+            if result is None:
+                continue
+            task, lane = result
+            try:
+                task()
+            except Exception as e:
+                self.logger.exception('An exception occurred: %s' % e)
+            finally:
+                self.__service.task_done(lane)
+        self.logger.debug('Thread stopped.')
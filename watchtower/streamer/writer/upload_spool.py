@@ -0,0 +1,327 @@
+import dropbox
+import dropbox.exceptions
+import json
+import logging
+import os
+import requests.exceptions
+import time
+from collections import namedtuple
+from threading import Condition, Lock
+from .upload_service import UploadService
+from ...util.shutdown import TerminableThread
+
+DEFAULT_MAX_BYTES = 512*1024*1024  # 512 MB
+MIN_BACKOFF = 1.0  # In seconds
+MAX_BACKOFF = 300.0  # In seconds
+MAX_ATTEMPTS = 5  # Failed uploads of an entry before it's discarded
+JOURNAL_NAME = 'journal.log'
+CHUNK_EXTENSION = '.chunk'
+WAIT_TIME = 0.5  # Time between checks while there's nothing to drain
+
+# Failures of the uplink or of Dropbox itself, which affect every entry.
+UPLINK_ERRORS = (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                 dropbox.exceptions.InternalServerError, dropbox.exceptions.RateLimitError)
+# Failures that retrying the entry won't fix. A missing chunk file was evicted
+# while it was uploaded.
+PERMANENT_ERRORS = (dropbox.exceptions.ApiError, dropbox.exceptions.BadInputError, FileNotFoundError)
+
+# A pending upload. Chunks are uploaded to path. Session commits have no data
+# and finish the upload session at path instead.
+SpoolEntry = namedtuple('SpoolEntry', 'id path priority event_time size session_id offset')
+
+
+class UploadSpool:
+    """
+    A persistent directory of uploads that failed. Each pending chunk is
+    stored in its own file, and a journal of added and finished entries lets
+    the spool be rebuilt after a restart.
+
+    A worker thread retries the uploads whenever the UploadService is idle,
+    so the spool drains with the bandwidth the live uploads don't use. The
+    highest priority entries are uploaded first, and the newest events first
+    within a priority. After a failure of the uplink, like a connection
+    error or a server error, the whole spool waits, doubling the wait after
+    each failure up to ``max_backoff``. Uploads that Dropbox rejects are
+    discarded. An entry that fails for any other reason is retried after the
+    other entries of its priority, and discarded after ``max_attempts``
+    failures, so it can't hold up the rest of the spool.
+
+    The stored bytes are limited to ``max_bytes``. When a new chunk doesn't
+    fit, the lowest priority, oldest entries are removed to make room.
+    """
+
+    def __init__(self, directory, dbx, max_bytes=DEFAULT_MAX_BYTES, upload_service=None,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF, max_attempts=MAX_ATTEMPTS):
+        """
+        :param directory: The spool directory. It's created if needed.
+        :param dbx: The Dropbox client, or an object with the same upload
+        methods, used to drain the spool.
+        :param max_bytes: The maximum number of stored bytes.
+        :param upload_service: The service whose idle time is used for
+        draining. Defaults to the shared service.
+        :param min_backoff: The wait in seconds after the first failure.
+        :param max_backoff: The longest wait in seconds between retries.
+        :param max_attempts: The number of failures, other than those of the
+        uplink, after which an entry is discarded.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.__directory = directory
+        self.__dbx = dbx
+        self.__max_bytes = max_bytes
+        self.__service = upload_service if upload_service is not None else UploadService.shared()
+        self.__min_backoff = min_backoff
+        self.__max_backoff = max_backoff
+        self.__max_attempts = max_attempts
+        self.__attempts = {}  # Failed attempts of the entries by ID
+        self.__backoff = 0
+        self.__resume_time = 0
+        self.__condition = Condition(Lock())
+        self.__entries = {}
+        self.__size = 0
+        self.__next_id = 0
+        self.__uploaded = 0
+        self.__failures = 0
+        self.__evicted = 0
+        self.__discarded = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__load()
+        self.__worker = SpoolDrainThread(self)
+        self.__worker.start()
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    def metrics(self):
+        """
+        :return: A dict of the pending entries and bytes and the number of
+        uploads, failures, evicted entries and entries discarded after
+        failing.
+        """
+        with self.__condition:
+            return dict(entries=len(self.__entries),
+                        bytes=self.__size,
+                        uploaded=self.__uploaded,
+                        failures=self.__failures,
+                        evicted=self.__evicted,
+                        discarded=self.__discarded,
+                        backoff_sec=self.__backoff)
+
+    def add(self, path, bts, priority, event_time):
+        """
+        Stores a chunk to upload to ``path``.
+
+        :return: False if the chunk didn't fit in the quota.
+        """
+        return self.__add(path, bts, priority, event_time, session_id=None, offset=0)
+
+    def add_commit(self, path, session_id, offset, priority, event_time):
+        """
+        Stores the commit of an upload session whose finish call failed.
+        """
+        return self.__add(path, b'', priority, event_time, session_id=session_id, offset=offset)
+
+    def close(self):
+        self.__worker.stop()
+        with self.__condition:
+            self.__condition.notify_all()
+        self.__worker.join()
+
+    def __add(self, path, bts, priority, event_time, session_id, offset):
+        with self.__condition:
+            entry = SpoolEntry(id=self.__next_id, path=path, priority=priority, event_time=event_time,
+                               size=len(bts), session_id=session_id, offset=offset)
+            self.__next_id += 1
+            if not self.__make_room(entry):
+                self.__evicted += 1
+                self.logger.warning('Spool full. Discarded upload to "%s".' % path)
+                return False
+            if entry.size > 0:
+                self.__write_file(self.__chunk_path(entry.id), bts)
+            self.__append_journal(dict(op='add', **entry._asdict()))
+            self.__entries[entry.id] = entry
+            self.__size += entry.size
+            self.__condition.notify_all()
+        self.logger.debug('Spooled %d bytes for "%s".' % (entry.size, path))
+        return True
+
+    def __make_room(self, entry):
+        """
+        Evicts the least important entries until ``entry`` fits.
+
+        :return: False if ``entry`` is itself the least important.
+        """
+        if self.__size + entry.size <= self.__max_bytes:
+            return True
+        # Video before triggers, then the oldest events first.
+        candidates = sorted(list(self.__entries.values()) + [entry],
+                            key=lambda e: (-e.priority, e.event_time, e.id))
+        size = self.__size + entry.size
+        for candidate in candidates:
+            if size <= self.__max_bytes:
+                break
+            if candidate is entry:
+                return False
+            if candidate.size == 0:
+                continue
+            size -= candidate.size
+            self.__remove(candidate)
+            self.__evicted += 1
+            self.logger.warning('Spool full. Evicted upload to "%s".' % candidate.path)
+        return True
+
+    def __remove(self, entry):
+        self.__append_journal(dict(op='done', id=entry.id))
+        del self.__entries[entry.id]
+        self.__attempts.pop(entry.id, None)
+        self.__size -= entry.size
+        if entry.size > 0:
+            try:
+                os.remove(self.__chunk_path(entry.id))
+            except FileNotFoundError:
+                pass
+        if len(self.__entries) == 0:
+            self.__rewrite_journal()  # Keeps the journal from growing forever
+
+    def drain_once(self):
+        """
+        Called by the worker. Uploads the next entry if the uplink isn't
+        backing off and the UploadService is idle.
+
+        :return: True if an entry was uploaded.
+        """
+        with self.__condition:
+            if len(self.__entries) == 0 or time.time() < self.__resume_time:
+                return False
+            entry = min(self.__entries.values(),
+                        key=lambda e: (e.priority, self.__attempts.get(e.id, 0), -e.event_time, e.id))
+        if not self.__service.idle:
+            return False
+        try:
+            self.__upload(entry)
+        except UPLINK_ERRORS as e:
+            with self.__condition:
+                self.__failures += 1
+                self.__backoff = min(self.__max_backoff, max(self.__min_backoff, self.__backoff * 2))
+                self.__resume_time = time.time() + self.__backoff
+            self.logger.warning('Spooled upload to "%s" failed. Retrying in %.1f sec: %s' % (entry.path, self.__backoff, e))
+            return False
+        except Exception as e:
+            with self.__condition:
+                self.__failures += 1
+                attempts = self.__attempts.get(entry.id, 0) + 1
+                discard = isinstance(e, PERMANENT_ERRORS) or attempts >= self.__max_attempts
+                if entry.id in self.__entries:
+                    if discard:
+                        self.__remove(entry)
+                        self.__discarded += 1
+                    else:
+                        self.__attempts[entry.id] = attempts
+            if discard:
+                self.logger.error('Discarded spooled upload to "%s" after %d attempts: %s' % (entry.path, attempts, e))
+            else:
+                self.logger.warning('Spooled upload to "%s" failed. Retrying it later: %s' % (entry.path, e))
+            return False
+        with self.__condition:
+            self.__uploaded += 1
+            self.__backoff = 0
+            if entry.id in self.__entries:
+                self.__remove(entry)
+        self.logger.debug('Uploaded spooled "%s".' % entry.path)
+        return True
+
+    def wait(self, timeout):
+        """
+        Called by the worker. Waits until an entry is added, the backoff
+        expires or the timeout expires.
+        """
+        with self.__condition:
+            backoff_left = self.__resume_time - time.time()
+            if len(self.__entries) > 0 and backoff_left > 0:
+                timeout = min(timeout, backoff_left)
+            self.__condition.wait(timeout)
+
+    def __upload(self, entry):
+        if entry.session_id is None:
+            with open(self.__chunk_path(entry.id), 'rb') as f:
+                bts = f.read()
+            self.__dbx.files_upload(bts, entry.path)
+        else:
+            cursor = dropbox.files.UploadSessionCursor(session_id=entry.session_id, offset=entry.offset)
+            self.__dbx.files_upload_session_finish(b'', cursor, dropbox.files.CommitInfo(path=entry.path))
+
+    def __chunk_path(self, entry_id):
+        return os.path.join(self.__directory, str(entry_id) + CHUNK_EXTENSION)
+
+    def __write_file(self, path, bts):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(bts)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def __append_journal(self, record):
+        with open(os.path.join(self.__directory, JOURNAL_NAME), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __rewrite_journal(self):
+        lines = ''.join(json.dumps(dict(op='add', **e._asdict())) + '\n' for e in self.__entries.values())
+        self.__write_file(os.path.join(self.__directory, JOURNAL_NAME), lines.encode())
+
+    def __load(self):
+        """
+        Rebuilds the entries from the journal and removes the chunk files that
+        don't belong to an entry.
+        """
+        journal_path = os.path.join(self.__directory, JOURNAL_NAME)
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # A partial line from an interrupted write
+                    op = record.pop('op')
+                    if op == 'add':
+                        self.__entries[record['id']] = SpoolEntry(**record)
+                    else:
+                        self.__entries.pop(record['id'], None)
+                    self.__next_id = max(self.__next_id, record['id'] + 1)
+        for entry in list(self.__entries.values()):
+            if entry.size > 0 and not os.path.exists(self.__chunk_path(entry.id)):
+                del self.__entries[entry.id]
+        for name in os.listdir(self.__directory):
+            if name.endswith(CHUNK_EXTENSION) or name.endswith('.tmp'):
+                entry_id = name.split('.')[0]
+                if name.endswith('.tmp') or not entry_id.isdigit() or int(entry_id) not in self.__entries:
+                    os.remove(os.path.join(self.__directory, name))
+        self.__size = sum(e.size for e in self.__entries.values())
+        self.__rewrite_journal()
+        if len(self.__entries) > 0:
+            self.logger.info('Loaded %d spooled uploads (%d bytes).' % (len(self.__entries), self.__size))
+
+
+class SpoolDrainThread(TerminableThread):
+    """
+    A threaded class that uploads the entries of an UploadSpool.
+    """
+
+    def __init__(self, spool):
+        super(SpoolDrainThread, self).__init__()
+        self.name = 'SpoolDrainThread'
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.__spool = spool
+        self.__stopped = False
+
+    def stop(self):
+        self.__stopped = True
+
+    def run(self):
+        while self.should_run and not self.__stopped:
+            if not self.__spool.drain_once():
+                self.__spool.wait(WAIT_TIME)
+        self.logger.debug('Thread stopped.')
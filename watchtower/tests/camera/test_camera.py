@@ -6,6 +6,7 @@ terminated before running these.
 import json
 import os
 import pytest
+import threading
 from watchtower.camera import SafeCamera
 
 def test_bad_config():
@@ -139,6 +140,33 @@ def test_updating_config_params_saves_to_disk(tmp_config_path, sample_config_pat
     for update_key, update_value in updates.items():
         assert(saved_data[update_key] == update_value)
 
+def test_wait_for_frame(tmp_config_path):
+    """
+    Tests that `wait_for_frame()` returns published frames in sequence order,
+    wakes when a new frame is published, and times out without one.
+    """
+    camera = SafeCamera(name ="Test Camera",
+                        resolution=(640, 480),
+                        framerate=15,
+                        config_path=tmp_config_path)
+
+    assert(camera.wait_for_frame(after_seq=0, timeout=0.1) is None)
+
+    first = camera.publish_frame(b'first')
+    assert(camera.wait_for_frame(after_seq=0, timeout=0.1) == first)
+    assert(camera.wait_for_frame(after_seq=first.sequence, timeout=0.1) is None)
+
+    publisher = threading.Timer(0.1, lambda: camera.publish_frame(b'second'))
+    publisher.start()
+    second = camera.wait_for_frame(after_seq=first.sequence, timeout=5)
+    publisher.join()
+    camera.close()
+
+    assert(second.data == b'second')
+    assert(second.sequence == first.sequence + 1)
+    assert(second.timestamp >= first.timestamp)
+    assert(camera.jpeg_data == b'second')
+
 # ---- Fixtures
 
 @pytest.fixture
@@ -1,6 +1,9 @@
 import os
 import pytest
 import sys
+import time
+from collections import namedtuple
+from threading import Condition, Lock
 
 test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 watchtower_path = os.path.dirname(os.path.realpath(__file__))
@@ -22,3 +25,100 @@ def test_data_path():
 @pytest.fixture(scope="session")
 def installation_path():
     return watchtower_path
+
+@pytest.fixture(scope="function")
+def mock_camera():
+    return MockCamera()
+
+@pytest.fixture(scope="function")
+def fake_dropbox():
+    return FakeDropbox()
+
+# ---- Mock objects
+
+Frame = namedtuple('Frame', 'sequence timestamp data')
+
+class MockCamera:
+    """
+    Implements the frame publishing interface of SafeCamera without requiring
+    camera hardware.
+    """
+    def __init__(self):
+        self.should_monitor = True
+        self.__condition = Condition()
+        self.__frame = Frame(0, 0, b'')
+
+    def publish_frame(self, data):
+        with self.__condition:
+            self.__frame = Frame(self.__frame.sequence + 1, time.time(), data)
+            self.__condition.notify_all()
+            return self.__frame
+
+    def latest_frame(self):
+        with self.__condition:
+            return self.__frame
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        with self.__condition:
+            if self.__condition.wait_for(lambda: self.__frame.sequence > after_seq, timeout):
+                return self.__frame
+            return None
+
+
+class FakeDropbox:
+    """
+    A local stand-in for the Dropbox client that implements ``files_upload``
+    and the upload session calls. Uploaded files are kept in ``files`` and
+    every call is counted in ``request_count``. ``latency`` seconds are slept
+    per request to approximate a network round trip when benchmarking. While
+    ``failing`` is True, every request raises a ConnectionError, like during
+    an uplink outage.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.failing = False
+        self.failed_count = 0
+        self.files = {}
+        self.request_count = 0
+        self.uploaded_bytes = 0
+        self.__sessions = {}
+        self.__session_count = 0
+        self.__lock = Lock()
+
+    def __request(self, f):
+        time.sleep(self.latency)
+        with self.__lock:
+            if self.failing:
+                self.failed_count += 1
+                raise ConnectionError('Uplink is down.')
+            self.request_count += 1
+            self.uploaded_bytes += len(f)
+
+    def files_upload(self, f, path):
+        self.__request(f)
+        with self.__lock:
+            self.files[path] = bytes(f)
+
+    def files_upload_session_start(self, f):
+        self.__request(f)
+        with self.__lock:
+            session_id = str(self.__session_count)
+            self.__session_count += 1
+            self.__sessions[session_id] = bytearray(f)
+        return FakeSessionStartResult(session_id)
+
+    def files_upload_session_append_v2(self, f, cursor):
+        self.__request(f)
+        with self.__lock:
+            data = self.__sessions[cursor.session_id]
+            if cursor.offset != len(data):
+                raise ValueError('Incorrect offset %d. Expected %d.' % (cursor.offset, len(data)))
+            data += f
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        self.files_upload_session_append_v2(f, cursor)
+        with self.__lock:
+            self.files[commit.path] = bytes(self.__sessions.pop(cursor.session_id))
+
+
+FakeSessionStartResult = namedtuple('FakeSessionStartResult', 'session_id')
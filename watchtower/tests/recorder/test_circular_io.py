@@ -0,0 +1,103 @@
+import pytest
+import random
+from collections import namedtuple
+from watchtower.recorder.circular_io import IndexedCircularIO
+from watchtower.streamer.frame_index import KEY_FRAME, SPS_HEADER
+
+BUFFER_SIZE = 4096
+FRAME_SIZE = 300
+
+
+def test_segments(stream, camera):
+    """
+    Ensures ranges near either end of the buffer, which are walked from
+    different ends, cover the same bytes.
+    """
+    data = write_frames(stream, camera, 40)[-BUFFER_SIZE:]
+    ranges = [(0, BUFFER_SIZE), (0, 10), (BUFFER_SIZE - 10, 10), (BUFFER_SIZE, 0), (5, 0)]
+    ranges += [random_range(BUFFER_SIZE) for _ in range(1000)]
+    for position, length in ranges:
+        segments = stream.segments(position, length)
+        assert(all(isinstance(segment, memoryview) for segment in segments))
+        assert(b''.join(segments) == data[position:position + length])
+
+def test_segments_of_tail(stream, camera):
+    data = write_frames(stream, camera, 40)
+    assert(b''.join(stream.segments(BUFFER_SIZE - FRAME_SIZE, FRAME_SIZE)) == data[-FRAME_SIZE:])
+
+def test_segments_from_middle_to_newest(stream, camera):
+    data = write_frames(stream, camera, 40)
+    position = BUFFER_SIZE // 2 - 7
+    segments = stream.segments(position, BUFFER_SIZE - position)
+    assert(len(segments) > 1)
+    assert(b''.join(segments) == data[stream.start_offset + position:])
+
+def test_caches_newest_headers(stream, camera):
+    """
+    Ensures an SPS header written after the buffer wrapped around, which is
+    read from the newest chunks, is cached.
+    """
+    frame_types = [SPS_HEADER, KEY_FRAME] + [0]*30 + [SPS_HEADER, KEY_FRAME]
+    data = write_frames(stream, camera, len(frame_types), frame_types)
+    assert(stream.start_offset > 0)
+    assert(stream.headers == data[-2*FRAME_SIZE:-FRAME_SIZE])
+    header = stream.frame_index.last_of_type(SPS_HEADER, stream.frame_index.last().position)
+    assert(header.position == (len(frame_types) - 2)*FRAME_SIZE)
+
+# ---- Helpers
+
+def random_range(size):
+    position = random.randint(0, size)
+    return position, random.randint(0, size - position)
+
+def write_frames(stream, camera, count, frame_types=None):
+    """
+    Writes ``count`` frames of FRAME_SIZE bytes, each in several chunks like
+    the encoder does, with the frame only completed by its last chunk.
+    """
+    data = b''
+    for i in range(count):
+        frame_data = bytes(random.getrandbits(8) for _ in range(FRAME_SIZE))
+        chunk_start = 0
+        while chunk_start < FRAME_SIZE:
+            chunk_end = min(FRAME_SIZE, chunk_start + random.randint(1, FRAME_SIZE // 2))
+            camera.encoder.frame = MockFrame(index=i,
+                                             frame_type=frame_types[i] if frame_types else 0,
+                                             frame_size=FRAME_SIZE,
+                                             timestamp=i*1000000,
+                                             complete=chunk_end == FRAME_SIZE)
+            stream.write(frame_data[chunk_start:chunk_end])
+            chunk_start = chunk_end
+        data += frame_data
+    return data
+
+# ---- Fixtures
+
+@pytest.fixture
+def camera():
+    return MockCamera()
+
+@pytest.fixture
+def stream(camera):
+    return IndexedCircularIO(camera, size=BUFFER_SIZE, splitter_port=1)
+
+# ---- Mock objects
+
+MockFrame = namedtuple('MockFrame', 'index frame_type frame_size timestamp complete')
+
+
+class MockEncoder:
+
+    def __init__(self):
+        self.frame = None
+
+
+class MockCamera:
+    """
+    Provides the encoder frames a PiCameraCircularIO attaches to the chunks
+    it holds.
+    """
+
+    def __init__(self):
+        self.encoder = MockEncoder()
+        self._encoders = {1: self.encoder}
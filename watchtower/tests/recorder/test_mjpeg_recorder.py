@@ -0,0 +1,60 @@
+import pytest
+from watchtower.recorder import mjpeg
+from watchtower.recorder.mjpeg import MJPEGRecorder
+
+JPEG = b'\xff\xd8jpeg'
+
+
+def test_publishes_every_frame_without_rate(mock_camera):
+    recorder = MJPEGRecorder(mock_camera)
+    for _ in range(10):
+        recorder.write(JPEG)
+    assert(mock_camera.latest_frame().sequence == 10)
+
+def test_decimates_to_frame_rate(mock_camera, clock):
+    """
+    Simulates 3 seconds of a 30 fps encoder. Only 4 frames per second should
+    reach the camera.
+    """
+    recorder = MJPEGRecorder(mock_camera, frame_rate=4)
+    for _ in range(90):
+        recorder.write(JPEG)
+        clock.advance(1/30)
+    assert(mock_camera.latest_frame().sequence == 12)
+
+def test_raising_frame_rate_applies_immediately(mock_camera, clock):
+    recorder = MJPEGRecorder(mock_camera, frame_rate=1)
+    recorder.write(JPEG)
+    clock.advance(0.1)
+    recorder.write(JPEG)
+    assert(mock_camera.latest_frame().sequence == 1)
+
+    recorder.frame_rate = 10
+    recorder.write(JPEG)
+    assert(mock_camera.latest_frame().sequence == 2)
+    assert(recorder.frame_rate == 10)
+
+def test_ignores_partial_frames(mock_camera):
+    recorder = MJPEGRecorder(mock_camera)
+    recorder.write(b'not a jpeg start')
+    assert(mock_camera.latest_frame().sequence == 0)
+
+# ---- Fixtures
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = MockClock()
+    monkeypatch.setattr(mjpeg.time, 'time', clock.time)
+    return clock
+
+# ---- Mock objects
+
+class MockClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
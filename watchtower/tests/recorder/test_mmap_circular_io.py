@@ -0,0 +1,168 @@
+import pytest
+from collections import namedtuple
+from watchtower.recorder.mmap_circular_io import MmapCircularIO
+from watchtower.streamer.frame_index import KEY_FRAME, SPS_HEADER
+from watchtower.streamer.video_stream_saver import VideoStreamSaver
+
+BUFFER_SIZE = 4096
+FRAME_SIZE = 1000
+
+
+def test_wraps_around(stream, camera):
+    """
+    Ensures only the newest bytes are kept and frames whose start was
+    overwritten are dropped from the index.
+    """
+    data = write_frames(stream, camera, 10)
+    assert(stream.start_offset == len(data) - BUFFER_SIZE)
+    assert(b''.join(stream.segments(0, BUFFER_SIZE)) == data[-BUFFER_SIZE:])
+
+    first_frame = stream.frame_index.first()
+    assert(first_frame.position >= stream.start_offset)
+    assert(stream.frame_index.last().index == 9)
+    assert(stream.frame_index.last().position == 9*FRAME_SIZE)
+
+def test_segments_across_the_end(stream, camera):
+    data = write_frames(stream, camera, 5)
+    position = 1000
+    segments = stream.segments(position, 3000)
+    assert(len(segments) == 2)
+    start = stream.start_offset + position
+    assert(b''.join(segments) == data[start:start + 3000])
+    # The range is clamped to the bytes held.
+    assert(len(b''.join(stream.segments(position, BUFFER_SIZE))) == BUFFER_SIZE - position)
+
+def test_notifies_writes(stream, camera):
+    write_frames(stream, camera, 3)
+    assert(stream.notifier.position == (3*FRAME_SIZE, 3))
+
+def test_video_stream_saver(stream, camera):
+    """
+    Ensures the VideoStreamSaver reads up to the last frame from the start
+    frame.
+    """
+    data = write_frames(stream, camera, 10)
+    saver = VideoStreamSaver(stream, [], 'test', start_time=7)
+    position = saver.start_pos()
+    assert(position + stream.start_offset == 7*FRAME_SIZE)
+    read_bytes, _ = saver.read(position)
+    assert(read_bytes == data[7*FRAME_SIZE:9*FRAME_SIZE])
+
+def test_saves_backlog_in_bounded_reads(camera, tmp_path):
+    """
+    Ensures the padding is read in passes of ``max_read_bytes`` instead of
+    being copied out of the buffer at once.
+    """
+    stream = MmapCircularIO(camera, size=BUFFER_SIZE*4, splitter_port=1, directory=tmp_path)
+    data = write_frames(stream, camera, 10)
+    writer = MockWriter()
+    saver = VideoStreamSaver(stream, [writer], 'test', start_time=0)
+    saver.max_read_bytes = 1500
+    saver.start()
+    saver.stop()
+    saver.join(timeout=5)
+    appends = [buffers for buffers in writer.appends if len(buffers) > 0]
+    assert(max(len(buffers) for buffers in appends) <= 1500)
+    assert(b''.join(appends) == data[stream.start_offset:9*FRAME_SIZE])
+    assert(writer.flushed)
+    stream.close()
+
+def test_starts_on_key_frame(stream, camera):
+    """
+    Ensures a recording starts on the SPS header written before the key
+    frame, and on the start frame if no key frame is held.
+    """
+    frame_types = [SPS_HEADER, KEY_FRAME, 0, 0, 0, 0, 0, 0, 0, 0]
+    write_frames(stream, camera, 10, frame_types)
+    assert(stream.headers == bytes([0])*FRAME_SIZE)
+    saver = VideoStreamSaver(stream, [], 'test', start_time=8)
+    assert(saver.start_pos() + stream.start_offset == 8*FRAME_SIZE)
+
+    stream = MmapCircularIO(camera, size=BUFFER_SIZE*4, splitter_port=1)
+    frame_types = [SPS_HEADER, KEY_FRAME, 0, 0, 0, SPS_HEADER, KEY_FRAME, 0, 0, 0]
+    data = write_frames(stream, camera, 10, frame_types)
+    saver = VideoStreamSaver(stream, [], 'test', start_time=8)
+    position = saver.start_pos()
+    assert(position + stream.start_offset == 5*FRAME_SIZE)
+    read_bytes, _ = saver.read(position)
+    assert(read_bytes == data[5*FRAME_SIZE:9*FRAME_SIZE])
+    stream.close()
+
+def test_prepends_cached_headers(camera):
+    """
+    Ensures the cached SPS/PPS header is written first when the key frame
+    isn't preceded by one.
+    """
+    stream = MmapCircularIO(camera, size=BUFFER_SIZE*4, splitter_port=1)
+    frame_types = [SPS_HEADER, 0, 0, 0, KEY_FRAME, 0, 0, 0, 0, 0]
+    data = write_frames(stream, camera, 10, frame_types)
+    saver = VideoStreamSaver(stream, [], 'test', start_time=8)
+    position = saver.start_pos()
+    assert(position + stream.start_offset == 4*FRAME_SIZE)
+    read_bytes, _ = saver.read(position)
+    assert(read_bytes == data[:FRAME_SIZE] + data[4*FRAME_SIZE:9*FRAME_SIZE])
+    stream.close()
+
+def test_requires_size(camera):
+    with pytest.raises(ValueError):
+        MmapCircularIO(camera)
+
+# ---- Helpers
+
+def write_frames(stream, camera, count, frame_types=None):
+    """
+    Writes ``count`` frames of FRAME_SIZE bytes, one second apart.
+    """
+    data = b''
+    for i in range(count):
+        frame_data = bytes([i])*FRAME_SIZE
+        camera.encoder.frame = MockFrame(index=i,
+                                         frame_type=frame_types[i] if frame_types else 0,
+                                         frame_size=FRAME_SIZE,
+                                         timestamp=i*1000000,
+                                         complete=True)
+        stream.write(frame_data)
+        data += frame_data
+    return data
+
+# ---- Fixtures
+
+@pytest.fixture
+def camera():
+    return MockCamera()
+
+@pytest.fixture
+def stream(camera, tmp_path):
+    stream = MmapCircularIO(camera, size=BUFFER_SIZE, splitter_port=1, directory=tmp_path)
+    yield stream
+    stream.close()
+
+# ---- Mock objects
+
+MockFrame = namedtuple('MockFrame', 'index frame_type frame_size timestamp complete')
+
+
+class MockWriter:
+
+    def __init__(self):
+        self.appends = []
+        self.flushed = False
+
+    def append_buffers(self, buffers, close=False):
+        self.appends.append(b''.join(buffers))
+
+    def flush(self):
+        self.flushed = True
+
+
+class MockEncoder:
+
+    def __init__(self):
+        self.frame = None
+
+
+class MockCamera:
+
+    def __init__(self):
+        self.encoder = MockEncoder()
+        self._encoders = {1: self.encoder}
@@ -0,0 +1,106 @@
+import os
+import pytest
+import socket
+import time
+from watchtower.streamer.async_mjpeg_server import AsyncMJPEGServer, INTERNAL_MJPEG_PATH
+from watchtower.streamer.mjpeg_broadcaster import MJPEGHub
+from watchtower.streamer.writer import http_writer
+
+
+def test_streams_multipart_frames(server, hub, mock_camera):
+    """
+    Ensures a request to /mjpeg receives the multipart header followed by the
+    published frames, base64 encoded when requested.
+    """
+    client = connect(server, '/mjpeg?encoding=base64')
+    wait_for_clients(hub, 1)
+    mock_camera.publish_frame(b'\xff\xd8jpeg')
+
+    expected = http_writer.multipart_frame(b'\xff\xd8jpeg', use_base64=True)
+    response = read_until(client, expected)
+    client.close()
+
+    assert(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+    assert(('boundary=' + http_writer.MULTIPART_BOUNDARY).encode() in response)
+    assert(response.endswith(expected))
+
+def test_many_clients_share_one_loop(server, hub, mock_camera):
+    """
+    Ensures dozens of concurrent viewers are served and each receives the
+    frame.
+    """
+    client_count = 30
+    clients = [connect(server, '/api/internal_mjpeg') for _ in range(client_count)]
+    wait_for_clients(hub, client_count)
+    assert(hub.client_counts() == [dict(encoding='jpeg', fps=4, width=None, quality=None, clients=client_count, dropped_frames=0)])
+
+    mock_camera.publish_frame(b'\xff\xd8jpeg')
+    expected = http_writer.multipart_frame(b'\xff\xd8jpeg')
+    for client in clients:
+        assert(read_until(client, expected).endswith(expected))
+        client.close()
+    wait_for_clients(hub, 0)
+    assert(hub.client_count == 0)
+
+def test_unknown_path(server):
+    client = connect(server, '/api/status')
+    response = read_until(client, b'\r\n\r\n')
+    client.close()
+    assert(response.startswith(b'HTTP/1.1 404'))
+
+def test_web_path_disabled(hub, tmp_path):
+    """
+    Ensures only the internal stream is served when the web app is disabled.
+    """
+    socket_path = start_server(hub, tmp_path, paths=(INTERNAL_MJPEG_PATH,))
+    client = connect(socket_path, '/mjpeg')
+    response = read_until(client, b'\r\n\r\n')
+    client.close()
+    assert(response.startswith(b'HTTP/1.1 404'))
+
+    client = connect(socket_path, INTERNAL_MJPEG_PATH)
+    wait_for_clients(hub, 1)
+    assert(hub.client_count == 1)
+    client.close()
+    wait_for_clients(hub, 0)
+
+# ---- Helpers
+
+def connect(socket_path, path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5)
+    client.connect(socket_path)
+    client.sendall(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path).encode())
+    return client
+
+def read_until(client, suffix):
+    response = b''
+    while not response.endswith(suffix):
+        data = client.recv(4096)
+        if len(data) == 0:
+            break
+        response += data
+    return response
+
+def start_server(hub, tmp_path, **kwargs):
+    socket_path = os.path.join(tmp_path, 'mjpeg.sock')
+    AsyncMJPEGServer(hub, socket_path, **kwargs).start()
+    end_time = time.time() + 5
+    while not os.path.exists(socket_path) and time.time() < end_time:
+        time.sleep(0.01)
+    return socket_path
+
+def wait_for_clients(hub, count, timeout=5):
+    end_time = time.time() + timeout
+    while hub.client_count != count and time.time() < end_time:
+        time.sleep(0.01)
+
+# ---- Fixtures
+
+@pytest.fixture
+def hub(mock_camera):
+    return MJPEGHub(mock_camera)
+
+@pytest.fixture
+def server(hub, tmp_path):
+    return start_server(hub, tmp_path)
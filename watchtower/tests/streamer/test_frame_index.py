@@ -0,0 +1,85 @@
+import pytest
+from watchtower.streamer.frame_index import FrameIndex, COMPACT_THRESHOLD, KEY_FRAME, SPS_HEADER
+
+
+def test_find(index):
+    assert(index.find(0).position == 0)
+    assert(index.find(5).position == 500)
+    assert(index.find(99) is None)
+    assert(index.last().index == 9)
+    assert(index.last_index == 9)
+
+def test_before_time(index):
+    """
+    Ensures the newest frame at or before a time is found and that the oldest
+    frame is used when every frame is newer.
+    """
+    assert(index.before_time(3).index == 3)
+    assert(index.before_time(3.5).index == 3)
+    assert(index.before_time(100).index == 9)
+    assert(index.before_time(-5).index == 0)
+
+def test_before_time_skips_frames_without_timestamps():
+    index = FrameIndex()
+    index.append(0, 1000000, 0)
+    index.append(1, None, 100)
+    index.append(2, 2000000, 200)
+    assert(index.before_time(1.5).index == 0)
+
+def test_discard_before(index):
+    index.discard_before(350)
+    assert(len(index) == 6)
+    assert(index.first().index == 4)
+    assert(index.find(2) is None)
+    assert(index.before_time(0).index == 4)
+
+    index.discard_before(10000)
+    assert(len(index) == 0)
+    assert(index.last() is None)
+    assert(index.before_time(0) is None)
+
+def test_compaction_keeps_lookups():
+    """
+    Ensures trimming discarded entries doesn't change lookups.
+    """
+    index = FrameIndex()
+    count = COMPACT_THRESHOLD * 3
+    for i in range(count):
+        index.append(i, i * 1000000, i * 100)
+    index.discard_before((count - 10) * 100)
+    assert(len(index) == 10)
+    assert(index.first().index == count - 10)
+    assert(index.find(count - 1).position == (count - 1) * 100)
+    assert(index.before_time(count - 5).index == count - 5)
+
+def test_last_of_type():
+    """
+    Ensures the newest key frame and header before a position are found and
+    that discarded ones are ignored.
+    """
+    index = FrameIndex()
+    for i in range(COMPACT_THRESHOLD * 3):
+        # A header followed by a key frame every 10 frames.
+        frame_type = SPS_HEADER if i % 10 == 0 else KEY_FRAME if i % 10 == 1 else 0
+        index.append(i, i * 1000000, i * 100, frame_type)
+
+    assert(index.last_of_type(KEY_FRAME, 2500).index == 21)
+    assert(index.last_of_type(SPS_HEADER, 2500).index == 20)
+    assert(index.last_of_type(KEY_FRAME, 2100).index == 21)
+    assert(index.previous(index.find(21)).frame_type == SPS_HEADER)
+
+    index.discard_before(2200)
+    assert(index.last_of_type(KEY_FRAME, 2500) is None)
+    assert(index.previous(index.first()) is None)
+    index.discard_before(COMPACT_THRESHOLD * 200 + 50)
+    assert(index.last_of_type(KEY_FRAME, COMPACT_THRESHOLD * 300).index == 3071)
+    assert(index.last_of_type(KEY_FRAME, COMPACT_THRESHOLD * 200 + 50) is None)
+
+# ---- Fixtures
+
+@pytest.fixture
+def index():
+    index = FrameIndex()
+    for i in range(10):
+        index.append(index=i, timestamp=i * 1000000, position=i * 100)
+    return index
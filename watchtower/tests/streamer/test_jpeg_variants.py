@@ -0,0 +1,70 @@
+import io
+import pytest
+from collections import namedtuple
+from PIL import Image
+from watchtower.streamer.jpeg_variants import JPEGVariantCache
+from watchtower.streamer.writer.http_writer import multipart_frame
+
+Frame = namedtuple('Frame', 'sequence timestamp data')
+
+
+def test_original_frame_without_options(variants, jpeg):
+    frame = Frame(1, 0, jpeg)
+    assert(variants.jpeg(frame) is jpeg)
+
+def test_resized_variant(variants, jpeg):
+    """
+    Ensures a width produces a smaller JPEG with the same aspect ratio.
+    """
+    data = variants.jpeg(Frame(1, 0, jpeg), width=160)
+    image = Image.open(io.BytesIO(data))
+    assert(image.size == (160, 120))
+    assert(len(data) < len(jpeg))
+
+def test_wider_than_original_is_not_resized(variants, jpeg):
+    assert(variants.jpeg(Frame(1, 0, jpeg), width=1280) is jpeg)
+
+def test_variant_encoded_once_per_frame(variants, jpeg):
+    """
+    Ensures repeated requests for a variant of the same frame share one
+    encoding and that a new frame replaces the cached variants.
+    """
+    first = variants.jpeg(Frame(1, 0, jpeg), width=320, quality=40)
+    assert(variants.jpeg(Frame(1, 0, jpeg), width=320, quality=40) is first)
+
+    second = variants.jpeg(Frame(2, 0, jpeg), width=320, quality=40)
+    assert(second is not first)
+    assert(second == first)
+
+    # Stale frames are still encoded, but never replace the newer variants.
+    variants.jpeg(Frame(1, 0, jpeg), width=320, quality=40)
+    assert(variants.jpeg(Frame(2, 0, jpeg), width=320, quality=40) is second)
+
+def test_base64_payload_encoded_once_per_frame(variants, jpeg):
+    """
+    Ensures the base64 multipart payload is built once per frame and evicted
+    when the next frame arrives.
+    """
+    first = variants.payload(Frame(1, 0, jpeg), use_base64=True)
+    assert(first == multipart_frame(jpeg, use_base64=True))
+    assert(variants.payload(Frame(1, 0, jpeg), use_base64=True) is first)
+    assert(variants.payload(Frame(1, 0, jpeg)) == multipart_frame(jpeg))
+
+    second = variants.payload(Frame(2, 0, jpeg), use_base64=True)
+    assert(second is not first)
+    assert(second == first)
+
+# ---- Fixtures
+
+@pytest.fixture
+def variants():
+    return JPEGVariantCache()
+
+@pytest.fixture(scope="module")
+def jpeg():
+    image = Image.new('RGB', (640, 480))
+    for x in range(0, 640, 8):
+        image.paste((x % 256, (x * 3) % 256, 128), (x, 0, x + 4, 480))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
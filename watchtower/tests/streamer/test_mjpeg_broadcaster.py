@@ -0,0 +1,144 @@
+import pytest
+import time
+from watchtower.streamer.mjpeg_broadcaster import MJPEGHub, stream_options
+from watchtower.streamer.writer import http_writer
+
+
+def test_clients_share_one_payload(hub, camera):
+    """
+    Ensures that clients attached with the same options receive the very same
+    formatted payload object, meaning the frame was only formatted once.
+    """
+    first = MockClient()
+    second = MockClient()
+    hub.attach(first, use_base64=True, rate=100)
+    hub.attach(second, use_base64=True, rate=100)
+
+    camera.publish_frame(b'\xff\xd8jpeg')
+    first.wait_for_frames(1)
+    second.wait_for_frames(1)
+    hub.detach(first)
+    hub.detach(second)
+
+    assert(first.payloads[0] is second.payloads[0])
+    assert(first.payloads[0] == http_writer.multipart_frame(b'\xff\xd8jpeg', use_base64=True))
+
+def test_broadcasters_share_payloads(hub, camera):
+    """
+    Ensures broadcasters with different frame rates reuse the payload built
+    for a frame instead of encoding it again.
+    """
+    slow = MockClient()
+    fast = MockClient()
+    hub.attach(slow, use_base64=True, rate=50)
+    hub.attach(fast, use_base64=True, rate=100)
+
+    camera.publish_frame(b'\xff\xd8jpeg')
+    slow.wait_for_frames(1)
+    fast.wait_for_frames(1)
+    hub.detach(slow)
+    hub.detach(fast)
+
+    assert(slow.payloads[0] is fast.payloads[0])
+
+def test_duplicate_frames_are_not_sent(hub, camera):
+    """
+    Ensures a client only receives a frame once, even if no new frame is
+    published for a while.
+    """
+    client = MockClient()
+    hub.attach(client, rate=100)
+    camera.publish_frame(b'one')
+    client.wait_for_frames(1)
+    time.sleep(0.2)
+    camera.publish_frame(b'two')
+    client.wait_for_frames(2)
+    hub.detach(client)
+
+    assert(client.payloads == [http_writer.multipart_frame(b'one'),
+                               http_writer.multipart_frame(b'two')])
+
+def test_client_counts(hub):
+    """
+    Ensures the hub creates one broadcaster per option set and removes it when
+    its last client detaches.
+    """
+    clients = [MockClient() for _ in range(3)]
+    hub.attach(clients[0], use_base64=False, rate=4)
+    hub.attach(clients[1], use_base64=False, rate=4)
+    hub.attach(clients[2], use_base64=True, rate=4)
+
+    counts = sorted(hub.client_counts(), key=lambda c: c['encoding'])
+    assert(counts == [dict(encoding='base64', fps=4, width=None, quality=None, clients=1, dropped_frames=0),
+                      dict(encoding='jpeg', fps=4, width=None, quality=None, clients=2, dropped_frames=0)])
+    assert(hub.client_count == 3)
+
+    hub.detach(clients[2])
+    assert(hub.client_counts() == [dict(encoding='jpeg', fps=4, width=None, quality=None, clients=2, dropped_frames=0)])
+    for client in clients[:2]:
+        hub.detach(client)
+    assert(hub.client_counts() == [])
+    assert(hub.client_count == 0)
+
+def test_frame_source_follows_demand(camera):
+    """
+    Ensures the frame source runs at the idle rate unless an attached client
+    needs a faster one.
+    """
+    source = MockFrameSource()
+    hub = MJPEGHub(camera, frame_source=source, idle_rate=4)
+    slow = MockClient()
+    fast = MockClient()
+
+    hub.attach(slow, rate=2)
+    assert(source.frame_rate == 4)
+    hub.attach(fast, rate=15)
+    assert(source.frame_rate == 15)
+    hub.detach(fast)
+    assert(source.frame_rate == 4)
+    hub.detach(slow)
+    assert(source.frame_rate == 4)
+
+def test_stream_options():
+    """
+    Ensures query string values are parsed, clamped, and defaulted.
+    """
+    assert(stream_options({}) == dict(use_base64=False, rate=4, width=None, quality=None))
+    assert(stream_options(dict(encoding='base64', fps='10', width='320', quality='50')) == \
+        dict(use_base64=True, rate=10, width=320, quality=50))
+    assert(stream_options(dict(fps='1000', quality='0')) == \
+        dict(use_base64=False, rate=30, width=None, quality=1))
+    assert(stream_options(dict(fps='fast', width='')) == \
+        dict(use_base64=False, rate=4, width=None, quality=None))
+
+# ---- Fixtures
+
+@pytest.fixture
+def camera(mock_camera):
+    return mock_camera
+
+@pytest.fixture
+def hub(camera):
+    return MJPEGHub(camera)
+
+# ---- Mock objects
+
+class MockClient:
+    """
+    Collects every payload handed to it by a broadcaster.
+    """
+    def __init__(self):
+        self.payloads = []
+        self.dropped_frames = 0
+
+    def append_frame(self, payload):
+        self.payloads.append(payload)
+
+    def wait_for_frames(self, count, timeout=5):
+        end_time = time.time() + timeout
+        while len(self.payloads) < count and time.time() < end_time:
+            time.sleep(0.01)
+
+class MockFrameSource:
+    def __init__(self):
+        self.frame_rate = None
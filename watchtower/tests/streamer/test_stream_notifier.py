@@ -0,0 +1,94 @@
+import io
+import time
+from threading import Thread
+from watchtower.streamer.stream_notifier import StreamNotifier
+from watchtower.streamer.stream_saver import StreamSaver
+from watchtower.streamer.writer.byte_writer import ByteWriter
+
+
+def test_wakes_on_byte_threshold():
+    notifier = StreamNotifier()
+    since = notifier.position
+    notify_later(notifier, 0.05, byte_count=100)
+    start = time.time()
+    position = notifier.wait(since, min_bytes=100, min_frames=10, max_latency=5, idle_timeout=5)
+    assert(time.time() - start < 1)
+    assert(position == (100, 0))
+
+def test_wakes_on_frame_threshold():
+    notifier = StreamNotifier()
+    since = notifier.position
+    notify_later(notifier, 0.05, byte_count=1, frame_count=2)
+    start = time.time()
+    position = notifier.wait(since, min_bytes=100, min_frames=2, max_latency=5, idle_timeout=5)
+    assert(time.time() - start < 1)
+    assert(position == (1, 2))
+
+def test_wakes_after_max_latency():
+    """
+    Ensures data below the thresholds waits no longer than max_latency.
+    """
+    notifier = StreamNotifier()
+    since = notifier.position
+    notifier.notify(10)
+    start = time.time()
+    position = notifier.wait(since, min_bytes=100, min_frames=10, max_latency=0.1, idle_timeout=5)
+    assert(0.09 <= time.time() - start < 1)
+    assert(position == (10, 0))
+
+def test_idle_timeout():
+    notifier = StreamNotifier()
+    start = time.time()
+    position = notifier.wait(notifier.position, min_bytes=1, min_frames=1, max_latency=0.01, idle_timeout=0.1)
+    assert(time.time() - start >= 0.09)
+    assert(position == (0, 0))
+
+def test_closed_and_interrupted():
+    notifier = StreamNotifier()
+    interrupted = []
+    Thread(target=lambda: (time.sleep(0.05), interrupted.append(True), notifier.interrupt())).start()
+    start = time.time()
+    notifier.wait(notifier.position, min_bytes=1, min_frames=1, max_latency=5, idle_timeout=5,
+                  interrupted=lambda: len(interrupted) > 0)
+    assert(time.time() - start < 1)
+
+    notifier.close()
+    start = time.time()
+    notifier.wait(notifier.position, min_bytes=1, min_frames=1, max_latency=5, idle_timeout=5)
+    assert(time.time() - start < 0.05)
+
+def test_saver_with_closed_notifier():
+    """
+    Ensures a complete stream is saved and closed without any fixed sleeps.
+    """
+    notifier = StreamNotifier()
+    notifier.close()
+    writer = MockWriter()
+    saver = StreamSaver(io.BytesIO(b'jpeg data'), [writer], 'test', stop_when_empty=True, notifier=notifier)
+    start = time.time()
+    saver.start()
+    saver.join(timeout=5)
+    assert(time.time() - start < 0.2)
+    assert(writer.data == b'jpeg data')
+    assert(writer.closed)
+
+# ---- Helpers
+
+def notify_later(notifier, delay, byte_count, frame_count=0):
+    def notify():
+        time.sleep(delay)
+        notifier.notify(byte_count, frame_count)
+    Thread(target=notify).start()
+
+# ---- Mock objects
+
+class MockWriter(ByteWriter):
+
+    def __init__(self):
+        super(MockWriter, self).__init__('mock')
+        self.data = b''
+        self.closed = False
+
+    def append_bytes(self, bts, close=False):
+        self.data += bts
+        self.closed = self.closed or close
@@ -4,6 +4,7 @@ import picamera
 import pytest
 import time
 from threading import Lock
+from watchtower.streamer.frame_index import FrameIndex
 
 simulated_time = time.time()
 
@@ -84,6 +85,59 @@ def test_read_from_middle(stream_saver):
     assert(bytes_read == stream_saver.stream.getvalue()[read_position:last_frame.position])
     assert(new_position == (read_position + len(bytes_read)))
 
+def test_read_after_stream_advances(stream_saver):
+    """
+    Simulates the circular stream discarding old data between reads. Reading
+    must continue from the last streamed frame at its new position.
+    """
+    # Arrange
+    stream_saver.stream.simulate_timestamps(current_time=simulated_time,
+                                            index_for_current_time=0)
+    stream = stream_saver.stream
+    stream_saver.start_pos()
+    first_bytes, _ = stream_saver.read(0)
+    last_position = stream.frames[-1].position
+
+    # Simulate the oldest 4 frames being discarded and 4 new frames written.
+    frame_size = stream.frames[1].position
+    discarded = 4 * frame_size
+    new_data = os.urandom(discarded)
+    stream.start_offset = discarded
+    data = stream.getvalue()[discarded:] + new_data
+    stream.seek(0)
+    stream.truncate(0)
+    stream.write(data)
+    stream.simulate_frames(len(stream.frames))
+
+    # Act
+    bytes_read, _ = stream_saver.read(0)
+
+    # Assert
+    expected_start = last_position - discarded
+    assert(bytes_read == stream.getvalue()[expected_start:stream.frames[-1].position])
+    assert(len(bytes_read) == discarded)
+
+def test_backlog_written_first(stream_saver):
+    """
+    Ensures the padding is handed to the writers in one call and flushed
+    before the live tail is read.
+    """
+    from watchtower.streamer.video_stream_saver import VideoStreamSaver
+
+    stream_saver.stream.simulate_timestamps(current_time=simulated_time,
+                                            index_for_current_time=0)
+    writer = MockWriter()
+    saver = VideoStreamSaver(stream_saver.stream, [writer], 'test backlog', simulated_time)
+    saver.start()
+    time.sleep(0.1)
+    saver.stop()
+    saver.join(timeout=5)
+
+    last_frame = stream_saver.stream.frames[-1]
+    assert(writer.calls[0] == ('append', stream_saver.stream.getvalue()[0:last_frame.position], False))
+    assert(writer.calls[1] == ('flush',))
+    assert(writer.calls[-1] == ('append', b'', True))
+
 # ---- Fixtures
 
 @pytest.fixture
@@ -104,6 +158,17 @@ def disk_writer(tmpdir):
 
 # ---- Mock objects
 
+class MockWriter:
+
+    def __init__(self):
+        self.calls = []
+
+    def append_buffers(self, buffers, close=False):
+        self.calls.append(('append', b''.join(buffers), close))
+
+    def flush(self):
+        self.calls.append(('flush',))
+
 class MockPiCameraCircularIO(io.BytesIO):
     """
     This mock object is used because the real PiCameraCircularIO requires a
@@ -112,7 +177,27 @@ class MockPiCameraCircularIO(io.BytesIO):
     def __init__(self, initial_bytes):
         self.frames = None
         self.lock = Lock()
+        self.start_offset = 0
         super(MockPiCameraCircularIO, self).__init__(initial_bytes)
+
+    @property
+    def frame_index(self):
+        """
+        Builds the index from the simulated frames. The real stream maintains
+        its index as frames are written.
+        """
+        index = FrameIndex()
+        for frame in self.frames:
+            index.append(frame.index, frame.timestamp, self.start_offset + frame.position)
+        return index
+
+    def segments(self, position, length):
+        """
+        Splits the range into two views to simulate the stream's chunks.
+        """
+        data = memoryview(self.getvalue()[position:position + length])
+        middle = len(data)//2
+        return [data[:middle], data[middle:]] if length > 0 else []
     
     def simulate_frames(self, frame_count):
         """
@@ -0,0 +1,96 @@
+import errno
+import os
+import pytest
+import time
+from watchtower.streamer.writer import async_disk_writer
+from watchtower.streamer.writer.async_disk_writer import AsyncDiskWriter, ALIGNMENT
+
+TEST_FILE_NAME = 'test_file.bin'
+
+
+def test_multiple_append_bytes(random_data, tmp_path):
+    writer = AsyncDiskWriter(os.path.join(tmp_path, TEST_FILE_NAME))
+    append_count = 5
+    amount_to_read = len(random_data)//append_count
+    for i in range(append_count):
+        data = random_data[i*amount_to_read:(i+1) * amount_to_read]
+        writer.append_bytes(data, close=(i == append_count-1)) # Close on the last chunk.
+    wait_until_finished(writer)
+
+    with open(os.path.join(tmp_path, TEST_FILE_NAME), 'rb') as f:
+        assert(f.read() == random_data[:append_count * amount_to_read])
+
+def test_coalesces_aligned_writes(tmp_path):
+    """
+    Ensures small appends are combined into writes that end on alignment
+    boundaries, and that the preallocation is trimmed on close.
+    """
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    writer = AsyncDiskWriter(path, expected_size=10*ALIGNMENT, coalesce_bytes=ALIGNMENT)
+    data = os.urandom(ALIGNMENT * 3 + 100)
+    chunk_size = 1000
+    for i in range(0, len(data), chunk_size):
+        writer.append_buffers([memoryview(data)[i:i + chunk_size]])
+    writer.append_buffers([], close=True)
+    wait_until_finished(writer)
+
+    metrics = writer.metrics()
+    assert(metrics['bytes_written'] == len(data))
+    assert(metrics['writes'] <= 4)  # 3 aligned writes and the remainder
+    assert(metrics['queue_depth'] == 0)
+    with open(path, 'rb') as f:
+        assert(f.read() == data)
+
+def test_flush_writes_pending_bytes(tmp_path):
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    writer = AsyncDiskWriter(path, fsync_policy=async_disk_writer.FSYNC_ON_FLUSH)
+    writer.append_bytes(b'padding')
+    writer.flush()
+    end_time = time.time() + 5
+    while writer.metrics()['bytes_written'] == 0 and time.time() < end_time:
+        time.sleep(0.01)
+    with open(path, 'rb') as f:
+        assert(f.read() == b'padding')
+    writer.append_bytes(b'', close=True)
+    wait_until_finished(writer)
+
+def test_appends_to_existing_file(tmp_path):
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    with open(path, 'wb') as f:
+        f.write(b'existing')
+    writer = AsyncDiskWriter(path, expected_size=ALIGNMENT)
+    writer.append_bytes(b' data', close=True)
+    wait_until_finished(writer)
+    with open(path, 'rb') as f:
+        assert(f.read() == b'existing data')
+
+def test_stops_on_write_errors(tmp_path, monkeypatch):
+    """
+    Ensures appends fail instead of blocking on a full queue once the I/O
+    thread stopped, like it does when the disk is full.
+    """
+    def pwrite(fd, data, offset):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    monkeypatch.setattr(async_disk_writer.os, 'pwrite', pwrite)
+    writer = AsyncDiskWriter(os.path.join(tmp_path, TEST_FILE_NAME), coalesce_bytes=1, max_queue=1)
+    writer.append_bytes(b'data')
+    with pytest.raises(IOError) as e:
+        end_time = time.time() + 5
+        while time.time() < end_time:
+            writer.append_bytes(b'data')
+    assert(os.strerror(errno.ENOSPC) in str(e.value))
+    assert(writer.is_finished_writing())
+    with pytest.raises(IOError):
+        writer.flush()
+
+def test_invalid_fsync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        AsyncDiskWriter(os.path.join(tmp_path, TEST_FILE_NAME), fsync_policy='sometimes')
+
+# ---- Helpers
+
+def wait_until_finished(writer, timeout=5):
+    end_time = time.time() + timeout
+    while not writer.is_finished_writing() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(writer.is_finished_writing())
@@ -25,6 +25,13 @@ def test_multiple_append_bytes(writer, random_data, tmp_path):
     assert(written_data == random_data)
     pass
 
+def test_append_buffers(writer, random_data, tmp_path):
+    view = memoryview(random_data)
+    middle = len(random_data)//2
+    writer.append_buffers([view[:middle], view[middle:]], close=True)
+    with open(os.path.join(tmp_path, TEST_FILE_NAME), 'rb') as f:
+        assert(f.read() == random_data)
+
 # ---- Fixtures
 
 @pytest.fixture
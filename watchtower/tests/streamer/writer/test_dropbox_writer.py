@@ -3,6 +3,8 @@ import os
 import pytest
 import subprocess
 import time
+import tracemalloc
+from threading import Event
 from watchtower.streamer.writer import dropbox_writer
 from watchtower.streamer.writer.disk_writer import DiskWriter
 
@@ -90,6 +92,334 @@ def test_dropbox_writer_encrypted_integration(encrypted_writer, random_data, tmp
     # Assert the writer's input data is identical to the data output to disk.
     assert(written_data == random_data)
 
+def test_byte_pool_benchmark(random_data):
+    """
+    Microbenchmark of the DropboxWriter's byte pool against the previous
+    implementation, which concatenated every append onto one bytes object and
+    re-sliced it for every chunk. Small appends are fed to a 1 MB chunk size
+    like a live tail after a large backlog. The peak memory of the pool must
+    stay bounded by the chunk size instead of growing with the backlog.
+    """
+    chunk_size = 1024*1024
+    backlog = memoryview(random_data)
+    appends = [backlog[:len(random_data)//2]]  # The pre-roll backlog
+    appends += [backlog[i:i + 16*1024] for i in range(len(random_data)//2, len(random_data), 16*1024)]
+
+    def measure(append):
+        tracemalloc.start()
+        start_time = time.time()
+        for i, data in enumerate(appends):
+            append(data, i == len(appends) - 1)
+        elapsed = time.time() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return len(random_data) / elapsed / 1024 / 1024, peak
+
+    uploader = CountingDropboxUploader()
+    writer = dropbox_writer.DropboxWriter('/test_file.bin',
+                                          dropbox_token="",
+                                          file_chunk_size=chunk_size,
+                                          test_dropbox_uploader=uploader)
+    throughput, peak = measure(writer.append_bytes)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+    legacy_throughput, legacy_peak = measure(LegacyBytePool(chunk_size).append_bytes)
+
+    print('Byte pool: %.1f MB/s, peak %.1f MB. Previous: %.1f MB/s, peak %.1f MB.' %
+          (throughput, peak / 1024 / 1024, legacy_throughput, legacy_peak / 1024 / 1024))
+    assert(uploader.byte_count == len(random_data))
+    assert(peak < legacy_peak)
+
+def test_upload_session(fake_dropbox, random_data):
+    """
+    Ensures a session upload produces one remote file with every byte and
+    uses one request per chunk plus the finishing request.
+    """
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token="",
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_session=True)
+    append_count = 20
+    amount_to_read = len(random_data)//append_count
+    for i in range(append_count):
+        data = random_data[i*amount_to_read:(i+1) * amount_to_read]
+        writer.append_bytes(data, close=(i == append_count-1))
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+
+    assert(list(fake_dropbox.files.keys()) == ['/camera/video.h264'])
+    assert(fake_dropbox.files['/camera/video.h264'] == random_data[:append_count * amount_to_read])
+    assert(fake_dropbox.request_count == math.ceil(len(random_data)/dropbox_writer.DEFAULT_FILE_CHUNK_SIZE) + 1)
+
+def test_upload_session_benchmark(random_data):
+    """
+    Compares the request count and throughput of separate chunk files and an
+    upload session against a FakeDropbox with a simulated round trip.
+    """
+    from conftest import FakeDropbox
+
+    def measure(upload_session):
+        fake_dropbox = FakeDropbox(latency=0.01)
+        writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                              dropbox_token="",
+                                              test_dropbox_uploader=fake_dropbox,
+                                              upload_session=upload_session)
+        start_time = time.time()
+        for i in range(0, len(random_data), 64*1024):
+            writer.append_bytes(random_data[i:i + 64*1024])
+        writer.append_bytes(b'', close=True)
+        while not writer.is_finished_writing():
+            time.sleep(0.01)
+        elapsed = time.time() - start_time
+        return fake_dropbox, len(random_data) / elapsed / 1024 / 1024
+
+    files, files_throughput = measure(upload_session=False)
+    session, session_throughput = measure(upload_session=True)
+    print('Files: %d requests, %d files, %.1f MB/s. Session: %d requests, %d files, %.1f MB/s.' %
+          (files.request_count, len(files.files), files_throughput,
+           session.request_count, len(session.files), session_throughput))
+    assert(len(session.files) == 1)
+    assert(session.uploaded_bytes == files.uploaded_bytes == len(random_data))
+
+def test_encrypted_upload_session(fake_dropbox, random_data, tmp_path, public_pem_path, installation_path):
+    """
+    Ensures an encrypted upload session produces one file that decrypts to
+    every byte, even when its chunks are encrypted out of order.
+    """
+    from watchtower.streamer.writer.encryption_pool import EncryptionPool
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token="",
+                                          file_chunk_size=100*1024,
+                                          public_pem_path=public_pem_path,
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_session=True,
+                                          encryption_pool=EncryptionPool(worker_count=4))
+    for i in range(0, len(random_data), 100*1000):
+        writer.append_bytes(random_data[i:i + 100*1000])
+    writer.append_bytes(b'', close=True)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+
+    assert(list(fake_dropbox.files.keys()) == ['/camera/video.h264'])
+    in_path = os.path.join(tmp_path, 'video.h264')
+    with open(in_path, 'wb') as f:
+        f.write(fake_dropbox.files['/camera/video.h264'])
+    assert(decrypt(installation_path, tmp_path, [in_path]) == random_data)
+
+def test_decrypts_numbered_files_together(fake_dropbox, random_data, tmp_path, public_pem_path, installation_path):
+    """
+    Ensures the numbered files of a recording, which each have their own data
+    key, decrypt in one call like mp4_wrapper.sh makes.
+    """
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token="",
+                                          file_chunk_size=100*1024,
+                                          public_pem_path=public_pem_path,
+                                          test_dropbox_uploader=fake_dropbox)
+    writer.append_bytes(random_data[:1024*1024], close=True)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+    in_paths = []
+    for i in range(len(fake_dropbox.files)):
+        in_paths.append(os.path.join(tmp_path, 'video%d.h264' % i))
+        with open(in_paths[-1], 'wb') as f:
+            f.write(fake_dropbox.files['/camera/video%d.h264' % i])
+    assert(len(in_paths) == 11)
+    assert(decrypt(installation_path, tmp_path, in_paths) == random_data[:1024*1024])
+
+def test_encryption_failure_ends_upload_session(fake_dropbox, random_data, tmp_path, public_pem_path,
+                                                installation_path, monkeypatch):
+    """
+    Ensures the chunks after one that fails to encrypt aren't appended to the
+    session, so the file decrypts to the chunks before it and then fails as
+    truncated instead of decrypting to corrupted data.
+    """
+    from watchtower.streamer.writer.encryption_pool import EncryptionPool
+    from watchtower.streamer.writer.envelope_encryption import EncryptedStream, FRAME_SIZE
+    encrypted_count = [0]
+    original_encrypt = EncryptedStream.encrypt
+    def encrypt(stream, parts):
+        encrypted_count[0] += 1
+        if encrypted_count[0] == 3:
+            raise ValueError('Encryption failed.')
+        return original_encrypt(stream, parts)
+    monkeypatch.setattr(EncryptedStream, 'encrypt', encrypt)
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token="",
+                                          file_chunk_size=100*1024,
+                                          public_pem_path=public_pem_path,
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_session=True,
+                                          encryption_pool=EncryptionPool(worker_count=1))
+    writer.append_bytes(random_data[:500*1024], close=True)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+
+    assert(list(fake_dropbox.files.keys()) == ['/camera/video.h264'])
+    in_path = os.path.join(tmp_path, 'video.h264')
+    with open(in_path, 'wb') as f:
+        f.write(fake_dropbox.files['/camera/video.h264'])
+    with pytest.raises(subprocess.CalledProcessError):
+        decrypt(installation_path, tmp_path, [in_path])
+    with open(os.path.join(tmp_path, 'decrypted.bin'), 'rb') as f:
+        # The frames completed by the first two chunks.
+        assert(f.read() == random_data[:(200*1024 // FRAME_SIZE) * FRAME_SIZE])
+
+def test_decrypts_previous_format(random_data, tmp_path, public_pem_path, installation_path):
+    """
+    Ensures decrypt.py still reads the files of the previous Fernet format.
+    """
+    in_path = os.path.join(tmp_path, 'legacy.h264')
+    with open(in_path, 'wb') as f:
+        f.write(LegacyEncryptor(public_pem_path).encrypt(random_data[:1024*1024]))
+    assert(decrypt(installation_path, tmp_path, [in_path]) == random_data[:1024*1024])
+
+def test_decrypt_rejects_tampering(tmp_path, public_pem_path, installation_path):
+    """
+    Ensures modified or truncated files fail to decrypt.
+    """
+    uploader = CountingDropboxUploader()
+    writer = dropbox_writer.DropboxWriter('/test_file.bin',
+                                          dropbox_token="",
+                                          file_chunk_size=-1,
+                                          public_pem_path=public_pem_path,
+                                          test_dropbox_uploader=uploader)
+    writer.append_bytes(os.urandom(200*1024), close=True)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+    encrypted = uploader.last_bytes
+    in_path = os.path.join(tmp_path, 'tampered.bin')
+    for tampered in [encrypted[:-1] + bytes([encrypted[-1] ^ 1]), encrypted[:len(encrypted)//2]]:
+        with open(in_path, 'wb') as f:
+            f.write(tampered)
+        with pytest.raises(subprocess.CalledProcessError):
+            decrypt(installation_path, tmp_path, [in_path])
+
+def test_encryption_benchmark(random_data, public_pem_path):
+    """
+    Compares the uploaded bytes and CPU time per MB of the streaming format
+    against the previous format, which encrypted each chunk with Fernet and
+    a new RSA-wrapped key.
+    """
+    def measure(encrypt):
+        start_time = time.process_time()
+        uploaded_bytes = encrypt()
+        elapsed = time.process_time() - start_time
+        return uploaded_bytes, elapsed / (len(random_data) / 1024 / 1024) * 1000
+
+    def streaming():
+        uploader = CountingDropboxUploader()
+        writer = dropbox_writer.DropboxWriter('/test_file.bin',
+                                              dropbox_token="",
+                                              public_pem_path=public_pem_path,
+                                              test_dropbox_uploader=uploader)
+        for i in range(0, len(random_data), 64*1024):
+            writer.append_bytes(random_data[i:i + 64*1024])
+        writer.append_bytes(b'', close=True)
+        while not writer.is_finished_writing():
+            time.sleep(0.01)
+        return uploader.byte_count
+
+    def legacy():
+        encryptor = LegacyEncryptor(public_pem_path)
+        chunk_size = dropbox_writer.DEFAULT_FILE_CHUNK_SIZE
+        return sum(len(encryptor.encrypt(random_data[i:i + chunk_size])) for i in range(0, len(random_data), chunk_size))
+
+    streaming_bytes, streaming_ms = measure(streaming)
+    legacy_bytes, legacy_ms = measure(legacy)
+    print('Streaming: %d bytes, %.1f ms/MB. Previous: %d bytes, %.1f ms/MB.' %
+          (streaming_bytes, streaming_ms, legacy_bytes, legacy_ms))
+    assert(streaming_bytes < len(random_data) * 1.01)
+    assert(streaming_bytes < legacy_bytes)
+
+def test_encryption_overlaps_uploads(random_data, public_pem_path):
+    """
+    Ensures chunks are encrypted while earlier chunks upload. The simulated
+    round trip is set so uploading takes as long as encrypting, and the
+    end-to-end time must approach the time of one stage rather than both.
+    """
+    from conftest import FakeDropbox
+    from watchtower.streamer.writer.encryption_pool import EncryptionPool
+    from watchtower.streamer.writer.upload_service import UploadService
+    data = random_data * 3  # Long enough to dwarf the thread handoffs
+    chunk_count = math.ceil(len(data) / dropbox_writer.DEFAULT_FILE_CHUNK_SIZE)
+
+    def write(fake_dropbox, public_pem_path):
+        writer = dropbox_writer.DropboxWriter('/test_file.bin',
+                                              dropbox_token="",
+                                              public_pem_path=public_pem_path,
+                                              test_dropbox_uploader=fake_dropbox,
+                                              upload_service=UploadService(worker_count=1),
+                                              encryption_pool=EncryptionPool(worker_count=1))
+        start_time = time.time()
+        for i in range(0, len(data), 64*1024):
+            writer.append_bytes(data[i:i + 64*1024])
+        writer.append_bytes(b'', close=True)
+        while not writer.is_finished_writing():
+            time.sleep(0.001)
+        return time.time() - start_time
+
+    # Encrypting alone. The uploads take no time.
+    encrypt_time = min(write(FakeDropbox(), public_pem_path) for _ in range(3))
+    # Uploading alone, with a round trip that matches the encryption time.
+    latency = encrypt_time / chunk_count
+    upload_time = min(write(FakeDropbox(latency=latency), None) for _ in range(3))
+    overlapped_time = min(write(FakeDropbox(latency=latency), public_pem_path) for _ in range(3))
+    print('Encrypt: %.3f sec. Upload: %.3f sec. Both: %.3f sec.' % (encrypt_time, upload_time, overlapped_time))
+    assert(overlapped_time < 0.9 * (encrypt_time + upload_time))
+
+def test_slow_uploads_spill(random_data, tmp_path):
+    """
+    Ensures unencrypted chunks waiting for a slow upload hold up the writer,
+    so the QueuedWriter in front of it spills instead of the upload queue
+    growing.
+    """
+    from watchtower.streamer.writer import queued_writer
+    from watchtower.streamer.writer.upload_service import UploadService
+    uploader = BlockingDropboxUploader()
+    service = UploadService(worker_count=1)
+    writer = queued_writer.QueuedWriter(
+        dropbox_writer.DropboxWriter('/test_file.bin',
+                                     dropbox_token="",
+                                     file_chunk_size=64*1024,
+                                     test_dropbox_uploader=uploader,
+                                     upload_service=service,
+                                     max_chunks_ahead=2),
+        name='dropbox',
+        overflow_policy=queued_writer.OVERFLOW_SPILL,
+        max_queue_bytes=128*1024,
+        spill_dir=tmp_path)
+    data = random_data[:1024*1024]
+    for i in range(0, len(data), 64*1024):
+        writer.append_bytes(data[i:i + 64*1024])
+    writer.append_bytes(b'', close=True)
+    time.sleep(0.2)
+    assert(service.pending_count <= 2)
+    assert(writer.metrics()['spilled_bytes'] > 0)
+
+    uploader.released.set()
+    end_time = time.time() + 5
+    while not writer.is_finished_writing() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(writer.is_finished_writing())
+    assert(b''.join(uploader.files['/test_file%d.bin' % i] for i in range(len(uploader.files))) == data)
+
+# ---- Helpers
+
+def decrypt(installation_path, tmp_path, in_paths):
+    """
+    Decrypts the files with decrypt.py and returns the decrypted bytes.
+    """
+    out_path = os.path.join(tmp_path, 'decrypted.bin')
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    decrypt_script_path = os.path.join(installation_path, 'ancillary', 'decryption', 'decrypt.py')
+    subprocess.run(['python', decrypt_script_path,
+                    '-k', os.path.join(tmp_path, 'private.pem'),
+                    '-i'] + in_paths + ['-o', out_path], check=True, stderr=subprocess.DEVNULL)
+    with open(out_path, 'rb') as f:
+        return f.read()
+
 # ---- Fixtures
 
 @pytest.fixture
@@ -99,10 +429,17 @@ def writer(tmp_path):
                                         test_dropbox_uploader=MockDropboxUploader())
 
 @pytest.fixture
-def encrypted_writer(tmp_path):
+def encrypted_writer(tmp_path, public_pem_path):
+    return dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
+                                        dropbox_token="",
+                                        public_pem_path=public_pem_path,
+                                        test_dropbox_uploader=MockDropboxUploader())
+
+@pytest.fixture
+def public_pem_path(tmp_path):
     from cryptography.hazmat.backends import default_backend
-    from cryptography.hazmat.primitives import serialization, hashes
-    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
 
     # Generate a private and public key and save these in the tmp_path.
     private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
@@ -116,11 +453,7 @@ def encrypted_writer(tmp_path):
                                          format=serialization.PublicFormat.SubjectPublicKeyInfo)
     with open(os.path.join(tmp_path, 'public.pem'), 'wb') as public_out:
         public_out.write(public_pem)
-    
-    return dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
-                                        dropbox_token="",
-                                        public_pem_path=os.path.join(tmp_path, 'public.pem'),
-                                        test_dropbox_uploader=MockDropboxUploader())
+    return os.path.join(tmp_path, 'public.pem')
 
 # ---- Mock objects
 
@@ -132,3 +465,73 @@ class MockDropboxUploader():
     def files_upload(self, bts, path):
         writer = DiskWriter(path)
         writer.append_bytes(bts, close=True)
+
+
+class BlockingDropboxUploader():
+    """
+    Mock object whose uploads wait until ``released`` is set.
+    """
+    def __init__(self):
+        self.released = Event()
+        self.files = {}
+
+    def files_upload(self, bts, path):
+        self.released.wait()
+        self.files[path] = bts
+
+
+class CountingDropboxUploader():
+    """
+    Mock object that discards the uploaded bytes after counting them.
+    """
+    def __init__(self):
+        self.byte_count = 0
+        self.last_bytes = None
+
+    def files_upload(self, bts, path):
+        self.byte_count += len(bts)
+        self.last_bytes = bts
+
+
+class LegacyBytePool():
+    """
+    The byte pool previously used by DropboxWriter. The chunks are discarded.
+    """
+    def __init__(self, file_chunk_size):
+        self.__file_chunk_size = file_chunk_size
+        self.__byte_pool = ''.encode()
+
+    def append_bytes(self, bts, close=False):
+        self.__byte_pool += bts
+        if len(self.__byte_pool) < self.__file_chunk_size and not close:
+            return
+        sub_bytes = self.__byte_pool[:self.__file_chunk_size]
+        while len(sub_bytes) == self.__file_chunk_size:
+            self.__byte_pool = self.__byte_pool[self.__file_chunk_size:]
+            sub_bytes = self.__byte_pool[:self.__file_chunk_size]
+        self.__byte_pool = sub_bytes
+
+
+class LegacyEncryptor():
+    """
+    The encryption previously used by DropboxWriter. Each chunk got a new
+    Fernet key wrapped with the public key.
+    """
+    def __init__(self, public_pem_path):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        with open(public_pem_path, 'rb') as f:
+            self.__public_key = serialization.load_pem_public_key(f.read(), backend=default_backend())
+
+    def encrypt(self, bts):
+        import base64
+        from cryptography.fernet import Fernet
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        fernet_key = Fernet.generate_key()
+        encrypted_fernet_key = self.__public_key.encrypt(fernet_key,
+                                                         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                                                      algorithm=hashes.SHA256(),
+                                                                      label=None))
+        encoded_fernet_key = base64.b64encode(encrypted_fernet_key)
+        return str(len(encoded_fernet_key)).encode() + b' ' + encoded_fernet_key + Fernet(fernet_key).encrypt(bts)
@@ -0,0 +1,33 @@
+import pytest
+from watchtower.streamer.writer.http_writer import HTTPMultipartWriter, multipart_frame
+
+
+def test_unbounded_writer_keeps_every_frame():
+    writer = HTTPMultipartWriter()
+    for i in range(5):
+        writer.append_bytes(str(i).encode())
+
+    assert(writer.blocking_read() == b''.join(multipart_frame(str(i).encode()) for i in range(5)))
+    assert(writer.dropped_frames == 0)
+
+def test_bounded_writer_keeps_latest_frames():
+    """
+    Ensures a bounded writer only holds the newest frames and counts the ones
+    it replaced.
+    """
+    writer = HTTPMultipartWriter(max_frames=2)
+    for i in range(5):
+        writer.append_bytes(str(i).encode())
+
+    assert(writer.blocking_read() == multipart_frame(b'3') + multipart_frame(b'4'))
+    assert(writer.dropped_frames == 3)
+
+    writer.append_bytes(b'5')
+    assert(writer.blocking_read() == multipart_frame(b'5'))
+    assert(writer.dropped_frames == 3)
+
+def test_empty_bytes_are_ignored():
+    writer = HTTPMultipartWriter(max_frames=1)
+    writer.append_bytes(b'frame')
+    writer.append_bytes(b'')
+    assert(writer.blocking_read() == multipart_frame(b'frame'))
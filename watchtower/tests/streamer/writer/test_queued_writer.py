@@ -0,0 +1,106 @@
+import pytest
+import time
+from threading import Event, Timer
+from watchtower.streamer.writer import queued_writer
+from watchtower.streamer.writer.byte_writer import ByteWriter
+from watchtower.streamer.writer.queued_writer import QueuedWriter
+
+
+def test_writes_in_order(tmp_path):
+    target = MockWriter()
+    writer = QueuedWriter(target, 'test')
+    writer.append_bytes(b'one')
+    writer.flush()
+    writer.append_buffers([memoryview(b'two'), b'three'], close=True)
+    wait_until_finished(writer)
+    assert(target.calls == [('append', b'one', False), ('flush',), ('append', b'twothree', True)])
+
+def test_slow_writer_does_not_block(tmp_path):
+    """
+    Ensures appends return immediately while the writer is stalled and the
+    spilled chunks are written in order once it recovers.
+    """
+    target = MockWriter(blocked=True)
+    writer = QueuedWriter(target, 'test', overflow_policy=queued_writer.OVERFLOW_SPILL,
+                          max_queue_bytes=10, spill_dir=tmp_path)
+    start_time = time.time()
+    for i in range(10):
+        writer.append_bytes(bytes([i])*8)
+    assert(time.time() - start_time < 0.5)
+
+    metrics = writer.metrics()
+    assert(metrics['spilled_bytes'] > 0)
+    assert(metrics['queued_bytes'] <= 10)
+    assert(metrics['lag_sec'] >= 0)
+
+    target.unblock()
+    writer.append_bytes(b'', close=True)
+    wait_until_finished(writer)
+    assert(target.data == b''.join(bytes([i])*8 for i in range(10)))
+    assert(writer.metrics()['spilled_bytes'] == 0)
+
+def test_drop_oldest(tmp_path):
+    target = MockWriter(blocked=True)
+    writer = QueuedWriter(target, 'test', overflow_policy=queued_writer.OVERFLOW_DROP_OLDEST,
+                          max_queue_bytes=20)
+    for i in range(10):
+        writer.append_bytes(bytes([i])*8)
+    metrics = writer.metrics()
+    assert(metrics['dropped_chunks'] > 0)
+    assert(metrics['dropped_bytes'] == metrics['dropped_chunks'] * 8)
+
+    target.unblock()
+    writer.append_bytes(b'', close=True)
+    wait_until_finished(writer)
+    assert(len(target.data) == 80 - metrics['dropped_bytes'])
+    assert(target.data.endswith(bytes([9])*8))
+
+def test_block(tmp_path):
+    """
+    Ensures an append waits until the queue has room.
+    """
+    target = MockWriter(blocked=True)
+    writer = QueuedWriter(target, 'test', max_queue_bytes=10)
+    writer.append_bytes(b'a'*8)
+    Timer(0.2, target.unblock).start()
+    start_time = time.time()
+    writer.append_bytes(b'b'*8)  # Waits for the first chunk to be written
+    assert(time.time() - start_time >= 0.15)
+    writer.append_bytes(b'c'*8, close=True)
+    wait_until_finished(writer)
+    assert(target.data == b'a'*8 + b'b'*8 + b'c'*8)
+
+def test_invalid_overflow_policy():
+    with pytest.raises(ValueError):
+        QueuedWriter(MockWriter(), 'test', overflow_policy='ignore')
+
+# ---- Helpers
+
+def wait_until_finished(writer, timeout=5):
+    end_time = time.time() + timeout
+    while not writer.is_finished_writing() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(writer.is_finished_writing())
+
+# ---- Mock objects
+
+class MockWriter(ByteWriter):
+
+    def __init__(self, blocked=False):
+        super(MockWriter, self).__init__('mock')
+        self.calls = []
+        self.data = b''
+        self.__unblocked = Event()
+        if not blocked:
+            self.__unblocked.set()
+
+    def unblock(self):
+        self.__unblocked.set()
+
+    def append_bytes(self, bts, close=False):
+        self.__unblocked.wait()
+        self.calls.append(('append', bytes(bts), close))
+        self.data += bts
+
+    def flush(self):
+        self.calls.append(('flush',))
@@ -0,0 +1,96 @@
+import time
+from threading import Thread
+from watchtower.streamer.writer import dropbox_writer
+from watchtower.streamer.writer.upload_monitor import TokenBucket, UploadMonitor, MIN_CHUNK_SIZE
+from watchtower.streamer.writer.upload_service import UploadService
+
+
+def test_token_bucket_shared_rate():
+    """
+    Ensures threads sharing a bucket are limited to its rate once the burst
+    is spent.
+    """
+    bucket = TokenBucket(rate=100*1024, burst=10*1024)
+    def send():
+        for _ in range(5):
+            bucket.consume(4*1024)
+    threads = [Thread(target=send) for _ in range(3)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+    # 60 KB were sent, 10 KB of them in the burst.
+    assert(elapsed >= 0.45)
+    assert(elapsed < 1.5)
+
+def test_rate_limit_across_writers(fake_dropbox):
+    monitor = UploadMonitor(rate_limit=200*1024, adaptive=False)
+    service = UploadService(worker_count=4)
+    writers = [dropbox_writer.DropboxWriter('/camera/%d.h264' % i,
+                                            dropbox_token='',
+                                            file_chunk_size=50*1024,
+                                            test_dropbox_uploader=fake_dropbox,
+                                            upload_service=service,
+                                            upload_monitor=monitor) for i in range(2)]
+    start_time = time.time()
+    for writer in writers:
+        writer.append_bytes(bytes(200*1024), close=True)
+    assert(monitor.metrics()['backlog_bytes'] > 0)
+    wait_until(lambda: all(w.is_finished_writing() for w in writers))
+    elapsed = time.time() - start_time
+
+    # 400 KB at 200 KB/s, with the first 200 KB sent at once.
+    assert(elapsed >= 0.9)
+    metrics = monitor.metrics()
+    assert(metrics['backlog_bytes'] == 0)
+    assert(metrics['throttled_sec'] > 0)
+    assert(metrics['achieved_rate'] == 400*1024 / 10)  # Over the 10 second window
+    assert(fake_dropbox.uploaded_bytes == 400*1024)
+
+def test_adaptive_chunk_size():
+    monitor = UploadMonitor()
+    assert(monitor.chunk_size(512*1024) == 512*1024)  # Nothing measured yet
+    monitor.upload(0, lambda: time.sleep(0.05))  # Latency
+    monitor.upload(100*1024, lambda: time.sleep(0.15))  # About 1 MB/s
+    metrics = monitor.metrics()
+    assert(0.04 < metrics['latency_sec'] < 0.1)
+    assert(0.5*1024*1024 < metrics['bandwidth'] < 1.2*1024*1024)
+    size = monitor.chunk_size(512*1024)
+    assert(1024*1024 < size < 2.5*1024*1024)  # About 2 seconds
+    assert(size % MIN_CHUNK_SIZE == 0)
+
+    limited = UploadMonitor(rate_limit=128*1024)
+    limited.upload(100*1024, lambda: time.sleep(0.1))
+    assert(limited.chunk_size(512*1024) == 256*1024)
+
+    slow = UploadMonitor()
+    slow.upload(20*1024, lambda: time.sleep(0.5))  # About 40 KB/s
+    assert(slow.chunk_size(512*1024) == MIN_CHUNK_SIZE)
+    assert(UploadMonitor(adaptive=False).chunk_size(512*1024) == 512*1024)
+
+def test_writer_adapts_chunk_size(fake_dropbox):
+    monitor = UploadMonitor()
+    monitor.upload(100*1024, lambda: time.sleep(0.1))
+    adapted_size = monitor.chunk_size(0)
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token='',
+                                          file_chunk_size=64*1024,
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_service=UploadService(worker_count=1),
+                                          upload_monitor=monitor)
+    writer.append_bytes(bytes(64*1024 + adapted_size + 1), close=True)
+    wait_until(writer.is_finished_writing)
+    sizes = [len(fake_dropbox.files['/camera/video%d.h264' % i]) for i in range(3)]
+    assert(sizes[0] == 64*1024)
+    assert(sizes[1] == adapted_size)
+    assert(sizes[2] == 1)
+
+# ---- Helpers
+
+def wait_until(condition, timeout=5):
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(condition())
@@ -0,0 +1,86 @@
+import threading
+import time
+from threading import Event
+from watchtower.streamer.writer import dropbox_writer, upload_service
+from watchtower.streamer.writer.upload_service import UploadService
+
+
+def test_priority_order():
+    """
+    Ensures trigger uploads run before the video uploads queued ahead of them.
+    """
+    service = UploadService(worker_count=1)
+    started = Event()
+    release = Event()
+    service.submit(lambda: (started.set(), release.wait()), upload_service.PRIORITY_VIDEO)
+    started.wait(5)  # The only worker is now busy.
+
+    order = []
+    service.submit(lambda: order.append('video1'), upload_service.PRIORITY_VIDEO)
+    service.submit(lambda: order.append('video2'), upload_service.PRIORITY_VIDEO)
+    service.submit(lambda: order.append('trigger'), upload_service.PRIORITY_TRIGGER)
+    release.set()
+    wait_until(lambda: len(order) == 3)
+    assert(order == ['trigger', 'video1', 'video2'])
+
+def test_lane_runs_in_order():
+    """
+    Ensures tasks sharing a lane run one at a time and in order, even with
+    several workers.
+    """
+    service = UploadService(worker_count=4)
+    lane = object()
+    order = []
+    running = []
+
+    def task(i):
+        running.append(i)
+        assert(len(running) == 1)
+        time.sleep(0.01)
+        order.append(i)
+        running.remove(i)
+
+    for i in range(10):
+        service.submit(lambda i=i: task(i), upload_service.PRIORITY_VIDEO, lane)
+    wait_until(lambda: len(order) == 10)
+    assert(order == list(range(10)))
+    assert(service.pending_count == 0)
+
+def test_task_exception_does_not_stop_worker():
+    service = UploadService(worker_count=1)
+    done = Event()
+    service.submit(lambda: 1/0, upload_service.PRIORITY_VIDEO)
+    service.submit(done.set, upload_service.PRIORITY_VIDEO)
+    assert(done.wait(5))
+
+def test_thread_count_is_flat(fake_dropbox):
+    """
+    Ensures many concurrent writers share the service's workers instead of
+    creating their own threads.
+    """
+    service = UploadService(worker_count=2)
+    thread_count = threading.active_count()
+    writers = []
+    for i in range(20):
+        writer = dropbox_writer.DropboxWriter('/camera/%d.h264' % i,
+                                              dropbox_token='',
+                                              file_chunk_size=4,
+                                              test_dropbox_uploader=fake_dropbox,
+                                              upload_service=service)
+        writer.append_bytes(b'0123456789')
+        writers.append(writer)
+    assert(threading.active_count() == thread_count)
+
+    for writer in writers:
+        writer.append_bytes(b'', close=True)
+    wait_until(lambda: all(w.is_finished_writing() for w in writers))
+    assert(len(fake_dropbox.files) == 20 * 3)
+    assert(fake_dropbox.uploaded_bytes == 20 * 10)
+
+# ---- Helpers
+
+def wait_until(condition, timeout=5):
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(condition())
@@ -0,0 +1,181 @@
+import dropbox.exceptions
+import time
+from threading import Event
+from watchtower.streamer.writer import dropbox_writer, upload_service
+from watchtower.streamer.writer.upload_service import UploadService
+from watchtower.streamer.writer.upload_spool import UploadSpool
+
+
+def test_outage_recovery(fake_dropbox, tmp_path):
+    """
+    Ensures chunks that fail during an outage are spooled and uploaded once
+    the uplink recovers.
+    """
+    service = UploadService(worker_count=2)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service, min_backoff=0.05, max_backoff=0.1)
+    fake_dropbox.failing = True
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token='',
+                                          file_chunk_size=1024,
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_service=service,
+                                          spool=spool)
+    data = bytes(range(256)) * 20
+    writer.append_bytes(data, close=True)
+    wait_until(writer.is_finished_writing)
+    wait_until(lambda: spool.metrics()['failures'] > 0)
+    assert(spool.metrics()['entries'] == 5)
+    assert(len(fake_dropbox.files) == 0)
+
+    fake_dropbox.failing = False
+    wait_until(lambda: spool.metrics()['entries'] == 0)
+    spool.close()
+    assert(b''.join(fake_dropbox.files['/camera/video%d.h264' % i] for i in range(5)) == data)
+    assert(spool.metrics()['uploaded'] == 5)
+
+def test_session_outage(fake_dropbox, tmp_path):
+    """
+    Ensures a failed upload session continues with numbered files and its
+    commit is spooled.
+    """
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service, min_backoff=0.05, max_backoff=0.1)
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token='',
+                                          file_chunk_size=4,
+                                          test_dropbox_uploader=fake_dropbox,
+                                          upload_session=True,
+                                          upload_service=service,
+                                          spool=spool)
+    writer.append_bytes(b'0123')
+    wait_until(lambda: fake_dropbox.request_count == 1)
+    fake_dropbox.failing = True
+    writer.append_bytes(b'4567', close=True)
+    wait_until(writer.is_finished_writing)
+    assert(spool.metrics()['entries'] == 2)  # The chunk and the commit
+
+    fake_dropbox.failing = False
+    wait_until(lambda: spool.metrics()['entries'] == 0)
+    spool.close()
+    assert(fake_dropbox.files['/camera/video.h264'] == b'0123')
+    assert(fake_dropbox.files['/camera/video1.h264'] == b'4567')
+
+def test_survives_restart(fake_dropbox, tmp_path):
+    fake_dropbox.failing = True
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service)
+    spool.add('/camera/a.jpg', b'a', upload_service.PRIORITY_TRIGGER, 1)
+    spool.add('/camera/b.h264', b'b', upload_service.PRIORITY_VIDEO, 1)
+    spool.add('/camera/c.h264', b'c', upload_service.PRIORITY_VIDEO, 1)
+    wait_until(lambda: spool.metrics()['failures'] == 1)
+    spool.close()
+    (tmp_path / '99.chunk').write_bytes(b'orphan')  # Not in the journal
+
+    fake_dropbox.failing = False
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service)
+    wait_until(lambda: spool.metrics()['entries'] == 0)
+    spool.close()
+    assert(fake_dropbox.files == {'/camera/a.jpg': b'a', '/camera/b.h264': b'b', '/camera/c.h264': b'c'})
+    assert(sorted(p.name for p in tmp_path.iterdir()) == ['journal.log'])
+
+def test_drain_order(fake_dropbox, tmp_path):
+    """
+    Ensures trigger images drain first, then the newest events.
+    """
+    fake_dropbox.failing = True
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service, min_backoff=0.05, max_backoff=0.05)
+    spool.add('/old/video0.h264', b'1', upload_service.PRIORITY_VIDEO, 1)
+    spool.add('/new/video0.h264', b'2', upload_service.PRIORITY_VIDEO, 2)
+    spool.add('/old/trigger.jpg', b'3', upload_service.PRIORITY_TRIGGER, 1)
+    spool.add('/new/video1.h264', b'4', upload_service.PRIORITY_VIDEO, 2)
+    uploaded = []
+    original_upload = fake_dropbox.files_upload
+    def files_upload(f, path):
+        original_upload(f, path)
+        uploaded.append(path)
+    fake_dropbox.files_upload = files_upload
+    fake_dropbox.failing = False
+    wait_until(lambda: len(uploaded) == 4)
+    spool.close()
+    assert(uploaded == ['/old/trigger.jpg', '/new/video0.h264', '/new/video1.h264', '/old/video0.h264'])
+
+def test_failing_entries_are_discarded(fake_dropbox, tmp_path):
+    """
+    Ensures entries that fail for reasons other than the uplink are discarded
+    instead of holding up the entries behind them.
+    """
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service, min_backoff=10, max_attempts=3)
+    attempts = {}
+    started = Event()
+    original_upload = fake_dropbox.files_upload
+    def files_upload(f, path):
+        started.wait()
+        attempts[path] = attempts.get(path, 0) + 1
+        if path == '/bad/trigger.jpg':
+            raise dropbox.exceptions.BadInputError('request', 'Invalid path.')
+        if path == '/flaky/trigger.jpg':
+            raise RuntimeError('Unexpected response.')
+        original_upload(f, path)
+    fake_dropbox.files_upload = files_upload
+    spool.add('/bad/trigger.jpg', b'b', upload_service.PRIORITY_TRIGGER, 2)
+    spool.add('/flaky/trigger.jpg', b'f', upload_service.PRIORITY_TRIGGER, 2)
+    for i in range(3):
+        spool.add('/new/video%d.h264' % i, b'v', upload_service.PRIORITY_VIDEO, 2)
+    spool.add('/evicted/video0.h264', b'e', upload_service.PRIORITY_VIDEO, 1)
+    (tmp_path / '5.chunk').unlink()  # Like an eviction during its upload
+    started.set()
+
+    wait_until(lambda: spool.metrics()['entries'] == 0)
+    spool.close()
+    assert(sorted(fake_dropbox.files) == ['/new/video0.h264', '/new/video1.h264', '/new/video2.h264'])
+    assert(attempts == {'/bad/trigger.jpg': 1, '/flaky/trigger.jpg': 3, '/new/video0.h264': 1,
+                        '/new/video1.h264': 1, '/new/video2.h264': 1})
+    metrics = spool.metrics()
+    assert(metrics['discarded'] == 3)
+    assert(metrics['backoff_sec'] == 0)
+
+def test_quota_evicts_oldest_video(fake_dropbox, tmp_path):
+    fake_dropbox.failing = True
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, max_bytes=30, upload_service=service, min_backoff=10)
+    assert(spool.add('/old/trigger.jpg', b't'*10, upload_service.PRIORITY_TRIGGER, 1))
+    assert(spool.add('/old/video0.h264', b'o'*10, upload_service.PRIORITY_VIDEO, 1))
+    assert(spool.add('/new/video0.h264', b'n'*10, upload_service.PRIORITY_VIDEO, 2))
+    assert(spool.add('/new/video1.h264', b'n'*10, upload_service.PRIORITY_VIDEO, 2))
+    assert(not spool.add('/older/video0.h264', b'x'*10, upload_service.PRIORITY_VIDEO, 0))
+    metrics = spool.metrics()
+    assert(metrics['bytes'] == 30)
+    assert(metrics['evicted'] == 2)
+    spool.close()
+    assert(not (tmp_path / '1.chunk').exists())
+
+def test_drain_throughput(tmp_path):
+    """
+    Measures how quickly a backlog drains after an outage against a
+    FakeDropbox with a simulated round trip.
+    """
+    from conftest import FakeDropbox
+    fake_dropbox = FakeDropbox(latency=0.005)
+    fake_dropbox.failing = True
+    service = UploadService(worker_count=1)
+    spool = UploadSpool(tmp_path, fake_dropbox, upload_service=service, min_backoff=0.05, max_backoff=0.05)
+    chunk = bytes(64*1024)
+    for i in range(50):
+        spool.add('/camera/video%d.h264' % i, chunk, upload_service.PRIORITY_VIDEO, 1)
+    fake_dropbox.failing = False
+    start_time = time.time()
+    wait_until(lambda: spool.metrics()['entries'] == 0, timeout=10)
+    elapsed = time.time() - start_time
+    spool.close()
+    print('Drained 50 chunks in %.2f sec (%.1f MB/s).' % (elapsed, 50 * len(chunk) / elapsed / 1024 / 1024))
+    assert(len(fake_dropbox.files) == 50)
+
+# ---- Helpers
+
+def wait_until(condition, timeout=5):
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.01)
+    assert(condition())
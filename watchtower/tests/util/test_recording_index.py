@@ -0,0 +1,188 @@
+import os
+import pytest
+import time
+from watchtower.util import file_system as fs
+from watchtower.util import recording_index
+from watchtower.util.recording_index import RecordingIndex
+
+DAY_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%H.%M.%S'
+
+
+def test_matches_file_system(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-02', '2019-12-31'], ['09.00.00', '23.59.59', '10.30.00'])
+    os.makedirs(os.path.join(recordings_path, 'not-a-day'))
+    os.makedirs(os.path.join(recordings_path, '2020-01-02', 'not-a-time'))
+    index = create_index(recordings_path, tmp_path)
+    assert(index.all_recordings() == fs.all_recordings(recordings_path, DAY_FORMAT, TIME_FORMAT))
+    assert(index.times_for_day('2020-01-02') == ['23.59.59', '10.30.00', '09.00.00'])
+
+def test_incremental_updates(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-01'], ['08.00.00'])
+    index = create_index(recordings_path, tmp_path)
+    index.add('2020-01-01', '09.00.00')
+    index.add('2020-01-02', '07.00.00')
+    index.add('2020-01-02', 'invalid')
+    assert(index.all_recordings() == [{'day': '2020-01-02', 'times': ['07.00.00']},
+                                      {'day': '2020-01-01', 'times': ['09.00.00', '08.00.00']}])
+
+    assert(fs.delete_recording(recordings_path, '2020-01-01', '08.00.00', index=index))
+    assert(index.times_for_day('2020-01-01') == ['09.00.00'])
+    index.remove('2020-01-02')
+    assert(index.all_recordings() == [{'day': '2020-01-01', 'times': ['09.00.00']}])
+
+def test_rebuilds_stale_days(recordings_path, tmp_path):
+    """
+    Ensures changes made while Watchtower wasn't running are picked up at
+    startup.
+    """
+    create_recordings(recordings_path, ['2020-01-01', '2020-01-02'], ['08.00.00'])
+    create_index(recordings_path, tmp_path).close()
+
+    create_recordings(recordings_path, ['2020-01-01', '2020-01-03'], ['09.00.00'])
+    fs.delete_recording(recordings_path, '2020-01-02')
+    bump_mtime(os.path.join(recordings_path, '2020-01-01'))
+    index = create_index(recordings_path, tmp_path)
+    assert(index.all_recordings() == fs.all_recordings(recordings_path, DAY_FORMAT, TIME_FORMAT))
+
+def test_rebuilds_when_formats_change(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-01'], ['08.00.00'])
+    create_index(recordings_path, tmp_path).close()
+    index = RecordingIndex(os.path.join(tmp_path, 'index.sqlite3'), recordings_path, '%Y-%m-%d', '%H-%M-%S')
+    assert(index.all_recordings() == [])
+
+def test_pages(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-%02d' % day for day in range(1, 6)], ['08.00.00', '09.00.00'])
+    index = create_index(recordings_path, tmp_path)
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = index.recordings_page(2, cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+    assert([[day['day'] for day in page] for page in pages] == [['2020-01-05', '2020-01-04'],
+                                                                ['2020-01-03', '2020-01-02'],
+                                                                ['2020-01-01']])
+    assert(sum(pages, []) == index.all_recordings())
+    assert(index.recordings_page(5) == (index.all_recordings(), None))
+    assert(index.recordings_page(2, 'invalid') == ([], None))
+    assert(index.recordings_page(2, '2020-01-01') == ([], None))
+
+def test_change_feed(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-01'], ['08.00.00', '09.00.00'])
+    index = create_index(recordings_path, tmp_path)
+    cursor = index.cursor
+    assert(index.changes(cursor) == (cursor, []))
+
+    create_recordings(recordings_path, ['2020-01-02'], ['07.00.00'])
+    index.add('2020-01-02', '07.00.00')
+    index.add('2020-01-02', '07.00.00')  # Already indexed
+    fs.delete_recording(recordings_path, '2020-01-01', index=index)
+    index.remove('2020-01-01', '08.00.00')  # Already removed
+    new_cursor, changes = index.changes(cursor)
+    assert(new_cursor == cursor + 3)
+    assert([(c['change'], c['day'], c['time']) for c in changes] == [('added', '2020-01-02', '07.00.00'),
+                                                                    ('removed', '2020-01-01', '08.00.00'),
+                                                                    ('removed', '2020-01-01', '09.00.00')])
+    assert([c['cursor'] for c in changes] == [cursor + 1, cursor + 2, cursor + 3])
+
+    # Paging
+    assert(index.changes(cursor, limit=2) == (cursor + 2, changes[:2]))
+    assert(index.changes(cursor + 2, limit=2) == (cursor + 3, changes[2:]))
+
+    # The cursor isn't reused after a restart.
+    index.close()
+    index = create_index(recordings_path, tmp_path)
+    assert(index.cursor == new_cursor)
+    index.add('2020-01-03', '07.00.00')
+    assert(index.changes(new_cursor)[0] == new_cursor + 1)
+
+def test_change_feed_of_sync(recordings_path, tmp_path):
+    create_recordings(recordings_path, ['2020-01-01'], ['08.00.00'])
+    index = create_index(recordings_path, tmp_path)
+    cursor = index.cursor
+    create_recordings(recordings_path, ['2020-01-01'], ['09.00.00'])
+    fs.delete_recording(recordings_path, '2020-01-01', '08.00.00')
+    bump_mtime(os.path.join(recordings_path, '2020-01-01'))
+    index.sync()
+    assert([(c['change'], c['time']) for c in index.changes(cursor)[1]] == [('removed', '08.00.00'),
+                                                                           ('added', '09.00.00')])
+
+def test_expired_changes(recordings_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(recording_index, 'MAX_CHANGES', 3)
+    index = create_index(recordings_path, tmp_path)
+    for hour in range(5):
+        index.add('2020-01-01', '%02d.00.00' % hour)
+    assert(index.changes(1) == (5, None))  # Changes 2 and earlier were dropped
+    assert(len(index.changes(2)[1]) == 3)
+    assert(index.changes(6) == (5, None))  # From another index
+
+def test_version(recordings_path, tmp_path):
+    index = create_index(recordings_path, tmp_path)
+    etag, last_modified = index.version()
+    assert(last_modified is None)
+    assert(index.version() == (etag, None))
+    index.add('2020-01-01', '08.00.00')
+    new_etag, last_modified = index.version()
+    assert(new_etag != etag)
+    assert(last_modified.endswith(' GMT'))
+    index.remove('2020-01-01', '09.00.00')  # Nothing changes
+    assert(index.version() == (new_etag, last_modified))
+
+    # A new database doesn't reuse the ETags.
+    index.close()
+    os.remove(os.path.join(tmp_path, 'index.sqlite3'))
+    index = create_index(recordings_path, tmp_path)
+    index.add('2020-01-01', '08.00.00')
+    assert(index.version()[0] != new_etag)
+
+def test_listing_benchmark(recordings_path, tmp_path):
+    """
+    Compares listing the recordings with the index against walking the
+    directories, and against reading the first page of the web app, as the
+    number of recordings grows.
+    """
+    days = ['2019-%02d-%02d' % (month, day) for month in range(1, 13) for day in range(1, 29)]
+    index = None
+    for day_count in (28, len(days)):
+        create_recordings(recordings_path, days[:day_count], ['%02d.00.00' % hour for hour in range(10)])
+        if index is not None:
+            index.close()
+        index = create_index(recordings_path, tmp_path)
+        start_time = time.perf_counter()
+        walked = fs.all_recordings(recordings_path, DAY_FORMAT, TIME_FORMAT)
+        walk_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        indexed = index.all_recordings()
+        index_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        index.recordings_page(7)
+        page_time = time.perf_counter() - start_time
+        print('%d recordings. Walk: %.1f ms. Index: %.1f ms. First page: %.1f ms.' %
+              (day_count * 10, walk_time * 1000, index_time * 1000, page_time * 1000))
+        assert(indexed == walked)
+        assert(index_time < walk_time)
+
+# ---- Fixtures
+
+@pytest.fixture
+def recordings_path(tmp_path):
+    path = os.path.join(tmp_path, 'recordings')
+    os.makedirs(path)
+    return path
+
+# ---- Helpers
+
+def create_index(recordings_path, tmp_path):
+    return RecordingIndex(os.path.join(tmp_path, 'index.sqlite3'), recordings_path, DAY_FORMAT, TIME_FORMAT)
+
+def create_recordings(recordings_path, days, times):
+    for day in days:
+        for time_name in times:
+            os.makedirs(os.path.join(recordings_path, day, time_name), exist_ok=True)
+
+def bump_mtime(path):
+    # Some file systems only store the modification time in seconds.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
@@ -62,11 +62,12 @@ def all_recording_times_for_day(path, day_dirname, time_format):
     dirpath, dirnames, filenames = next(os.walk(path))
     return __dirnames_matching_format(dirnames, time_format)
 
-def delete_recording(path, day_dirname, time_dirname=None):
+def delete_recording(path, day_dirname, time_dirname=None, index=None):
     """
     If a time_dirname is supplied, this will delete the time directory within
     the provided day directory. Otherwise if just a day_dirname is supplied,
-    the day's whole directory tree will be deleted.
+    the day's whole directory tree will be deleted. The deleted recordings
+    are also removed from the optional RecordingIndex.
     """
     path = os.path.join(path, day_dirname)
     if time_dirname is not None:
@@ -74,6 +75,8 @@ def delete_recording(path, day_dirname, time_dirname=None):
     if os.path.exists(os.path.dirname(path)):
         try:
             shutil.rmtree(path)
+            if index is not None:
+                index.remove(day_dirname, time_dirname)
             return True
         except Exception as ex:
             print(ex)
@@ -0,0 +1,300 @@
+"""This module contains an index of the recordings on disk, so they can be
+listed without walking the recordings directory.
+
+The index is a SQLite database in the instance directory. It's updated as
+recordings are created and deleted. The modification time of each day
+directory is stored when it's scanned, so at startup only the days that
+changed on disk are scanned again.
+
+Every recording that's added or removed is also logged with a cursor that
+increases with each change, so clients can fetch what changed since the
+cursor of their last request instead of the whole listing.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+from threading import Lock
+from werkzeug.http import http_date
+
+DAY_KEY_FORMAT = '%Y%m%d'
+TIME_KEY_FORMAT = '%H%M%S%f'
+MAX_CHANGES = 10000  # The number of changes kept for the change feed
+ADDED = 'added'
+REMOVED = 'removed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    day TEXT NOT NULL,
+    time TEXT NOT NULL,
+    day_key TEXT NOT NULL,
+    time_key TEXT NOT NULL,
+    PRIMARY KEY (day, time)
+);
+CREATE INDEX IF NOT EXISTS recordings_order ON recordings (day_key DESC, time_key DESC);
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS changes (
+    cursor INTEGER PRIMARY KEY AUTOINCREMENT,
+    change TEXT NOT NULL,
+    day TEXT NOT NULL,
+    time TEXT NOT NULL,
+    changed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class RecordingIndex:
+    """
+    A persistent index of the recording day and time directories. All
+    methods can be called from any thread.
+    """
+
+    def __init__(self, db_path, recordings_path, day_format, time_format):
+        """
+        :param db_path: The path of the SQLite database. It's created if
+        needed.
+        :param recordings_path: The recordings directory that is indexed.
+        :param day_format: The strptime format of the day directories.
+        :param time_format: The strptime format of the time directories.
+        """
+        self.__recordings_path = recordings_path
+        self.__day_format = day_format
+        self.__time_format = time_format
+        self.__lock = Lock()
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.executescript(SCHEMA)
+            formats = '%s|%s' % (day_format, time_format)
+            row = self.__db.execute("SELECT value FROM meta WHERE key = 'formats'").fetchone()
+            if row is None or row[0] != formats:
+                # The directory names are parsed differently, so start over.
+                self.__log(REMOVED, self.__db.execute('SELECT day, time FROM recordings').fetchall())
+                self.__db.execute('DELETE FROM recordings')
+                self.__db.execute('DELETE FROM days')
+                self.__db.execute("INSERT OR REPLACE INTO meta VALUES ('formats', ?)", (formats,))
+            # Identifies this database in the ETags, so they can't match those
+            # of a database that was deleted and created again.
+            self.__db.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)", (uuid.uuid4().hex,))
+            self.__id = self.__db.execute("SELECT value FROM meta WHERE key = 'id'").fetchone()[0]
+            row = self.__db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            self.__cursor = row[0] if row is not None else 0
+            row = self.__db.execute('SELECT MAX(changed) FROM changes').fetchone()
+            self.__changed = row[0]
+        self.sync()
+
+    @property
+    def cursor(self):
+        """
+        The cursor of the latest change, or 0 before the first one.
+        """
+        return self.__cursor
+
+    def version(self):
+        """
+        Reads no more than memory, so polling clients cost almost nothing.
+        Call it before reading a listing, so a change made in between makes
+        the client read the listing again instead of missing the change.
+
+        :return: The ETag of the current listings and their HTTP
+        Last-Modified date, which is None before the first change.
+        """
+        with self.__lock:
+            etag = '%s-%d' % (self.__id, self.__cursor)
+            last_modified = http_date(self.__changed) if self.__changed is not None else None
+        return etag, last_modified
+
+    def changes(self, since, limit=1000):
+        """
+        :param since: The cursor of the last change the client has seen.
+        :param limit: The maximum number of changes returned. The returned
+        cursor is that of the last returned change, so the client gets the
+        rest by calling again with it.
+        :return: The cursor to pass as ``since`` next time and a list of
+        dictionaries of the changes with their ``cursor``, ``change``
+        (``added`` or ``removed``), ``day`` and ``time``, oldest first. The
+        list is None if the changes since the cursor are no longer kept, in
+        which case the client needs the whole listing again.
+        """
+        with self.__lock:
+            cursor = self.__cursor
+            if since == cursor:
+                return cursor, []
+            oldest = self.__db.execute('SELECT MIN(cursor) FROM changes').fetchone()[0]
+            if since > cursor or oldest is None or since < oldest - 1:
+                return cursor, None
+            rows = self.__db.execute('SELECT cursor, change, day, time FROM changes WHERE cursor > ? '
+                                     'ORDER BY cursor LIMIT ?', (since, limit)).fetchall()
+        if len(rows) == limit:
+            cursor = rows[-1][0]
+        return cursor, [dict(cursor=row[0], change=row[1], day=row[2], time=row[3]) for row in rows]
+
+    def sync(self):
+        """
+        Brings the index up to date with the disk by scanning the day
+        directories that were added or modified since they were last
+        scanned.
+        """
+        disk_days = {}
+        if os.path.isdir(self.__recordings_path):
+            for entry in os.scandir(self.__recordings_path):
+                if entry.is_dir() and self.__key(entry.name, self.__day_format, DAY_KEY_FORMAT) is not None:
+                    disk_days[entry.name] = entry.stat().st_mtime_ns
+        with self.__lock, self.__db:
+            indexed_days = dict(self.__db.execute('SELECT day, mtime_ns FROM days'))
+            indexed_days.update((day, None) for day, in self.__db.execute('SELECT DISTINCT day FROM recordings')
+                                if day not in indexed_days)
+            removed_days = [day for day in indexed_days if day not in disk_days]
+            for day in removed_days:
+                self.__delete(day)
+            scanned_days = [day for day, mtime_ns in disk_days.items() if indexed_days.get(day) != mtime_ns]
+            for day in scanned_days:
+                self.__scan(day, disk_days[day])
+        if len(removed_days) > 0 or len(scanned_days) > 0:
+            logging.getLogger(__name__).info('Recording index updated. Scanned %d days and removed %d.' %
+                                             (len(scanned_days), len(removed_days)))
+
+    def add(self, day, time):
+        """
+        Adds a recording. Names that don't match the formats are ignored.
+        """
+        day_key = self.__key(day, self.__day_format, DAY_KEY_FORMAT)
+        time_key = self.__key(time, self.__time_format, TIME_KEY_FORMAT)
+        if day_key is None or time_key is None:
+            return
+        with self.__lock, self.__db:
+            inserted = self.__db.execute('INSERT OR IGNORE INTO recordings VALUES (?, ?, ?, ?)',
+                                         (day, time, day_key, time_key)).rowcount
+            if inserted > 0:
+                self.__log(ADDED, [(day, time)])
+            # The day is scanned again at startup, which picks up its new
+            # modification time.
+            self.__db.execute('INSERT OR IGNORE INTO days VALUES (?, NULL)', (day,))
+
+    def remove(self, day, time=None):
+        """
+        Removes a recording, or a whole day if no time is supplied.
+        """
+        with self.__lock, self.__db:
+            if time is None:
+                self.__delete(day)
+            elif self.__db.execute('DELETE FROM recordings WHERE day = ? AND time = ?', (day, time)).rowcount > 0:
+                self.__log(REMOVED, [(day, time)])
+
+    def all_recordings(self):
+        """
+        :return: The same array of dictionaries as
+        ``file_system.all_recordings()``, with one dictionary per day.
+        """
+        with self.__lock:
+            rows = self.__db.execute('SELECT day, time FROM recordings ORDER BY day_key DESC, time_key DESC').fetchall()
+        return self.__group(rows)
+
+    def recordings_page(self, limit, before=None):
+        """
+        Reads one page of ``all_recordings()``. The cost of a page depends
+        on its size rather than on the number of recordings.
+
+        :param limit: The maximum number of days in the page.
+        :param before: The cursor returned with the previous page. None gets
+        the first page.
+        :return: The page's days, in the format of ``all_recordings()``,
+        and the cursor of the next page, which is None after the last page.
+        Invalid cursors give an empty page.
+        """
+        if before is None:
+            before_key = '99999999'
+        else:
+            before_key = self.__key(before, self.__day_format, DAY_KEY_FORMAT)
+            if before_key is None:
+                return [], None
+        with self.__lock:
+            days = self.__db.execute('SELECT DISTINCT day_key FROM recordings WHERE day_key < ? '
+                                     'ORDER BY day_key DESC LIMIT ?', (before_key, limit + 1)).fetchall()
+            if len(days) == 0:
+                return [], None
+            last_key = days[min(limit, len(days)) - 1][0]
+            rows = self.__db.execute('SELECT day, time FROM recordings WHERE day_key < ? AND day_key >= ? '
+                                     'ORDER BY day_key DESC, time_key DESC', (before_key, last_key)).fetchall()
+        recordings = self.__group(rows)
+        return recordings, recordings[-1]['day'] if len(days) > limit else None
+
+    def times_for_day(self, day):
+        """
+        :return: The recording times of the day, newest first.
+        """
+        with self.__lock:
+            rows = self.__db.execute('SELECT time FROM recordings WHERE day = ? ORDER BY time_key DESC', (day,))
+            return [time for time, in rows]
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def __delete(self, day):
+        self.__log(REMOVED, self.__db.execute('SELECT day, time FROM recordings WHERE day = ?', (day,)).fetchall())
+        self.__db.execute('DELETE FROM recordings WHERE day = ?', (day,))
+        self.__db.execute('DELETE FROM days WHERE day = ?', (day,))
+
+    def __scan(self, day, mtime_ns):
+        rows = []
+        for entry in os.scandir(os.path.join(self.__recordings_path, day)):
+            time_key = self.__key(entry.name, self.__time_format, TIME_KEY_FORMAT)
+            if entry.is_dir() and time_key is not None:
+                rows.append((day, entry.name, self.__key(day, self.__day_format, DAY_KEY_FORMAT), time_key))
+        indexed_times = {time for time, in self.__db.execute('SELECT time FROM recordings WHERE day = ?', (day,))}
+        disk_times = {row[1] for row in rows}
+        self.__log(REMOVED, [(day, time) for time in sorted(indexed_times - disk_times)])
+        self.__log(ADDED, [(day, time) for time in sorted(disk_times - indexed_times)])
+        self.__db.execute('DELETE FROM recordings WHERE day = ?', (day,))
+        self.__db.executemany('INSERT INTO recordings VALUES (?, ?, ?, ?)', rows)
+        self.__db.execute('INSERT OR REPLACE INTO days VALUES (?, ?)', (day, mtime_ns))
+
+    def __log(self, change, recordings):
+        """
+        Adds changes to the change feed. Must be called in a transaction
+        while holding the lock.
+
+        :param recordings: A list of (day, time) tuples.
+        """
+        if len(recordings) == 0:
+            return
+        changed = time.time()
+        self.__db.executemany('INSERT INTO changes (change, day, time, changed) VALUES (?, ?, ?, ?)',
+                              [(change, day, time, changed) for day, time in recordings])
+        self.__cursor = self.__db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()[0]
+        self.__changed = changed
+        self.__db.execute('DELETE FROM changes WHERE cursor <= ?', (self.__cursor - MAX_CHANGES,))
+
+    @staticmethod
+    def __group(rows):
+        """
+        :param rows: (day, time) tuples ordered by day.
+        :return: A dictionary of each day and its times.
+        """
+        recordings = []
+        for day, time in rows:
+            if len(recordings) == 0 or recordings[-1]['day'] != day:
+                recordings.append({'day': day, 'times': []})
+            recordings[-1]['times'].append(time)
+        return recordings
+
+    @staticmethod
+    def __key(name, name_format, key_format):
+        """
+        :return: A key that sorts like the date in the name, or None if the
+        name doesn't match the format.
+        """
+        try:
+            return datetime.strptime(name, name_format).strftime(key_format)
+        except ValueError:
+            return None